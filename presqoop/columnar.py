@@ -0,0 +1,293 @@
+import json
+import math
+import array
+import base64
+import collections
+from literal import presto_base_type, double_literal, time_literal
+
+
+class StatementTooLongError(Exception):
+    pass
+
+
+# 列值的转换函数都以整列为单位: f(values, presto_type) -> [value, ...]，
+# values 中的 NULL 已替换为 TypeMapping.default，转换后再由 ColumnBatch 填回 NULL
+
+# export: 转换为 mysql 的语句参数 (cursor.executemany 的 %s)，由 pymysql 按连接的字符集与 sql_mode 转义
+
+def mysql_integers(values, presto_type):
+    return list(values)
+
+
+def mysql_booleans(values, presto_type):
+    return [1 if value else 0 for value in values]
+
+
+def mysql_floats(values, presto_type):
+    # mysql 不支持 NaN 与 Infinity
+    return [value if math.isfinite(value) else None for value in map(float, values)]
+
+
+def mysql_strings(values, presto_type):
+    return list(map(str, values))
+
+
+def mysql_zoned_timestamps(values, presto_type):
+    # presto 返回 '2019-01-01 00:00:00.000 Asia/Shanghai'，mysql 只保留本地时间部分
+    return [value.rsplit(' ', 1)[0] if value.count(' ') > 1 else value for value in map(str, values)]
+
+
+def mysql_base64(values, presto_type):
+    # presto 以 base64 返回 varbinary
+    return [base64.b64decode(value) for value in values]
+
+
+def mysql_json(values, presto_type):
+    return [json.dumps(value, ensure_ascii=False) for value in values]
+
+
+# import: 转换为 presto 字面量
+
+def presto_integers(values, presto_type):
+    return list(map(str, values))
+
+
+def presto_booleans(values, presto_type):
+    return ['true' if value else 'false' for value in values]
+
+
+def presto_strings(values, presto_type):
+    return ["'" + value.replace("'", "''") + "'" for value in map(str, values)]
+
+
+def presto_doubles(values, presto_type):
+    return list(map(double_literal, values))
+
+
+def presto_times(values, presto_type):
+    return list(map(time_literal, values))
+
+
+def presto_binaries(values, presto_type):
+    return ["X'{}'".format((value.encode('utf-8') if isinstance(value, str) else bytes(value)).hex()) for value in values]
+
+
+def presto_casts(values, presto_type):
+    return ['CAST({} AS {})'.format(literal, presto_type) for literal in presto_strings(values, presto_type)]
+
+
+def presto_json_casts(values, presto_type):
+    # mysql 的 json 文本转换为 array / map / row
+    return ['CAST(JSON {} AS {})'.format(literal, presto_type) for literal in presto_strings(
+        [value if isinstance(value, str) else json.dumps(value, ensure_ascii=False) for value in values], presto_type
+    )]
+
+
+def typed_literals(keyword, to_text=str):
+    """
+    <keyword> '<text>' 形式的字面量，例如 DATE '2019-01-01'
+    """
+    def convert(values, presto_type):
+        return [keyword + ' ' + literal for literal in presto_strings(map(to_text, values), presto_type)]
+    return convert
+
+
+def isoformat(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def isoformat_timestamp(value):
+    return value.isoformat(sep=' ') if hasattr(value, 'isoformat') else str(value)
+
+
+# typecode: 列在 ColumnBatch 中的存储方式，array.array 的 typecode，None 为 list
+# default: 替换 NULL 的值
+# to_mysql: presto 的查询结果 (export) 转换为 mysql 的语句参数
+# to_presto: mysql 的查询结果 (import) 转换为目标列类型的 presto 字面量
+TypeMapping = collections.namedtuple('TypeMapping', ['typecode', 'default', 'to_mysql', 'to_presto'])
+
+# presto 列类型 (去掉类型参数) -> TypeMapping
+TYPE_MAPPINGS = {
+    'boolean': TypeMapping('B', False, mysql_booleans, presto_booleans),
+    'tinyint': TypeMapping('b', 0, mysql_integers, typed_literals('TINYINT')),
+    'smallint': TypeMapping('h', 0, mysql_integers, typed_literals('SMALLINT')),
+    'integer': TypeMapping('i', 0, mysql_integers, presto_integers),
+    'bigint': TypeMapping('q', 0, mysql_integers, presto_integers),
+    # real 以 double 存储，避免 float32 改变 presto 返回的十进制表示
+    'real': TypeMapping('d', 0.0, mysql_floats, typed_literals('REAL', repr)),
+    'double': TypeMapping('d', 0.0, mysql_floats, presto_doubles),
+    'decimal': TypeMapping(None, '0', mysql_strings, typed_literals('DECIMAL')),
+    'varchar': TypeMapping(None, '', mysql_strings, presto_strings),
+    'char': TypeMapping(None, '', mysql_strings, presto_strings),
+    'json': TypeMapping(None, '', mysql_strings, typed_literals('JSON')),
+    'varbinary': TypeMapping(None, '', mysql_base64, presto_binaries),
+    'date': TypeMapping(None, '', mysql_strings, typed_literals('DATE', isoformat)),
+    'time': TypeMapping(None, '', mysql_strings, presto_times),
+    'timestamp': TypeMapping(None, '', mysql_strings, typed_literals('TIMESTAMP', isoformat_timestamp)),
+    'timestamp with time zone': TypeMapping(
+        None, '', mysql_zoned_timestamps, typed_literals('TIMESTAMP', isoformat_timestamp)
+    ),
+    'array': TypeMapping(None, [], mysql_json, presto_json_casts),
+    'map': TypeMapping(None, {}, mysql_json, presto_json_casts),
+    'row': TypeMapping(None, [], mysql_json, presto_json_casts),
+}
+
+# TYPE_MAPPINGS 中没有的类型
+DEFAULT_MAPPING = TypeMapping(None, '', mysql_strings, presto_casts)
+
+
+def type_mapping(presto_type):
+    return TYPE_MAPPINGS.get(presto_base_type(presto_type), DEFAULT_MAPPING)
+
+
+def presto_literal_formatter(presto_type):
+    """
+    返回把单个值转换为 presto_type 字面量的函数，None 转换为 NULL
+
+    **Usage**
+
+        format_decimal = presto_literal_formatter('decimal(10,2)')
+        format_decimal(Decimal('1.50'))  # DECIMAL '1.50'
+    """
+    to_presto = type_mapping(presto_type).to_presto
+    return lambda value: 'NULL' if value is None else to_presto([value], presto_type)[0]
+
+
+class ColumnBatch:
+    """
+    按列存储的一批行
+
+    **Basic**
+
+    fetchmany 得到的行转置为列，定长类型 (整数、浮点数、布尔) 存为 array.array，其他类型存为 list，
+    NULL 记录在每列的 null 下标中并替换为 TypeMapping.default，
+    转换时按 TYPE_MAPPINGS 对整列调用一次转换函数，而不是对每个值分别判断类型
+
+    **Usage**
+
+        batch = ColumnBatch(['id', 'name'], ['bigint', 'varchar'], [(1, 'a'), (2, None)])
+        batch.to_values()  # ["(1, 'a')", '(2, NULL)']
+        batch.to_parameters()  # [(1, 'a'), (2, None)]
+    """
+
+    def __init__(self, names, presto_types, rows):
+        """
+        :params names: 列名
+        :params presto_types: 每列的 presto 类型 (export 为查询结果的类型，import 为目标表的类型)
+        :params rows: [row, ...]
+        """
+        self.names = names
+        self.presto_types = presto_types
+        self.size = len(rows)
+        self.columns = []
+        self.nulls = []
+
+        for values, presto_type in zip(zip(*rows), presto_types):
+            mapping = type_mapping(presto_type)
+            nulls = [index for index, value in enumerate(values) if value is None] if None in values else []
+            if len(nulls) != 0:
+                values = [mapping.default if value is None else value for value in values]
+
+            if mapping.typecode is not None:
+                try:
+                    values = array.array(mapping.typecode, values)
+                except (TypeError, OverflowError):
+                    # 例如 mysql 的 decimal、bigint unsigned，保持为 list
+                    pass
+            self.columns.append(values)
+            self.nulls.append(nulls)
+
+
+    def __convert(self, target, null):
+        """
+        每列按 TypeMapping 转换，NULL 填回 null
+
+        :params target: 'mysql' 或 'presto'
+        :return: [[value, ...] (一列), ...]
+        """
+        columns = []
+        for values, nulls, presto_type in zip(self.columns, self.nulls, self.presto_types):
+            mapping = type_mapping(presto_type)
+            converted = (mapping.to_mysql if target == 'mysql' else mapping.to_presto)(values, presto_type)
+            for index in nulls:
+                converted[index] = null
+            columns.append(converted)
+        return columns
+
+
+    def to_literals(self):
+        """
+        每列转换为 presto 字面量
+
+        :return: [[literal, ...] (一列), ...]
+        """
+        return self.__convert('presto', 'NULL')
+
+
+    def to_values(self):
+        """
+        每行转换为 presto VALUES 中的一项: (literal, literal, ...)
+        """
+        return ['(' + ', '.join(row) + ')' for row in zip(*self.to_literals())]
+
+
+    def to_parameters(self):
+        """
+        每行转换为 mysql 语句的参数 (cursor.executemany)，NULL 为 None
+
+        :return: [(value, value, ...), ...]
+        """
+        return list(zip(*self.__convert('mysql', None)))
+
+
+class StatementBuffer:
+    """
+    把 VALUES 项拼成多行 INSERT 语句，每条语句的长度不超过 max_length
+
+    **Usage**
+
+        buffer = StatementBuffer('INSERT INTO t (a, b) VALUES ', 1000000)
+        for sql, rows in buffer.add(batch.to_values()) + buffer.flush():
+            cursor.execute(sql)
+    """
+
+    def __init__(self, prefix, max_length, suffix=''):
+        """
+        :params prefix: INSERT INTO <table> (<columns>) VALUES
+        :params max_length: 语句的最大长度 (字符数)
+        :params suffix: 语句的后缀，例如 ON DUPLICATE KEY UPDATE ...
+        """
+        self.__prefix = prefix
+        self.__suffix = suffix
+        self.__max_length = max_length
+        self.__values = []
+        self.__length = len(prefix) + len(suffix)
+
+
+    def add(self, values):
+        """
+        加入 VALUES 项，返回已经拼满的语句 [(sql, 行数), ...]
+        """
+        statements = []
+        for value in values:
+            if len(self.__prefix) + len(self.__suffix) + len(value) > self.__max_length:
+                raise StatementTooLongError("a row of {} chars exceeds the max statement length {}".format(
+                    len(value), self.__max_length
+                ))
+            if len(self.__values) != 0 and self.__length + 2 + len(value) > self.__max_length:
+                statements.extend(self.flush())
+            self.__length += len(value) + (2 if len(self.__values) != 0 else 0)
+            self.__values.append(value)
+        return statements
+
+
+    def flush(self):
+        """
+        返回剩余的 VALUES 项拼成的语句 (没有时返回空列表)
+        """
+        if len(self.__values) == 0:
+            return []
+        statement = (self.__prefix + ', '.join(self.__values) + self.__suffix, len(self.__values))
+        self.__values = []
+        self.__length = len(self.__prefix) + len(self.__suffix)
+        return [statement]
@@ -0,0 +1,186 @@
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from columnar import ColumnBatch
+from metrics import TransferMetrics
+
+
+def quote_mysql_identifier(name):
+    """
+    `db`.`table` 形式的 mysql 标识符
+    """
+    return '.'.join('`{}`'.format(part.replace('`', '``')) for part in name.split('.'))
+
+
+def mysql_insert_statement(table, columns, upsert=False):
+    """
+    INSERT INTO <table> (<columns>) VALUES (%s, ...) 形式的语句，供 cursor.executemany 使用
+
+    :params upsert: 加上 ON DUPLICATE KEY UPDATE，主键或唯一键已存在的行更新为新值
+    """
+    identifiers = [quote_mysql_identifier(column) for column in columns]
+    # executemany 会对 VALUES 之前的部分做 % 格式化 (ON DUPLICATE KEY UPDATE 部分原样发送)，标识符中的 % 需要转义
+    statement = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote_mysql_identifier(table).replace('%', '%%'),
+        ', '.join(identifier.replace('%', '%%') for identifier in identifiers),
+        ', '.join(['%s'] * len(columns))
+    )
+    if upsert:
+        statement += ' ON DUPLICATE KEY UPDATE {}'.format(', '.join(
+            '{0} = VALUES({0})'.format(identifier) for identifier in identifiers
+        ))
+    return statement
+
+
+class MysqlExport:
+    """
+    把 presto 查询结果并行导出到 mysql 表
+
+    **Basic**
+
+    每个 split (--split-by 的一段范围) 由一个 mapper 线程执行，mapper 持有自己的 presto 连接与 mysql 连接:
+    以 fetchmany(batch_size) 分批读取 presto 结果，每批转为 ColumnBatch 后按列转换为语句参数，
+    通过 cursor.executemany 写入: pymysql 按连接的字符集与 sql_mode (例如 NO_BACKSLASH_ESCAPES) 转义参数，
+    并把一批拼成多行 INSERT ... VALUES (...), (...) (超过 max_statement_length 字节时拆成多条)，
+    每写入 commit_interval 行提交一次事务
+
+    任一 mapper 失败时其余 mapper 在当前批次结束后停止，取消 presto 查询并回滚未提交的事务，
+    已提交的行不会回滚
+
+    每个批次的读取、转换、写入耗时与写入的字节数记录在 metrics (TransferMetrics) 中
+
+    **Usage**
+
+        export = MysqlExport(connect_presto, connect_mysql, 'db.table', batch_size=1000, commit_interval=10000)
+        rows = export.run(['select ... where id < 100', 'select ... where id >= 100'], num_mappers=2)
+    """
+
+    def __init__(self, connect_presto, connect_mysql, table, batch_size=1000, commit_interval=10000,
+                 max_statement_length=1000000, upsert=False, logger=None, metrics=None):
+        """
+        :params connect_presto: 返回新 presto 连接的函数
+        :params connect_mysql: 返回新 mysql 连接 (autocommit 关闭) 的函数
+        :params table: mysql 目标表
+        :params batch_size: 每批读取与写入的行数
+        :params commit_interval: 每个事务写入的行数
+        :params max_statement_length: 每条多行 INSERT 语句的最大长度 (字节数，pymysql cursor 的 max_stmt_length)，
+                                      需要小于 mysql 的 max_allowed_packet
+        :params upsert: 主键或唯一键已存在的行更新为新值 (增量 lastmodified 模式)
+        :params logger: 输出每个 split 进度的 logger
+        :params metrics: 记录分阶段统计的 TransferMetrics，不指定时新建
+        """
+        self.__connect_presto = connect_presto
+        self.__connect_mysql = connect_mysql
+        self.__table = table
+        self.__batch_size = batch_size
+        self.__commit_interval = commit_interval
+        self.__max_statement_length = max_statement_length
+        self.__upsert = upsert
+        self.__logger = logger
+        self.metrics = metrics if metrics is not None else TransferMetrics()
+        self.__stopped = threading.Event()
+
+
+    def run(self, split_sqls, num_mappers):
+        """
+        执行所有 split，返回导出的总行数；有 split 失败时抛出第一个异常
+
+        :params split_sqls: 每个 split 的查询语句
+        :params num_mappers: 同时执行的 split 数
+        """
+        self.__stopped.clear()
+        with ThreadPoolExecutor(max_workers=num_mappers, thread_name_prefix='presqoop-mapper') as executor:
+            futures = [
+                executor.submit(self.export_split, index, len(split_sqls), sql)
+                for index, sql in enumerate(split_sqls, start=1)
+            ]
+
+            rows, error = 0, None
+            for future in futures:
+                try:
+                    rows += future.result()
+                except Exception as e:
+                    self.__stopped.set()
+                    error = error or e
+
+        if error is not None:
+            raise error
+        return rows
+
+
+    def export_split(self, index, total, sql):
+        """
+        导出一个 split，返回导出的行数
+        """
+        if self.__stopped.is_set():
+            return 0
+
+        start = time.time()
+        presto_connection = self.__connect_presto()
+        mysql_connection = self.__connect_mysql()
+        presto_cursor = presto_connection.cursor()
+        rows, uncommitted = 0, 0
+        try:
+            presto_cursor.execute(sql)
+            mysql_cursor = mysql_connection.cursor()
+            mysql_cursor.max_stmt_length = self.__max_statement_length
+            statement = None
+
+            while not self.__stopped.is_set():
+                with self.metrics.stage('fetch'):
+                    batch = presto_cursor.fetchmany(self.__batch_size)
+                self.metrics.add_batch(len(batch))
+                if len(batch) == 0:
+                    break
+
+                with self.metrics.stage('convert'):
+                    # presto 返回第一页数据后 description 才有列名与类型
+                    names = [column[0] for column in presto_cursor.description]
+                    if statement is None:
+                        statement = mysql_insert_statement(self.__table, names, self.__upsert)
+
+                    batch = ColumnBatch(names, [column[1] for column in presto_cursor.description], batch)
+                    parameters = batch.to_parameters()
+
+                with self.metrics.stage('write'):
+                    mysql_cursor.executemany(statement, parameters)
+                    # 实际发送的语句由 pymysql 拼接，字节数按参数值的字符串长度估算
+                    self.metrics.add_written(
+                        batch.size, sum(len(str(value)) for row in parameters for value in row if value is not None)
+                    )
+                    rows += batch.size
+                    uncommitted += batch.size
+                    if uncommitted >= self.__commit_interval:
+                        mysql_connection.commit()
+                        uncommitted = 0
+
+            if self.__stopped.is_set():
+                presto_cursor.cancel()
+                mysql_connection.rollback()
+                if self.__logger is not None:
+                    self.__logger.warning("split {}/{} stopped, {} uncommitted rows rolled back".format(
+                        index, total, uncommitted
+                    ))
+                return rows - uncommitted
+
+            with self.metrics.stage('write'):
+                mysql_connection.commit()
+        except Exception:
+            self.__stopped.set()
+            # 连接已断开时 rollback 也会失败，保留原来的异常
+            with contextlib.suppress(Exception):
+                mysql_connection.rollback()
+            raise
+        finally:
+            mysql_connection.close()
+            presto_connection.close()
+
+        self.metrics.add_split()
+
+        if self.__logger is not None:
+            elapsed = time.time() - start
+            self.__logger.info("split {}/{} exported {} rows in {:.1f}s ({:.0f} rows/s)".format(
+                index, total, rows, elapsed, rows / elapsed if elapsed > 0 else 0
+            ))
+        return rows
@@ -0,0 +1,278 @@
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from metrics import TransferMetrics
+from writers import create_writer, file_suffix
+
+
+# 导出完成后写入的清单文件
+MANIFEST_NAME = '_manifest.json'
+
+
+class ChecksumFile(io.RawIOBase):
+    """
+    写入磁盘的同时计算 sha256 与字节数，压缩与 parquet 的输出都经过它写入文件
+    """
+
+    def __init__(self, path):
+        self.__file = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.bytes = 0
+
+
+    def writable(self):
+        return True
+
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.bytes += len(data)
+        return self.__file.write(data)
+
+
+    def tell(self):
+        return self.bytes
+
+
+    def flush(self):
+        self.__file.flush()
+
+
+    def close(self):
+        if not self.closed:
+            # RawIOBase.close() 会先调用 flush()
+            super().close()
+            self.__file.close()
+
+
+class FileWriter:
+    """
+    按批次写入一个文件
+
+    **Basic**
+
+    序列化与压缩由 writers.py 的 RowWriter 完成，输出经过 ChecksumFile 写入磁盘，
+    用于按字节数轮转文件与生成清单
+    """
+
+    def __init__(self, path, file_format, compression, description):
+        """
+        :params path: 文件路径
+        :params file_format: csv, jsonl, parquet
+        :params compression: gzip, zstd, none (parquet 为列压缩方式)
+        :params description: presto cursor.description
+        """
+        self.path = path
+        self.rows = 0
+        self.__file = ChecksumFile(path)
+        self.__writer = create_writer(self.__file, file_format, compression, description)
+
+
+    @property
+    def bytes(self):
+        """
+        已写入磁盘的字节数 (压缩后)，压缩器缓冲中的数据不计入
+        """
+        return self.__file.bytes
+
+
+    def write(self, rows):
+        self.__writer.write(rows)
+        self.rows += len(rows)
+
+
+    def close(self):
+        """
+        关闭文件，返回清单中的一项
+        """
+        self.__writer.close()
+        self.__file.close()
+        return {
+            'path': os.path.basename(self.path),
+            'rows': self.rows,
+            'bytes': self.__file.bytes,
+            'sha256': self.__file.sha256.hexdigest(),
+        }
+
+
+class FileExport:
+    """
+    把 presto 查询结果并行导出为本地文件
+
+    **Basic**
+
+    每个 split 由一个 mapper 线程执行，以 fetchmany(batch_size) 分批读取并直接写入文件，内存占用只与批次大小有关；
+    文件超过 rotate_rows 行或 rotate_bytes 字节后换下一个文件，文件名为 part-<split>-<序号>.<format>[.gz|.zst]
+
+    全部 split 成功后在目录下写入 _manifest.json，记录每个文件的行数、字节数与 sha256；
+    没有 _manifest.json 的目录表示导出没有完成
+
+    读取与写入 (包括序列化与压缩) 的耗时记录在 metrics (TransferMetrics) 中，字节数为写入磁盘的大小
+
+    **Usage**
+
+        export = FileExport(connect_presto, '/data/orders', 'csv', 'gzip', rotate_rows=1000000)
+        rows = export.run(['select ... where id < 100', 'select ... where id >= 100'], num_mappers=2)
+    """
+
+    def __init__(self, connect_presto, target_dir, file_format='csv', compression='gzip', batch_size=1000,
+                 rotate_rows=0, rotate_bytes=0, logger=None, metrics=None):
+        """
+        :params connect_presto: 返回新 presto 连接的函数
+        :params target_dir: 输出目录
+        :params file_format: csv, jsonl, parquet
+        :params compression: gzip, zstd, none
+        :params batch_size: 每批读取的行数
+        :params rotate_rows: 每个文件的最大行数，0 为不限制
+        :params rotate_bytes: 每个文件写入磁盘的字节数达到该值后换下一个文件，0 为不限制
+        :params logger: 输出每个 split 进度的 logger
+        :params metrics: 记录分阶段统计的 TransferMetrics，不指定时新建
+        """
+        self.__connect_presto = connect_presto
+        self.__target_dir = target_dir
+        self.__format = file_format
+        self.__compression = compression
+        self.__batch_size = batch_size
+        self.__rotate_rows = rotate_rows
+        self.__rotate_bytes = rotate_bytes
+        self.__logger = logger
+        self.metrics = metrics if metrics is not None else TransferMetrics()
+        self.__stopped = threading.Event()
+
+
+    @staticmethod
+    def clear(target_dir):
+        """
+        删除目录中上一次导出的文件与清单
+        """
+        for name in os.listdir(target_dir):
+            if name == MANIFEST_NAME or name.startswith('part-'):
+                os.remove(os.path.join(target_dir, name))
+
+
+    def file_path(self, split_index, file_index):
+        return os.path.join(self.__target_dir, 'part-{:05d}-{:05d}{}'.format(
+            split_index, file_index, file_suffix(self.__format, self.__compression)
+        ))
+
+
+    def run(self, split_sqls, num_mappers, manifest=None):
+        """
+        执行所有 split 并写入清单，返回导出的总行数；有 split 失败时抛出第一个异常 (不写清单)
+
+        :params split_sqls: 每个 split 的查询语句
+        :params num_mappers: 同时执行的 split 数
+        :params manifest: 写入清单的其他信息，例如查询语句
+        """
+        os.makedirs(self.__target_dir, exist_ok=True)
+        self.__stopped.clear()
+        with ThreadPoolExecutor(max_workers=num_mappers, thread_name_prefix='presqoop-mapper') as executor:
+            futures = [
+                executor.submit(self.export_split, index, len(split_sqls), sql)
+                for index, sql in enumerate(split_sqls, start=1)
+            ]
+
+            files, error = [], None
+            for future in futures:
+                try:
+                    files.extend(future.result())
+                except Exception as e:
+                    self.__stopped.set()
+                    error = error or e
+
+        if error is not None:
+            raise error
+
+        rows = sum(file['rows'] for file in files)
+        self.write_manifest(dict(
+            manifest or {}, format=self.__format, compression=self.__compression, rows=rows, files=files,
+            created_at=time.strftime('%Y-%m-%d %H:%M:%S')
+        ))
+        return rows
+
+
+    def write_manifest(self, manifest):
+        """
+        先写临时文件再 rename，清单出现时内容一定是完整的
+        """
+        path = os.path.join(self.__target_dir, MANIFEST_NAME)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+    def export_split(self, index, total, sql):
+        """
+        导出一个 split，返回写入的文件的清单项
+        """
+        if self.__stopped.is_set():
+            return []
+
+        start = time.time()
+        presto_connection = self.__connect_presto()
+        presto_cursor = presto_connection.cursor()
+        files, writer = [], None
+        try:
+            presto_cursor.execute(sql)
+            while not self.__stopped.is_set():
+                with self.metrics.stage('fetch'):
+                    batch = presto_cursor.fetchmany(self.__batch_size)
+                self.metrics.add_batch(len(batch))
+                if len(batch) == 0:
+                    break
+
+                while len(batch) != 0:
+                    if writer is None:
+                        writer = FileWriter(
+                            self.file_path(index, len(files) + 1), self.__format, self.__compression,
+                            presto_cursor.description
+                        )
+                        written = 0
+                    # 按行数轮转时只写入当前文件剩余的行数
+                    size = len(batch) if self.__rotate_rows == 0 else min(len(batch), self.__rotate_rows - writer.rows)
+                    with self.metrics.stage('write'):
+                        writer.write(batch[:size])
+                        rotate = (
+                            (self.__rotate_rows != 0 and writer.rows >= self.__rotate_rows) or
+                            (self.__rotate_bytes != 0 and writer.bytes >= self.__rotate_bytes)
+                        )
+                        if rotate:
+                            files.append(writer.close())
+                    # 压缩器缓冲的数据在之后的批次或 close() 时才写入磁盘，计入当时的批次
+                    self.metrics.add_written(size, writer.bytes - written, 0)
+                    written = writer.bytes
+                    batch = batch[size:]
+                    if rotate:
+                        writer = None
+            else:
+                # 其他 split 失败，不写清单，已写的文件保留
+                presto_cursor.cancel()
+                return files
+
+            if writer is not None:
+                with self.metrics.stage('write'):
+                    files.append(writer.close())
+                self.metrics.add_written(0, writer.bytes - written, 0)
+                writer = None
+        except Exception:
+            self.__stopped.set()
+            raise
+        finally:
+            if writer is not None:
+                with contextlib.suppress(Exception):
+                    writer.close()
+            presto_connection.close()
+
+        self.metrics.add_split()
+        if self.__logger is not None:
+            rows = sum(file['rows'] for file in files)
+            elapsed = time.time() - start
+            self.__logger.info("split {}/{} exported {} rows to {} files in {:.1f}s ({:.0f} rows/s)".format(
+                index, total, rows, len(files), elapsed, rows / elapsed if elapsed > 0 else 0
+            ))
+        return files
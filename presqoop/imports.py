@@ -0,0 +1,162 @@
+import time
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import pymysql
+from literal import quote_presto_identifier
+from columnar import ColumnBatch, StatementBuffer
+from metrics import TransferMetrics
+
+
+class PrestoImportError(Exception):
+    pass
+
+
+class PrestoImport:
+    """
+    把 mysql 表并行导入到 presto 表
+
+    **Basic**
+
+    每个 split (主键或 --split-by 的一段范围) 由一个 mapper 线程执行，mapper 持有自己的 mysql 连接与 presto 连接:
+    以 SSCursor (服务端游标，结果不会整个读入内存) 按 fetchmany(batch_size) 流式读取 mysql，
+    每批转为 ColumnBatch 后按目标列的类型整列转换为 presto 字面量，拼成多行 INSERT INTO ... VALUES (...), (...)，
+    每条语句的长度不超过 max_statement_length (coordinator 的 query.max-length)
+
+    任一 mapper 失败时其余 mapper 在当前语句结束后停止；已执行的 INSERT 不会回滚，
+    需要整体生效时写入 staging 表后再替换目标表 (见 Presqoop.import_table)
+
+    每个批次的读取、转换、写入耗时与写入的字节数记录在 metrics (TransferMetrics) 中
+
+    **Usage**
+
+        load = PrestoImport(connect_mysql, connect_presto, 'ods.member', {'id': 'bigint', ...}, max_statement_length=1000000)
+        rows = load.run(['select ... where id < 100', 'select ... where id >= 100'], num_mappers=2)
+    """
+
+    def __init__(self, connect_mysql, connect_presto, table, column_types, batch_size=1000,
+                 max_statement_length=1000000, logger=None, metrics=None):
+        """
+        :params connect_mysql: 返回新 mysql 连接的函数
+        :params connect_presto: 返回新 presto 连接的函数
+        :params table: presto 目标表
+        :params column_types: 目标表的 {列名: presto 类型}，按 mysql 查询结果的列名对应
+        :params batch_size: 每次从 mysql 读取的行数
+        :params max_statement_length: 每条 INSERT 语句的最大长度 (字符数)
+        :params logger: 输出每个 split 进度的 logger
+        :params metrics: 记录分阶段统计的 TransferMetrics，不指定时新建
+        """
+        self.__connect_mysql = connect_mysql
+        self.__connect_presto = connect_presto
+        self.__table = table
+        self.__column_types = {column.lower(): presto_type for column, presto_type in column_types.items()}
+        self.__batch_size = batch_size
+        self.__max_statement_length = max_statement_length
+        self.__logger = logger
+        self.metrics = metrics if metrics is not None else TransferMetrics()
+        self.__stopped = threading.Event()
+
+
+    def run(self, split_sqls, num_mappers):
+        """
+        执行所有 split，返回导入的总行数；有 split 失败时抛出第一个异常
+
+        :params split_sqls: 每个 split 的 mysql 查询语句
+        :params num_mappers: 同时执行的 split 数
+        """
+        self.__stopped.clear()
+        with ThreadPoolExecutor(max_workers=num_mappers, thread_name_prefix='presqoop-mapper') as executor:
+            futures = [
+                executor.submit(self.import_split, index, len(split_sqls), sql)
+                for index, sql in enumerate(split_sqls, start=1)
+            ]
+
+            rows, error = 0, None
+            for future in futures:
+                try:
+                    rows += future.result()
+                except Exception as e:
+                    self.__stopped.set()
+                    error = error or e
+
+        if error is not None:
+            raise error
+        return rows
+
+
+    def get_insert_buffer(self, columns):
+        """
+        INSERT INTO <table> (<columns>) VALUES 的 StatementBuffer 以及每列的 presto 类型
+        """
+        missing = [column for column in columns if column.lower() not in self.__column_types]
+        if len(missing) != 0:
+            raise PrestoImportError("columns {} do not exist in presto table {}".format(missing, self.__table))
+
+        prefix = 'INSERT INTO {} ({}) VALUES '.format(
+            self.__table, ', '.join(quote_presto_identifier(column) for column in columns)
+        )
+        presto_types = [self.__column_types[column.lower()] for column in columns]
+        return StatementBuffer(prefix, self.__max_statement_length), presto_types
+
+
+    def import_split(self, index, total, sql):
+        """
+        导入一个 split，返回导入的行数
+        """
+        if self.__stopped.is_set():
+            return 0
+
+        start = time.time()
+        mysql_connection = self.__connect_mysql()
+        presto_connection = self.__connect_presto()
+        presto_cursor = presto_connection.cursor()
+        rows, statements_count = 0, 0
+        try:
+            mysql_cursor = mysql_connection.cursor(pymysql.cursors.SSCursor)
+            mysql_cursor.execute(sql)
+            names = [column[0] for column in mysql_cursor.description]
+            buffer, presto_types = self.get_insert_buffer(names)
+
+            while not self.__stopped.is_set():
+                with self.metrics.stage('fetch'):
+                    batch = mysql_cursor.fetchmany(self.__batch_size)
+                self.metrics.add_batch(len(batch))
+
+                with self.metrics.stage('convert'):
+                    statements = buffer.add(ColumnBatch(names, presto_types, batch).to_values())
+                    if len(batch) == 0:
+                        statements += buffer.flush()
+
+                with self.metrics.stage('write'):
+                    for statement, statement_rows in statements:
+                        self.__insert(presto_cursor, statement)
+                        rows, statements_count = rows + statement_rows, statements_count + 1
+                        self.metrics.add_written(statement_rows, len(statement.encode('utf-8')))
+                if len(batch) == 0:
+                    break
+            else:
+                if self.__logger is not None:
+                    self.__logger.warning("split {}/{} stopped after {} rows".format(index, total, rows))
+                return rows
+        except Exception:
+            self.__stopped.set()
+            raise
+        finally:
+            # 停止时 SSCursor 还有未读取的结果，直接关闭连接而不读完剩余的行
+            with contextlib.suppress(Exception):
+                mysql_connection.close()
+            presto_connection.close()
+
+        self.metrics.add_split()
+        if self.__logger is not None:
+            elapsed = time.time() - start
+            self.__logger.info("split {}/{} imported {} rows with {} statements in {:.1f}s ({:.0f} rows/s)".format(
+                index, total, rows, statements_count, elapsed, rows / elapsed if elapsed > 0 else 0
+            ))
+        return rows
+
+
+    def __insert(self, presto_cursor, sql):
+        presto_cursor.execute(sql)
+        # 读完结果 (写入的行数) 才表示 INSERT 执行结束
+        presto_cursor.fetchall()
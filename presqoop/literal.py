@@ -0,0 +1,38 @@
+import re
+import math
+import datetime
+
+
+def presto_base_type(presto_type):
+    """
+    去掉类型参数的 presto 类型名: decimal(10,2) -> decimal, varchar(20) -> varchar
+    """
+    return re.sub(r'\(.*\)', '', presto_type).strip().lower()
+
+
+def quote_string(value):
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def quote_presto_identifier(name):
+    """
+    "schema"."table" 形式的 presto 标识符
+    """
+    return '.'.join('"{}"'.format(part.replace('"', '""')) for part in name.split('.'))
+
+
+def double_literal(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'nan()'
+    if math.isinf(value):
+        return 'infinity()' if value > 0 else '-infinity()'
+    return 'DOUBLE {}'.format(quote_string(repr(value)))
+
+
+def time_literal(value):
+    # mysql 的 TIME 列返回 timedelta
+    if isinstance(value, datetime.timedelta):
+        seconds = int(value.total_seconds())
+        value = '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+    return 'TIME {}'.format(quote_string(value))
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+
+class TransferMetrics:
+    """
+    一次传输的分阶段统计
+
+    **Basic**
+
+    mapper 线程把每个批次的处理分为三个阶段计时:
+
+    - fetch: 从数据源读取一批 (presto / mysql 的 fetchmany)
+    - convert: 转换为 sql 字面量并拼接语句 (ColumnBatch, StatementBuffer)，导出到 mysql 时为转换为语句参数
+    - write: 写入目标 (执行 INSERT 与 commit，导出为文件时包括序列化与压缩)
+
+    阶段耗时是所有 mapper 的累加 (线程秒)，各阶段的占比说明瓶颈在哪一侧；
+    rows/s、bytes/s 按墙钟时间计算，bytes 为写入目标的字节数 (INSERT 语句的 utf-8 长度，或写入磁盘的文件大小；
+    导出到 mysql 时语句由 pymysql 的 executemany 拼接，按参数值的字符串长度估算)
+
+    **Usage**
+
+        metrics = TransferMetrics()
+        with metrics.stage('fetch'):
+            batch = cursor.fetchmany(1000)
+        metrics.add_batch(len(batch))
+        ...
+        metrics.add_written(rows, len(statement.encode('utf-8')))
+        print(metrics.summary())
+    """
+
+    STAGES = ('fetch', 'convert', 'write')
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start = time.perf_counter()
+        self.__end = None
+        self.__seconds = dict.fromkeys(TransferMetrics.STAGES, 0.0)
+        self.__calls = dict.fromkeys(TransferMetrics.STAGES, 0)
+        self.__batches = 0
+        self.__batch_rows = 0
+        self.__batch_min = None
+        self.__batch_max = 0
+        self.__statements = 0
+        self.__rows = 0
+        self.__bytes = 0
+        self.__splits = 0
+        self.__reporter = None
+        self.__reporter_stopped = threading.Event()
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        统计 with 块的耗时，计入 name 阶段
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.__lock:
+                self.__seconds[name] += seconds
+                self.__calls[name] += 1
+
+
+    def add_batch(self, rows):
+        """
+        记录一次读取的批次大小，空批次 (读取结束) 不计入
+        """
+        if rows == 0:
+            return
+        with self.__lock:
+            self.__batches += 1
+            self.__batch_rows += rows
+            self.__batch_min = rows if self.__batch_min is None else min(self.__batch_min, rows)
+            self.__batch_max = max(self.__batch_max, rows)
+
+
+    def add_written(self, rows, bytes_count, statements=1):
+        """
+        记录写入目标的行数与字节数
+
+        :params statements: 写入的语句数 (导出为文件时为 0，导出到 mysql 时为 executemany 的调用数)
+        """
+        with self.__lock:
+            self.__rows += rows
+            self.__bytes += bytes_count
+            self.__statements += statements
+
+
+    def add_split(self):
+        """
+        记录一个完成的 split
+        """
+        with self.__lock:
+            self.__splits += 1
+
+
+    def finish(self):
+        """
+        停止计时，之后的 summary() 使用固定的墙钟时间
+        """
+        self.stop_reporting()
+        with self.__lock:
+            if self.__end is None:
+                self.__end = time.perf_counter()
+
+
+    def summary(self):
+        """
+        统计摘要 (可以 json 序列化)
+        """
+        with self.__lock:
+            elapsed = (self.__end or time.perf_counter()) - self.__start
+            busy = sum(self.__seconds.values())
+            return {
+                'elapsed_seconds': round(elapsed, 3),
+                'rows': self.__rows,
+                'bytes': self.__bytes,
+                'rows_per_sec': round(self.__rows / elapsed, 1) if elapsed > 0 else None,
+                'bytes_per_sec': round(self.__bytes / elapsed, 1) if elapsed > 0 else None,
+                'splits': self.__splits,
+                'statements': self.__statements,
+                'batches': {
+                    'count': self.__batches,
+                    'min_rows': self.__batch_min,
+                    'max_rows': self.__batch_max,
+                    'avg_rows': round(self.__batch_rows / self.__batches, 1) if self.__batches != 0 else None,
+                },
+                'stages': {
+                    name: {
+                        'seconds': round(self.__seconds[name], 3),
+                        'calls': self.__calls[name],
+                        'share': round(self.__seconds[name] / busy, 3) if busy > 0 else None,
+                    }
+                    for name in TransferMetrics.STAGES
+                },
+            }
+
+
+    def progress(self):
+        """
+        日志中输出的进度
+        """
+        summary = self.summary()
+        return "{} rows in {:.1f}s ({:.0f} rows/s, {:.2f} MB/s), {} splits done, stages: {}".format(
+            summary['rows'], summary['elapsed_seconds'], summary['rows_per_sec'] or 0,
+            (summary['bytes_per_sec'] or 0) / 1024 / 1024, summary['splits'],
+            ' '.join(
+                '{}={:.1f}s'.format(name, stage['seconds']) + (' ({:.0%})'.format(stage['share']) if stage['share'] else '')
+                for name, stage in summary['stages'].items()
+            )
+        )
+
+
+    def start_reporting(self, interval, logger):
+        """
+        在后台线程中每隔 interval 秒输出一次进度
+
+        :params interval: 间隔 (秒)，不大于 0 时不输出
+        :params logger: 输出进度的 logger
+        """
+        if interval <= 0 or self.__reporter is not None:
+            return
+
+        def report():
+            while not self.__reporter_stopped.wait(interval):
+                logger.info("progress: " + self.progress())
+
+        self.__reporter_stopped.clear()
+        self.__reporter = threading.Thread(target=report, name='presqoop-metrics', daemon=True)
+        self.__reporter.start()
+
+
+    def stop_reporting(self):
+        if self.__reporter is not None:
+            self.__reporter_stopped.set()
+            self.__reporter.join()
+            self.__reporter = None
+
+
+    def write(self, path, **extra):
+        """
+        把摘要写入 json 文件，先写临时文件再 rename
+
+        :params extra: 一起写入的其他信息，例如传输的类型与目标
+        """
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(dict(extra, **self.summary()), file, ensure_ascii=False, indent=2)
+        os.replace(path + '.tmp', path)
@@ -1,10 +1,27 @@
 import sys
+import time
 import argparse
 import logging
+import coloredlogs
 import prestodb
 import pymysql
 import requests
+import os
 import json
+import hashlib
+from split import split_type, value_split_type, split_conditions, SplitError
+from export import MysqlExport, quote_mysql_identifier
+from files import FileExport, MANIFEST_NAME
+from writers import FILE_FORMATS, FILE_COMPRESSIONS
+from imports import PrestoImport
+from columnar import presto_literal_formatter
+from state import WatermarkStore
+from metrics import TransferMetrics
+
+
+# Create a logger object.
+logger = logging.getLogger('presqoop')
+coloredlogs.install(level='INFO', logger=logger)
 
 
 class Presqoop():
@@ -12,9 +29,29 @@ class Presqoop():
     A Sqoop like tools to import/export datas by using presto
 
     **Basic**
-    
+
     基于 presto 做的数据导入/导出脚本，功能仿照 sqoop 设计，尽量实现 sqoop 的功能
 
+    - export: 把 presto 表 (--table) 或查询 (--query) 导出到 mysql 表 (--mysql-table)，
+      按 --split-by 列的 min/max 切分为 --num-mappers 段并行导出；指定 --target-dir 时导出为本地文件
+    - import: 把 mysql 表 (--mysql-table) 导入到 presto 表 (--table)，
+      按主键 (或 --split-by 列) 的范围切分为 --num-mappers 段并行导入，可以先写入 --staging-table 再替换目标表
+    - --incremental append|lastmodified: 与 sqoop 相同，只传输 --check-column 超过上一次 watermark 的行，
+      watermark 按 job 保存在本地 (--state.path)，传输成功后才更新
+      (import 只支持 append)
+
+    **Usage**
+
+        python3 presqoop.py export \\
+            --presto-host 10.10.22.5 --presto-port 10300 --presto-user dev \\
+            --presto-catalog dev_hive --presto-schema ods_test \\
+            --mysql-host 10.10.22.6 --mysql-user etl --mysql-password *** --mysql-database report \\
+            --table orders --split-by id --num-mappers 4
+
+        python3 presqoop.py import \\
+            ... \\
+            --mysql-table member --table ods_test.member --staging-table ods_test.member_staging
+
     .. version v1.0
     """
 
@@ -25,9 +62,21 @@ class Presqoop():
         '--presto-user': 'presto_user',
         '--presto-catalog': 'presto_catalog',
         '--presto-schema': 'presto_schema',
-        '--table': 'table'
     }
 
+    # mysql 的连接参数，导出到文件 (--target-dir) 时不需要
+    MYSQL_ARGS = {
+        '--mysql-host': 'mysql_host',
+        '--mysql-user': 'mysql_user',
+        '--mysql-database': 'mysql_database',
+    }
+
+    # 增量传输 watermark 的默认存储路径
+    DEFAULT_STATE_PATH = '~/.presqoop/state.db'
+
+    # 支持的 execute_type
+    EXECUTE_TYPES = ('export', 'import')
+
 
     def __init__(self):
         """
@@ -36,31 +85,144 @@ class Presqoop():
         """
         self.__args = self.__set_args()
         self.__check_args()
-        
+        self.__set_log_path()
+
 
     def __set_args(self):
         """
         设置参数选项
         """
-        parser = argparse.ArgumentParser()
+        parser = argparse.ArgumentParser(prog="python3 presqoop.py")
 
-        parser.add_argument('execute_type')
+        parser.add_argument('execute_type', choices=Presqoop.EXECUTE_TYPES)
 
         # set connection arguments
-        parser.add_argument('--presto-host', action='store', dest='presto_port',type=str, help="set presto port")
-        parser.add_argument('--presto-port', action='store', dest='presto_port',type=int, help="set presto port")
+        parser.add_argument('--presto-host', action='store', dest='presto_host', type=str, help="set presto host")
+        parser.add_argument('--presto-port', action='store', dest='presto_port', type=int, help="set presto port")
         parser.add_argument('--presto-user', action='store', dest='presto_user', type=str, help="set presto user")
         parser.add_argument(
             '--presto-catalog', action='store', dest='presto_catalog', type=str, help="set presto catalog"
         )
         parser.add_argument('--presto-schema', action='store', dest='presto_schema', type=str, help="set presto schema")
-        parser.add_argument('--tabel', action='store', nargs='*', dest='table', type=str, help="set table names")
+        parser.add_argument('--mysql-host', action='store', dest='mysql_host', type=str, help="set mysql host")
+        parser.add_argument(
+            '--mysql-port', action='store', dest='mysql_port', type=int, default=3306,
+            help="set mysql port. (default: 3306)"
+        )
+        parser.add_argument('--mysql-user', action='store', dest='mysql_user', type=str, help="set mysql user")
+        parser.add_argument(
+            '--mysql-password', action='store', dest='mysql_password', type=str, default='', help="set mysql password"
+        )
+        parser.add_argument(
+            '--mysql-database', action='store', dest='mysql_database', type=str, help="set mysql database"
+        )
+
+        # set transfer arguments
+        parser.add_argument(
+            '--table', action='store', dest='table', type=str,
+            help="set the presto table, the source of export or the target of import"
+        )
+        parser.add_argument(
+            '--query', action='store', dest='query', type=str,
+            help="export the result of this presto query instead of --table"
+        )
+        parser.add_argument(
+            '--mysql-table', action='store', dest='mysql_table', type=str,
+            help="set the mysql table, the target of export or the source of import. the columns are matched by name. (default for export: the name of --table)"
+        )
+        parser.add_argument(
+            '--columns', action='store', dest='columns', type=str,
+            help="set the comma separated columns of the source table to transfer. (default: all columns)"
+        )
+        parser.add_argument(
+            '--where', action='store', dest='where', type=str, help="set the filter condition of the source table"
+        )
+        parser.add_argument(
+            '--split-by', action='store', dest='split_by', type=str,
+            help="set the integral, decimal, double or date column used to split the rows between mappers. (default for import: the primary key of --mysql-table)"
+        )
+        parser.add_argument(
+            '-m', '--num-mappers', action='store', dest='num_mappers', type=int, default=4,
+            help="set the number of splits transferred in parallel, each mapper uses its own presto and mysql connection. (export without --split-by uses one mapper, default: 4)"
+        )
+        parser.add_argument(
+            '--batch-size', action='store', dest='batch_size', type=int, default=1000,
+            help="set the number of rows fetched from the source and converted column by column per batch. (default: 1000)"
+        )
+        parser.add_argument(
+            '--commit-interval', action='store', dest='commit_interval', type=int, default=10000,
+            help="set the number of rows written per mysql transaction on export. (default: 10000)"
+        )
+        parser.add_argument(
+            '--max-statement-length', action='store', dest='max_statement_length', type=int, default=1000000,
+            help="set the max length of one multi-row INSERT ... VALUES statement (characters on import, bytes of the statements built by pymysql executemany on export), keep it under the query.max-length of the coordinator on import and the max_allowed_packet of mysql on export. (default: 1000000)"
+        )
+        parser.add_argument(
+            '--staging-table', action='store', dest='staging_table', type=str,
+            help="import into this presto table (recreated like --table) first, then replace --table with it by renaming, so --table is never partially loaded"
+        )
+
+        # set file export arguments
+        parser.add_argument(
+            '--target-dir', action='store', dest='target_dir', type=str,
+            help="export to files under this local directory instead of mysql, a _manifest.json with the rows and sha256 of every file is written when the export succeeds"
+        )
+        parser.add_argument(
+            '--delete-target-dir', action='store_true', dest='delete_target_dir', default=False,
+            help="delete the files of the previous export in --target-dir first"
+        )
+        parser.add_argument(
+            '--file-format', action='store', dest='file_format', choices=FILE_FORMATS, default='csv',
+            help="set the file format of --target-dir. (parquet requires pyarrow, default: csv)"
+        )
+        parser.add_argument(
+            '--compression', action='store', dest='compression', choices=FILE_COMPRESSIONS, default='gzip',
+            help="set the file compression of --target-dir, for parquet the column compression. (zstd requires zstandard, default: gzip)"
+        )
+        parser.add_argument(
+            '--rotate-rows', action='store', dest='rotate_rows', type=int, default=0,
+            help="start a new file after this many rows. (default: 0, no limit)"
+        )
+        parser.add_argument(
+            '--rotate-size', action='store', dest='rotate_size', type=int, default=0,
+            help="start a new file after this many MB are written to disk. (default: 0, no limit)"
+        )
+
+        # set incremental arguments
+        parser.add_argument(
+            '--incremental', action='store', dest='incremental', choices=['append', 'lastmodified'],
+            help="only transfer the rows whose --check-column is beyond the watermark of the last successful run. (append: for an increasing id, rows > watermark; lastmodified: for a last modified timestamp, rows >= watermark, export upserts them into mysql, not supported by import)"
+        )
+        parser.add_argument(
+            '--check-column', action='store', dest='check_column', type=str,
+            help="set the column compared with the watermark on --incremental"
+        )
+        parser.add_argument(
+            '--last-value', action='store', dest='last_value', type=str,
+            help="set the watermark of the first --incremental run, ignored once the job has a saved watermark"
+        )
+        parser.add_argument(
+            '--job-id', action='store', dest='job_id', type=str,
+            help="set the job identity of the saved watermark. (default: a hash of the presto, mysql, table and check column arguments)"
+        )
+        parser.add_argument(
+            '--state-path', action='store', dest='state_path', type=str, default=Presqoop.DEFAULT_STATE_PATH,
+            help="save the watermarks in this sqlite file. (default: {})".format(Presqoop.DEFAULT_STATE_PATH)
+        )
 
         # set log arguments
         parser.add_argument('--log-path', action='store', dest='log_path', type=str, help="set log path")
+        parser.add_argument(
+            '--progress-interval', action='store', dest='progress_interval', type=float, default=10,
+            help="log the rows/s, bytes/s and fetch/convert/write time every this many seconds, 0 to disable. (default: 10)"
+        )
+        parser.add_argument(
+            '--metrics-path', action='store', dest='metrics_path', type=str,
+            help="write the final transfer metrics (rows, bytes, batch sizes and per-stage time) to this json file"
+        )
 
         # set config arguments
-        parser.add_argument('-l', '--list', action='store_true', dest='config_list', defalut=False, help="list config")
+        parser.add_argument('-l', '--list', action='store_true', dest='config_list', default=False, help="list config")
         parser.add_argument('--presto', action='store', dest='config_presto', type=str, help="set presto config name")
         parser.add_argument('--log', action='store', dest='config_log', type=str, help="set log config name")
 
@@ -79,13 +241,103 @@ class Presqoop():
         参数检查
         """
         # check necesary arguments
-        for necessary_arg in SqlFlowExecutor.NECESSARY_ARGS.values():
+        for necessary_arg in Presqoop.NECESSARY_ARGS.values():
             if self.__args_dict[necessary_arg] is None:
-                logging.error(
-                    "Please provide all necessary arguments: {}".format(SqlFlowExecutor.NECESSARY_ARGS.keys())
+                logger.error(
+                    "Please provide all necessary arguments: {}".format(list(Presqoop.NECESSARY_ARGS.keys()))
                 )
                 sys.exit(1)
 
+        file_export = self.__args.execute_type == 'export' and self.__args.target_dir is not None
+        if not file_export:
+            for necessary_arg in Presqoop.MYSQL_ARGS.values():
+                if self.__args_dict[necessary_arg] is None:
+                    logger.error("Please provide all mysql arguments: {}".format(list(Presqoop.MYSQL_ARGS.keys())))
+                    sys.exit(1)
+
+        if self.__args.execute_type == 'export':
+            if (self.__args.table is None) == (self.__args.query is None):
+                logger.error("Please provide either --table or --query")
+                sys.exit(1)
+
+            if self.__args.query is not None and (self.__args.columns is not None or self.__args.where is not None):
+                logger.error("--columns and --where can only be used with --table, filter in --query instead")
+                sys.exit(1)
+
+            if self.__args.query is not None and self.__args.mysql_table is None and not file_export:
+                logger.error("Please provide --mysql-table when exporting a --query")
+                sys.exit(1)
+
+            if self.__args.staging_table is not None:
+                logger.error("--staging-table can only be used with import")
+                sys.exit(1)
+
+        if file_export and self.__args.delete_target_dir is False and os.path.isdir(self.__args.target_dir):
+            if any(name == MANIFEST_NAME or name.startswith('part-') for name in os.listdir(self.__args.target_dir)):
+                logger.error("{} already has exported files, use --delete-target-dir to replace them".format(
+                    self.__args.target_dir
+                ))
+                sys.exit(1)
+
+        if self.__args.execute_type == 'import':
+            if self.__args.target_dir is not None:
+                logger.error("--target-dir can only be used with export")
+                sys.exit(1)
+
+            if self.__args.mysql_table is None or self.__args.table is None:
+                logger.error("Please provide --mysql-table and --table to import")
+                sys.exit(1)
+
+            if self.__args.query is not None:
+                logger.error("--query can only be used with export, use --columns and --where instead")
+                sys.exit(1)
+
+            if self.__args.staging_table is not None and self.__args.staging_table == self.__args.table:
+                logger.error("--staging-table must be different from --table")
+                sys.exit(1)
+
+        if self.__args.incremental is not None:
+            if self.__args.check_column is None:
+                logger.error("Please provide --check-column with --incremental")
+                sys.exit(1)
+
+            if self.__args.staging_table is not None:
+                logger.error("--staging-table replaces the whole table and can not be used with --incremental")
+                sys.exit(1)
+
+            # import 到 presto 只能追加，lastmodified 每次都会重复写入与 watermark 同一时刻修改的行
+            if self.__args.execute_type == 'import' and self.__args.incremental == 'lastmodified':
+                logger.error("--incremental lastmodified can not be used with import, presto tables can only be appended")
+                sys.exit(1)
+        elif self.__args.check_column is not None or self.__args.last_value is not None:
+            logger.error("--check-column and --last-value can only be used with --incremental")
+            sys.exit(1)
+
+        for option, value in (
+            ('--num-mappers', self.__args.num_mappers),
+            ('--batch-size', self.__args.batch_size),
+            ('--commit-interval', self.__args.commit_interval),
+            ('--max-statement-length', self.__args.max_statement_length),
+        ):
+            if value < 1:
+                logger.error("{} must be a positive integer, got: {}".format(option, value))
+                sys.exit(1)
+
+        for option, value in (('--rotate-rows', self.__args.rotate_rows), ('--rotate-size', self.__args.rotate_size)):
+            if value < 0:
+                logger.error("{} must not be negative, got: {}".format(option, value))
+                sys.exit(1)
+
+
+    def __set_log_path(self):
+        """
+        指定 --log-path 时日志同时写入文件
+        """
+        if self.__args.log_path is not None:
+            handler = logging.FileHandler(self.__args.log_path)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s'))
+            logger.addHandler(handler)
+
 
     def __set_session(self):
         """
@@ -101,7 +353,7 @@ class Presqoop():
 
     def __get_presto_connection(self):
         return prestodb.dbapi.connect(
-            host=self.__args.preto_host,
+            host=self.__args.presto_host,
             port=self.__args.presto_port,
             user=self.__args.presto_user,
             catalog=self.__args.presto_catalog,
@@ -109,6 +361,421 @@ class Presqoop():
         )
 
 
-    # TODO: 2018-07-13
-    # 对各种数据源与 presto 支持的 DATATYPE 进行调研，
-    # 考察相互导入导出的类型转换问题，再进行功能函数的编写
+    def __get_mysql_connection(self):
+        return pymysql.connect(
+            host=self.__args.mysql_host,
+            port=self.__args.mysql_port,
+            user=self.__args.mysql_user,
+            password=self.__args.mysql_password,
+            database=self.__args.mysql_database,
+            charset='utf8mb4',
+            autocommit=False,
+        )
+
+
+    def get_source_sql(self):
+        """
+        导出的 presto 查询: --query，或由 --table、--columns、--where 拼接
+        """
+        if self.__args.query is not None:
+            return self.__args.query.strip().rstrip(';')
+
+        sql = 'SELECT {} FROM {}'.format(self.__args.columns or '*', self.__args.table)
+        if self.__args.where is not None:
+            sql += ' WHERE {}'.format(self.__args.where)
+        return sql
+
+
+    def get_job_id(self):
+        """
+        保存 watermark 的 job 标识，默认由连接、表与 check column 参数计算
+        """
+        if self.__args.job_id is not None:
+            return self.__args.job_id
+
+        identity = json.dumps([
+            self.__args.execute_type, self.__args.presto_host, self.__args.presto_port, self.__args.presto_catalog,
+            self.__args.presto_schema, self.__args.table, self.__args.query, self.__args.mysql_host,
+            self.__args.mysql_port, self.__args.mysql_database, self.__args.mysql_table, self.__args.check_column,
+        ])
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:16]
+
+
+    def get_last_value(self):
+        """
+        上一次成功传输保存的 watermark，没有时使用 --last-value (可以为 None，即传输全部行)
+        """
+        store = WatermarkStore(self.__args.state_path)
+        try:
+            saved = store.get(self.get_job_id())
+        finally:
+            store.close()
+
+        if saved is None:
+            return self.__args.last_value
+        check_column, last_value = saved
+        if check_column != self.__args.check_column:
+            logger.warning("the saved watermark of job {} is for --check-column {}, ignored".format(
+                self.get_job_id(), check_column
+            ))
+            return self.__args.last_value
+        return last_value
+
+
+    def get_incremental_condition(self, column, last_value, upper_value):
+        """
+        增量条件，与 sqoop 相同:
+
+        - append: column > last_value AND column <= upper_value
+        - lastmodified: column >= last_value AND column <= upper_value，
+          与 watermark 相同时间修改的行会被再传输一次 (导出时 upsert)，但不会漏掉
+
+        upper_value 为开始传输前 check column 的最大值，传输过程中新增的行留到下一次
+        """
+        condition = '{} <= {}'.format(column, upper_value)
+        if last_value is not None:
+            operator = '>' if self.__args.incremental == 'append' else '>='
+            condition = '{} {} {} AND {}'.format(column, operator, last_value, condition)
+        return condition
+
+
+    def get_incremental_sql(self, source_sql):
+        """
+        在 presto 查询上加上增量条件，返回 (sql, 新 watermark)
+        """
+        column = self.__args.check_column
+        presto_connection = self.__get_presto_connection()
+        try:
+            cursor = presto_connection.cursor()
+            cursor.execute('SELECT max({}) FROM ({}) presqoop_source'.format(column, source_sql))
+            upper_value = cursor.fetchone()[0]
+            formatter = presto_literal_formatter(cursor.description[0][1])
+        finally:
+            presto_connection.close()
+
+        return self.__incremental_sql(source_sql, column, formatter, upper_value)
+
+
+    def __incremental_sql(self, source_sql, column, formatter, upper_value):
+        last_value = self.get_last_value()
+        logger.info("incremental {} on {}: last value {}, upper value {}".format(
+            self.__args.incremental, self.__args.check_column, last_value, upper_value
+        ))
+        if upper_value is None:
+            # 源表为空或 check column 全为 NULL
+            return '{} WHERE 1 = 0'.format(source_sql), None
+
+        condition = self.get_incremental_condition(
+            column, None if last_value is None else formatter(last_value), formatter(upper_value)
+        )
+        return 'SELECT * FROM ({}) presqoop_source WHERE {}'.format(source_sql, condition), upper_value
+
+
+    def save_watermark(self, watermark, rows):
+        """
+        传输成功后保存新的 watermark；没有传输任何行时不更新，避免源表重建后 watermark 倒退
+        """
+        if watermark is None or rows == 0:
+            return
+
+        store = WatermarkStore(self.__args.state_path)
+        try:
+            store.set(self.get_job_id(), self.__args.check_column, watermark)
+        finally:
+            store.close()
+        logger.info("saved watermark {} = {} for job {}".format(self.__args.check_column, watermark, self.get_job_id()))
+
+
+    def get_split_sqls(self, source_sql):
+        """
+        按 --split-by 列的 min/max 切分查询，每个 mapper 执行其中一段
+
+        **Basic**
+
+        先执行 SELECT min(<split-by>), max(<split-by>) 得到范围，再按 split.split_conditions() 均分，
+        每段为 SELECT * FROM (<source>) WHERE <range>；没有 --split-by 或 --num-mappers 为 1 时只有一段
+        """
+        if self.__args.split_by is None or self.__args.num_mappers == 1:
+            if self.__args.num_mappers > 1:
+                logger.info("--split-by is not provided, export with one mapper")
+            return [source_sql]
+
+        presto_connection = self.__get_presto_connection()
+        try:
+            cursor = presto_connection.cursor()
+            cursor.execute('SELECT min({column}), max({column}) FROM ({sql}) presqoop_source'.format(
+                column=self.__args.split_by, sql=source_sql
+            ))
+            low, high = cursor.fetchone()
+            kind = split_type(cursor.description[0][1])
+        finally:
+            presto_connection.close()
+
+        conditions = split_conditions(self.__args.split_by, low, high, self.__args.num_mappers, kind)
+        logger.info("split {} by {} in [{}, {}]: {} splits".format(
+            self.__args.table or 'query', self.__args.split_by, low, high, len(conditions)
+        ))
+        return ['SELECT * FROM ({}) presqoop_source WHERE {}'.format(source_sql, condition) for condition in conditions]
+
+
+    def export(self):
+        """
+        导出到 mysql 或本地文件 (--target-dir)
+        """
+        start = time.time()
+        if self.__args.target_dir is not None:
+            target = self.__args.target_dir
+        else:
+            target = self.__args.mysql_table or self.__args.table.split('.')[-1]
+
+        try:
+            source_sql, watermark = self.get_source_sql(), None
+            if self.__args.incremental is not None:
+                source_sql, watermark = self.get_incremental_sql(source_sql)
+
+            split_sqls = self.get_split_sqls(source_sql)
+            num_mappers = min(self.__args.num_mappers, len(split_sqls))
+            metrics = self.start_metrics()
+            if self.__args.target_dir is not None:
+                rows = self.export_files(source_sql, split_sqls, num_mappers, metrics)
+            else:
+                export = MysqlExport(
+                    self.__get_presto_connection, self.__get_mysql_connection, target,
+                    batch_size=self.__args.batch_size, commit_interval=self.__args.commit_interval,
+                    max_statement_length=self.__args.max_statement_length,
+                    upsert=self.__args.incremental == 'lastmodified', logger=logger, metrics=metrics
+                )
+                rows = export.run(split_sqls, num_mappers)
+            self.report_metrics(metrics, target, num_mappers)
+            self.save_watermark(watermark, rows)
+        except Exception as e:
+            logger.error("export to {} failed: {}".format(target, e))
+            sys.exit(1)
+
+        elapsed = time.time() - start
+        logger.info("exported {} rows to {} in {:.1f}s ({:.0f} rows/s)".format(
+            rows, target, elapsed, rows / elapsed if elapsed > 0 else 0
+        ))
+
+
+    def export_files(self, source_sql, split_sqls, num_mappers, metrics=None):
+        """
+        导出到 --target-dir 下的文件
+        """
+        if self.__args.delete_target_dir and os.path.isdir(self.__args.target_dir):
+            FileExport.clear(self.__args.target_dir)
+
+        export = FileExport(
+            self.__get_presto_connection, self.__args.target_dir, self.__args.file_format, self.__args.compression,
+            batch_size=self.__args.batch_size, rotate_rows=self.__args.rotate_rows,
+            rotate_bytes=self.__args.rotate_size * 1024 * 1024, logger=logger, metrics=metrics
+        )
+        return export.run(split_sqls, num_mappers, manifest={'query': source_sql})
+
+
+    def start_metrics(self):
+        """
+        新建本次传输的 TransferMetrics，每隔 --progress-interval 秒输出一次进度
+        """
+        metrics = TransferMetrics()
+        metrics.start_reporting(self.__args.progress_interval, logger)
+        return metrics
+
+
+    def report_metrics(self, metrics, target, num_mappers):
+        """
+        传输结束后以 json 输出统计摘要，指定 --metrics-path 时同时写入文件
+        """
+        metrics.finish()
+        transfer = {
+            'execute_type': self.__args.execute_type,
+            'target': target,
+            'num_mappers': num_mappers,
+            'batch_size': self.__args.batch_size,
+        }
+        logger.info("metrics: " + json.dumps(dict(transfer, **metrics.summary()), ensure_ascii=False))
+        if self.__args.metrics_path is not None:
+            metrics.write(self.__args.metrics_path, **transfer)
+
+
+    def exec_presto(self, sql):
+        """
+        执行 presto 语句 (DDL 等) 并等待执行结束
+        """
+        presto_connection = self.__get_presto_connection()
+        try:
+            cursor = presto_connection.cursor()
+            cursor.execute(sql)
+            return cursor.fetchall()
+        finally:
+            presto_connection.close()
+
+
+    def get_mysql_source_sql(self):
+        """
+        导入的 mysql 查询，由 --mysql-table、--columns、--where 拼接
+        """
+        columns = '*'
+        if self.__args.columns is not None:
+            columns = ', '.join(quote_mysql_identifier(column.strip()) for column in self.__args.columns.split(','))
+
+        sql = 'SELECT {} FROM {}'.format(columns, quote_mysql_identifier(self.__args.mysql_table))
+        if self.__args.where is not None:
+            sql += ' WHERE ({})'.format(self.__args.where)
+        return sql
+
+
+    def get_mysql_incremental_sql(self, source_sql):
+        """
+        在 mysql 查询上加上增量条件，返回 (sql, 新 watermark)
+        """
+        column = quote_mysql_identifier(self.__args.check_column)
+        mysql_connection = self.__get_mysql_connection()
+        try:
+            cursor = mysql_connection.cursor()
+            cursor.execute('SELECT MAX({}) FROM ({}) presqoop_source'.format(column, source_sql))
+            upper_value = cursor.fetchone()[0]
+            # watermark 以字符串保存，mysql 比较时会按列的类型转换
+            return self.__incremental_sql(source_sql, column, mysql_connection.escape, upper_value)
+        finally:
+            mysql_connection.close()
+
+
+    def get_mysql_primary_key(self):
+        """
+        --mysql-table 的主键 (联合主键取第一列)，没有主键时返回 None
+        """
+        parts = self.__args.mysql_table.split('.')
+        schema, table = (parts[0], parts[1]) if len(parts) == 2 else (self.__args.mysql_database, parts[0])
+
+        mysql_connection = self.__get_mysql_connection()
+        try:
+            cursor = mysql_connection.cursor()
+            cursor.execute(
+                "SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE "
+                "WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND CONSTRAINT_NAME = 'PRIMARY' ORDER BY ORDINAL_POSITION",
+                (schema, table)
+            )
+            row = cursor.fetchone()
+        finally:
+            mysql_connection.close()
+        return row[0] if row is not None else None
+
+
+    def get_mysql_split_sqls(self, source_sql):
+        """
+        按主键 (或 --split-by 列) 的 min/max 切分 mysql 查询，每个 mapper 执行其中一段
+
+        **Basic**
+
+        与 get_split_sqls() 相同，只是 min/max 在 mysql 中查询，切分方式按返回值的类型判断；
+        没有主键又没有指定 --split-by 时与 sqoop 一样需要 --num-mappers 1
+        """
+        if self.__args.num_mappers == 1:
+            return [source_sql]
+
+        split_by = self.__args.split_by or self.get_mysql_primary_key()
+        if split_by is None:
+            raise SplitError("{} has no primary key, provide --split-by or --num-mappers 1".format(
+                self.__args.mysql_table
+            ))
+        column = quote_mysql_identifier(split_by)
+
+        mysql_connection = self.__get_mysql_connection()
+        try:
+            cursor = mysql_connection.cursor()
+            cursor.execute('SELECT MIN({column}), MAX({column}) FROM ({sql}) presqoop_source'.format(
+                column=column, sql=source_sql
+            ))
+            low, high = cursor.fetchone()
+        finally:
+            mysql_connection.close()
+
+        kind = value_split_type(low) if low is not None else 'integral'
+        conditions = split_conditions(column, low, high, self.__args.num_mappers, kind)
+        logger.info("split {} by {} in [{}, {}]: {} splits".format(
+            self.__args.mysql_table, split_by, low, high, len(conditions)
+        ))
+        return ['SELECT * FROM ({}) presqoop_source WHERE {}'.format(source_sql, condition) for condition in conditions]
+
+
+    def get_presto_column_types(self, table):
+        """
+        presto 表的 {列名: 类型}
+        """
+        return {row[0]: row[1] for row in self.exec_presto('DESCRIBE {}'.format(table))}
+
+
+    def swap_staging_table(self):
+        """
+        用 --staging-table 替换 --table
+
+        **Basic**
+
+        presto 没有原子的 swap，这里用两次 rename 完成: --table 改名为 <table>__presqoop_old，
+        --staging-table 改名为 --table，再删除旧表；第二次 rename 失败时把旧表改回原名。
+        两次 rename 之间 (只有 metastore 操作，通常在毫秒级) 查询 --table 会找不到表，但不会读到只导入了一部分的数据
+        """
+        table, staging_table = self.__args.table, self.__args.staging_table
+        old_table = '{}__presqoop_old'.format(table)
+
+        self.exec_presto('DROP TABLE IF EXISTS {}'.format(old_table))
+        self.exec_presto('ALTER TABLE {} RENAME TO {}'.format(table, old_table))
+        try:
+            self.exec_presto('ALTER TABLE {} RENAME TO {}'.format(staging_table, table))
+        except Exception:
+            self.exec_presto('ALTER TABLE {} RENAME TO {}'.format(old_table, table))
+            raise
+        self.exec_presto('DROP TABLE {}'.format(old_table))
+        logger.info("replaced {} with {}".format(table, staging_table))
+
+
+    def import_table(self):
+        """
+        从 mysql 导入
+        """
+        start = time.time()
+        table = self.__args.staging_table or self.__args.table
+
+        try:
+            if self.__args.staging_table is not None:
+                self.exec_presto('DROP TABLE IF EXISTS {}'.format(table))
+                self.exec_presto('CREATE TABLE {} (LIKE {} INCLUDING PROPERTIES)'.format(table, self.__args.table))
+
+            source_sql, watermark = self.get_mysql_source_sql(), None
+            if self.__args.incremental is not None:
+                source_sql, watermark = self.get_mysql_incremental_sql(source_sql)
+
+            split_sqls = self.get_mysql_split_sqls(source_sql)
+            num_mappers = min(self.__args.num_mappers, len(split_sqls))
+            load = PrestoImport(
+                self.__get_mysql_connection, self.__get_presto_connection, table, self.get_presto_column_types(table),
+                batch_size=self.__args.batch_size, max_statement_length=self.__args.max_statement_length,
+                logger=logger, metrics=self.start_metrics()
+            )
+            rows = load.run(split_sqls, num_mappers)
+            self.report_metrics(load.metrics, table, num_mappers)
+            self.save_watermark(watermark, rows)
+
+            if self.__args.staging_table is not None:
+                self.swap_staging_table()
+        except Exception as e:
+            logger.error("import into {} failed: {}".format(table, e))
+            sys.exit(1)
+
+        elapsed = time.time() - start
+        logger.info("imported {} rows into {} in {:.1f}s ({:.0f} rows/s)".format(
+            rows, self.__args.table, elapsed, rows / elapsed if elapsed > 0 else 0
+        ))
+
+
+    def execute(self):
+        {
+            'export': self.export,
+            'import': self.import_table,
+        }[self.__args.execute_type]()
+
+
+if __name__ == '__main__':
+    presqoop = Presqoop()
+    presqoop.execute()
@@ -0,0 +1,117 @@
+import re
+import datetime
+from decimal import Decimal
+
+
+class SplitError(Exception):
+    pass
+
+
+# 可以用作 --split-by 的 presto 类型
+INTEGRAL_TYPES = ('tinyint', 'smallint', 'integer', 'bigint')
+FRACTIONAL_TYPES = ('real', 'double', 'decimal')
+DATE_TYPES = ('date',)
+
+
+def split_type(presto_type):
+    """
+    presto 类型名 (例如 decimal(10,2)、bigint) 对应的切分方式: integral / fractional / date
+
+    :params presto_type: cursor.description 中的类型名
+    """
+    base_type = re.sub(r'\(.*\)', '', presto_type or '').strip().lower()
+    if base_type in INTEGRAL_TYPES:
+        return 'integral'
+    if base_type in FRACTIONAL_TYPES:
+        return 'fractional'
+    if base_type in DATE_TYPES:
+        return 'date'
+    raise SplitError("--split-by column must be an integral, decimal, double or date column, got: {}".format(presto_type))
+
+
+def value_split_type(value):
+    """
+    按 min/max 的 python 类型 (例如 pymysql 的返回值) 判断切分方式，用于没有 presto 类型名的数据源
+
+    :params value: split-by 列的最小值
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return 'integral'
+    if isinstance(value, (float, Decimal)):
+        return 'fractional'
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        return 'date'
+    raise SplitError("--split-by column must be an integral, decimal, double or date column, got: {}".format(
+        type(value).__name__
+    ))
+
+
+def split_bounds(low, high, num_splits, kind):
+    """
+    按 sqoop 的方式把 [low, high] 均分为最多 num_splits 段
+
+    **Basic**
+
+    返回边界列表 [b0, b1, ..., bn]，b0 = low，bn = high，第 i 段为 [b(i), b(i+1))，最后一段包含 high；
+    integral 与 date 的范围小于 num_splits 时段数相应减少
+
+    :params low: split-by 列的最小值
+    :params high: split-by 列的最大值
+    :params num_splits: 段数 (--num-mappers)
+    :params kind: split_type() 的返回值
+    """
+    if kind == 'date':
+        low, high = datetime.date.fromisoformat(str(low)), datetime.date.fromisoformat(str(high))
+        bounds = split_bounds(low.toordinal(), high.toordinal(), num_splits, 'integral')
+        return [datetime.date.fromordinal(bound) for bound in bounds]
+
+    if kind == 'integral':
+        low, high = int(low), int(high)
+    else:
+        low, high = Decimal(str(low)), Decimal(str(high))
+    if low == high:
+        return [low, high]
+
+    if kind == 'integral':
+        # 每段的起点互不相同，最后一段可以只有 high 一个值
+        num_splits = min(num_splits, high - low + 1)
+        bounds = [low + (high - low + 1) * i // num_splits for i in range(num_splits)]
+    else:
+        bounds = [low + (high - low) * i / num_splits for i in range(num_splits)]
+    return bounds + [high]
+
+
+def split_literal(value, kind):
+    if kind == 'date':
+        return "DATE '{}'".format(value.isoformat())
+    return str(value)
+
+
+def split_conditions(column, low, high, num_splits, kind):
+    """
+    生成每个 mapper 的 where 条件
+
+    **Basic**
+
+    split-by 列为 NULL 的行归入第一段；low 为 None (表为空或 split-by 列全为 NULL) 时只有一段
+
+    **Usage**
+
+        split_conditions('id', 1, 100, 2, 'integral')
+        # ['(id >= 1 AND id < 51 OR id IS NULL)', 'id >= 51 AND id <= 100']
+
+    :params column: --split-by 列名
+    """
+    if low is None or high is None:
+        return ['{} IS NULL'.format(column)]
+
+    bounds = split_bounds(low, high, num_splits, kind)
+    conditions = []
+    for i in range(len(bounds) - 1):
+        lower = '{} >= {}'.format(column, split_literal(bounds[i], kind))
+        last = i == len(bounds) - 2
+        upper = '{} {} {}'.format(column, '<=' if last else '<', split_literal(bounds[i + 1], kind))
+        conditions.append('{} AND {}'.format(lower, upper))
+
+    conditions[0] = '({} OR {} IS NULL)'.format(conditions[0], column)
+    return conditions
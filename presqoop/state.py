@@ -0,0 +1,61 @@
+import os
+import time
+import sqlite3
+
+
+class WatermarkStore:
+    """
+    增量传输的 watermark (check column 的 last value) 存储
+
+    **Basic**
+
+    使用本地 sqlite 按 job 记录上一次成功传输到的 check column 的值，
+    下一次执行只传输超过该值的行；值以字符串保存，由调用方按数据源的类型转换为字面量
+
+    **Usage**
+
+        store = WatermarkStore('~/.presqoop/state.db')
+        last_value = store.get(job_id)
+        ...
+        store.set(job_id, 'updated_at', '2019-01-01 00:00:00')
+    """
+
+    def __init__(self, path):
+        """
+        :params path: sqlite 文件路径
+        """
+        path = os.path.expanduser(path)
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.__connection = sqlite3.connect(path, timeout=30)
+        with self.__connection:
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS watermark (
+                    job_id TEXT PRIMARY KEY,
+                    check_column TEXT NOT NULL,
+                    last_value TEXT NOT NULL,
+                    updated_at REAL
+                )
+            """)
+
+
+    def get(self, job_id):
+        """
+        job 的 (check_column, last_value)，没有记录时返回 None
+        """
+        return self.__connection.execute(
+            "SELECT check_column, last_value FROM watermark WHERE job_id = ?", (job_id,)
+        ).fetchone()
+
+
+    def set(self, job_id, check_column, last_value):
+        with self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO watermark VALUES (?, ?, ?, ?)",
+                (job_id, check_column, str(last_value), time.time())
+            )
+
+
+    def close(self):
+        self.__connection.close()
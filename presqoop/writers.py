@@ -0,0 +1,171 @@
+import io
+import abc
+import csv
+import json
+import gzip
+
+
+# 支持的文件格式与压缩方式
+FILE_FORMATS = ['csv', 'jsonl', 'parquet']
+FILE_COMPRESSIONS = ['gzip', 'zstd', 'none']
+
+# 文件后缀
+COMPRESSION_SUFFIX = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+# presto 类型 ==> parquet 列类型，未列出的类型统一以字符串写入
+PARQUET_TYPES = {
+    'tinyint': 'int64',
+    'smallint': 'int64',
+    'integer': 'int64',
+    'bigint': 'int64',
+    'real': 'float64',
+    'double': 'float64',
+    'boolean': 'bool_',
+}
+
+
+class RowWriter(abc.ABC):
+    """
+    把 presto 查询结果按批次写入一个已打开的二进制文件对象
+
+    **Basic**
+
+    csv 首行为列名，jsonl 每行一个 {column: value} 对象，parquet 每个批次写为一个 row group (需要安装 pyarrow)；
+    array / map / row 以 json 字符串写入 csv 与 parquet，输出与 presto-etl 的 --result.sink.dir 相同
+
+    close() 只关闭序列化与压缩的部分，fileobj 由调用方关闭
+
+    **Usage**
+
+        writer = create_writer(file, 'csv', 'gzip', presto_cursor.description)
+        writer.write(presto_cursor.fetchmany(1000))
+        writer.close()
+    """
+
+    def __init__(self, fileobj, description):
+        """
+        :params fileobj: 二进制文件对象
+        :params description: presto cursor.description
+        """
+        self.columns = [column[0] for column in description]
+        self.types = [column[1] for column in description]
+
+
+    @abc.abstractmethod
+    def write(self, rows):
+        pass
+
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class CsvWriter(RowWriter):
+
+    def __init__(self, fileobj, description, compression):
+        super().__init__(fileobj, description)
+        self.__text = open_text(fileobj, compression)
+        self.__csv = csv.writer(self.__text)
+        self.__csv.writerow(self.columns)
+
+
+    def write(self, rows):
+        self.__csv.writerows(
+            [json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value for value in row]
+            for row in rows
+        )
+
+
+    def close(self):
+        self.__text.close()
+
+
+class JsonlWriter(RowWriter):
+
+    def __init__(self, fileobj, description, compression):
+        super().__init__(fileobj, description)
+        self.__text = open_text(fileobj, compression)
+
+
+    def write(self, rows):
+        self.__text.writelines(
+            json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str) + '\n' for row in rows
+        )
+
+
+    def close(self):
+        self.__text.close()
+
+
+class ParquetWriter(RowWriter):
+
+    def __init__(self, fileobj, description, compression):
+        super().__init__(fileobj, description)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.__pa = pa
+        self.__arrow_types = [
+            getattr(pa, PARQUET_TYPES.get(column_type.split('(')[0], 'string'))() for column_type in self.types
+        ]
+        schema = pa.schema([pa.field(name, arrow_type) for name, arrow_type in zip(self.columns, self.__arrow_types)])
+        self.__writer = pq.ParquetWriter(fileobj, schema, compression=compression)
+
+
+    def write(self, rows):
+        pa = self.__pa
+        arrays = []
+        for values, arrow_type in zip(zip(*rows), self.__arrow_types):
+            if arrow_type == pa.string():
+                values = [
+                    None if value is None else
+                    json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else str(value)
+                    for value in values
+                ]
+            arrays.append(pa.array(values, type=arrow_type))
+        self.__writer.write_table(pa.Table.from_arrays(arrays, names=self.columns))
+
+
+    def close(self):
+        self.__writer.close()
+
+
+def open_text(fileobj, compression):
+    """
+    在二进制文件对象上打开 (可压缩的) 文本流
+
+    :params fileobj: 二进制文件对象
+    :params compression: gzip, zstd, none
+    """
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=fileobj, mode='wb')
+    elif compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdCompressor().stream_writer(fileobj)
+    else:
+        stream = io.BufferedWriter(fileobj)
+    return io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+
+def file_suffix(file_format, compression):
+    """
+    文件后缀，例如 .csv.gz, .jsonl.zst, .parquet (parquet 为列压缩，不加压缩后缀)
+    """
+    if file_format == 'parquet':
+        return '.parquet'
+    return '.' + file_format + COMPRESSION_SUFFIX[compression]
+
+
+def create_writer(fileobj, file_format, compression, description):
+    """
+    创建写入器
+
+    :params fileobj: 二进制文件对象
+    :params file_format: csv, jsonl, parquet
+    :params compression: gzip, zstd, none (parquet 为列压缩方式)
+    :params description: presto cursor.description
+    :return: RowWriter
+    """
+    writer_class = {'csv': CsvWriter, 'jsonl': JsonlWriter, 'parquet': ParquetWriter}[file_format]
+    return writer_class(fileobj, description, compression)
@@ -1,10 +1,19 @@
+import io
+import atexit
 import os
+import time
+import uuid
+import hashlib
 import shutil
+import tarfile
 import logging
+import contextlib
 import coloredlogs, logging
 import configparser
+from shlex import quote
+from concurrent.futures import ThreadPoolExecutor
 from fabric import Connection, SerialGroup
-from invoke import task
+from invoke import task, Exit
 
 
 # Create a logger object.
@@ -40,6 +49,20 @@ for host_key in config['WORKER'].keys():
 worker_group = SerialGroup.from_connections(worker_connections)
 
 
+def close_connections():
+    """
+    关闭所有 coordinator 与 worker 的 SSH 连接
+
+    同一个进程中的 task (presto-admin.py 依次执行的多个操作) 共用这些连接，只在结束时关闭一次
+    """
+    for conn in coordinator_connections + worker_connections:
+        with contextlib.suppress(Exception):
+            conn.close()
+
+
+atexit.register(close_connections)
+
+
 @task
 def backup(c, type):
     if type == 'catalog':
@@ -49,29 +72,274 @@ def backup(c, type):
 
 
 @task
-def reload(c, type):
+def reload(c, type, parallel=8):
+    """
+    并行重载所有 coordinator 与 worker 的 catalog
+
+    **Basic**
+
+    本地的 catalog 目录 (只包括第一层的文件) 打包为一个 tar.gz，每台机器只上传一次，
+    最多同时处理 parallel 台机器；每台机器先把新的 catalog 解压到 catalog_path 下的临时目录，
+    解压成功后才删除旧的 catalog 并 mv 进来，上传失败时旧的 catalog 保持不变，
+    删除到 mv 完成之间只有本地文件操作
+
+    结束后输出每台机器的耗时与结果，有失败的机器时以 1 退出
+
+    **Usage**
+
+        fab reload catalog
+        fab reload catalog --parallel 16
+    """
     if type == 'catalog':
+        archive = pack_catalog('catalog')
+        token = uuid.uuid4().hex[:8]
 
-        # remove catalog
-        coordinator_group.run('rm -rf ' + coordinator_catalog_path + '/*')
-        worker_group.run('rm -rf ' + worker_catalog_path + '/*')
+        start = time.time()
+        results = run_on_hosts(
+            lambda role, conn, catalog_path: reload_catalog(role, conn, catalog_path, archive, token), parallel
+        )
 
-        # put new catalog
-        for conn in coordinator_group:
-            for pwd, sub_dir, files in os.walk('catalog'):
-                logger.info("[{}]: reloading...".format(conn.host))
-                for file in files:
-                    conn.put('catalog/{}'.format(file), coordinator_catalog_path)
-                logger.info("[{}]: reload complete!".format(conn.host))
-                break
-        
-        for conn in worker_group:
-            for pwd, sub_dir, files in os.walk('catalog'):
-                logger.info("[{}]: reloading...".format(conn.host))
+        failed = report_reload(results, time.time() - start)
+        if failed != 0:
+            raise Exit("reload failed on {} of {} hosts".format(failed, len(results)), code=1)
+
+
+def catalog_hosts():
+    """
+    [(role, conn, catalog_path), ...]
+    """
+    hosts = [('coordinator', conn, coordinator_catalog_path) for conn in coordinator_connections]
+    hosts += [('worker', conn, worker_catalog_path) for conn in worker_connections]
+    return hosts
+
+
+def run_on_hosts(func, parallel):
+    """
+    最多同时在 parallel 台机器上执行 func(role, conn, catalog_path)，按 catalog_hosts() 的顺序返回结果
+    """
+    with ThreadPoolExecutor(max_workers=max(1, int(parallel))) as executor:
+        return list(executor.map(lambda host: func(*host), catalog_hosts()))
+
+
+def catalog_files(catalog_dir):
+    """
+    catalog_dir 第一层的文件名，不包括隐藏文件
+    """
+    for pwd, sub_dir, files in os.walk(catalog_dir):
+        return sorted(file for file in files if not file.startswith('.'))
+    return []
+
+
+def pack_catalog(catalog_dir, files=None):
+    """
+    把 catalog_dir 第一层的文件打包为 tar.gz (bytes)
+
+    :params files: 只打包这些文件，默认全部
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for file in catalog_files(catalog_dir) if files is None else files:
+            archive.add(os.path.join(catalog_dir, file), arcname=file)
+    return buffer.getvalue()
+
+
+def reload_catalog(role, conn, catalog_path, archive, token):
+    """
+    在一台机器上重载 catalog
+
+    :params role: coordinator 或 worker
+    :params conn: fabric Connection
+    :params catalog_path: 远程的 catalog 目录
+    :params archive: pack_catalog() 的结果
+    :params token: 本次重载的临时文件名后缀
+    :return: {'role', 'host', 'ok', 'upload_seconds', 'seconds', 'error'}
+    """
+    start = time.time()
+    result = {'role': role, 'host': conn.host, 'ok': False, 'upload_seconds': None, 'seconds': None, 'error': None}
+    staging = '{}/.reload-{}'.format(catalog_path, token)
+    remote_archive = staging + '.tar.gz'
+    logger.info("[{}]: reloading...".format(conn.host))
+    try:
+        conn.put(io.BytesIO(archive), remote_archive)
+        result['upload_seconds'] = round(time.time() - start, 3)
+        conn.run(' && '.join([
+            'mkdir -p {staging}',
+            'tar -xzf {archive} -C {staging}',
+            'find {path} -mindepth 1 -maxdepth 1 ! -name .reload-{token} ! -name .reload-{token}.tar.gz -exec rm -rf {{}} +',
+            'find {staging} -mindepth 1 -maxdepth 1 -exec mv {{}} {path}/ \\;',
+            'rmdir {staging}',
+            'rm -f {archive}',
+        ]).format(staging=quote(staging), archive=quote(remote_archive), path=quote(catalog_path), token=token), hide=True)
+        result['ok'] = True
+        logger.info("[{}]: reload complete!".format(conn.host))
+    except Exception as e:
+        result['error'] = str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)
+        logger.error("[{}]: reload failed: {}".format(conn.host, result['error']))
+        with contextlib.suppress(Exception):
+            conn.run('rm -rf {} {}'.format(quote(staging), quote(remote_archive)), hide=True, warn=True)
+    finally:
+        result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def report_reload(results, elapsed):
+    """
+    输出每台机器的耗时与结果，返回失败的机器数
+    """
+    logger.info("{:<12} {:<24} {:<7} {:>10} {:>10}".format('role', 'host', 'result', 'upload(s)', 'total(s)'))
+    for result in results:
+        logger.info("{:<12} {:<24} {:<7} {:>10} {:>10}{}".format(
+            result['role'], result['host'], 'ok' if result['ok'] else 'FAILED',
+            result['upload_seconds'] if result['upload_seconds'] is not None else '-', result['seconds'],
+            '  ' + result['error'] if result['error'] else ''
+        ))
+
+    failed = len([result for result in results if not result['ok']])
+    logger.info("reloaded {} hosts in {:.1f}s, {} succeeded, {} failed".format(
+        len(results), elapsed, len(results) - failed, failed
+    ))
+    return failed
+
+
+@task
+def sync(c, type, parallel=8, dry_run=False):
+    """
+    按内容的 sha256 增量同步所有 coordinator 与 worker 的 catalog
+
+    **Basic**
+
+    每台机器先计算 catalog_path 第一层文件的 sha256 并与本地的 catalog 比较，只有新增与内容变化的文件
+    打包为一个 tar.gz 上传，解压到 catalog_path 下的临时目录后逐个 mv 覆盖 (同一文件系统内的 rename 是原子的)，
+    最后只删除本地已经不存在的文件；同步过程中 catalog 目录不会为空，也不会出现写了一半的文件
+
+    --dry-run 只输出每台机器的差异 (+ 新增、~ 变化、- 删除)，不做修改
+
+    **Usage**
+
+        fab sync catalog --dry-run
+        fab sync catalog --parallel 16
+    """
+    if type == 'catalog':
+        local_hashes = {file: file_sha256(os.path.join('catalog', file)) for file in catalog_files('catalog')}
+        token = uuid.uuid4().hex[:8]
+
+        start = time.time()
+        results = run_on_hosts(
+            lambda role, conn, catalog_path: sync_catalog(role, conn, catalog_path, local_hashes, token, dry_run),
+            parallel
+        )
+
+        failed = report_sync(results, time.time() - start, dry_run)
+        if failed != 0:
+            raise Exit("sync failed on {} of {} hosts".format(failed, len(results)), code=1)
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def remote_hashes(conn, catalog_path, dry_run=False):
+    """
+    远程 catalog_path 第一层文件 (不包括隐藏文件) 的 {文件名: sha256}
+
+    :params dry_run: 为 True 时不创建不存在的 catalog_path，视为空目录
+    """
+    find = "cd {path} && find . -mindepth 1 -maxdepth 1 -type f ! -name '.*' -exec sha256sum {{}} +"
+    command = 'test -d {path} && ' + find + ' || true' if dry_run else 'mkdir -p {path} && ' + find
+    output = conn.run(command.format(path=quote(catalog_path)), hide=True).stdout
+    hashes = {}
+    for line in output.splitlines():
+        if line.strip():
+            sha256, name = line.split(None, 1)
+            hashes[name.strip()[len('./'):]] = sha256
+    return hashes
+
+
+def diff_catalog(local_hashes, remote):
+    """
+    :return: (新增的文件, 内容变化的文件, 需要删除的文件)
+    """
+    added = sorted(file for file in local_hashes if file not in remote)
+    changed = sorted(file for file in local_hashes if file in remote and remote[file] != local_hashes[file])
+    removed = sorted(file for file in remote if file not in local_hashes)
+    return added, changed, removed
+
+
+def sync_catalog(role, conn, catalog_path, local_hashes, token, dry_run=False):
+    """
+    在一台机器上增量同步 catalog
+
+    :params role: coordinator 或 worker
+    :params conn: fabric Connection
+    :params catalog_path: 远程的 catalog 目录
+    :params local_hashes: 本地 catalog 的 {文件名: sha256}
+    :params token: 本次同步的临时文件名后缀
+    :params dry_run: 只比较不修改
+    :return: {'role', 'host', 'ok', 'added', 'changed', 'removed', 'seconds', 'error'}
+    """
+    start = time.time()
+    result = {
+        'role': role, 'host': conn.host, 'ok': False, 'added': [], 'changed': [], 'removed': [],
+        'seconds': None, 'error': None,
+    }
+    staging = '{}/.sync-{}'.format(catalog_path, token)
+    remote_archive = staging + '.tar.gz'
+    try:
+        added, changed, removed = diff_catalog(local_hashes, remote_hashes(conn, catalog_path, dry_run))
+        result.update(added=added, changed=changed, removed=removed)
+        if dry_run or len(added + changed + removed) == 0:
+            result['ok'] = True
+            return result
+
+        commands = []
+        if len(added + changed) != 0:
+            conn.put(io.BytesIO(pack_catalog('catalog', added + changed)), remote_archive)
+            commands += ['mkdir -p ' + quote(staging), 'tar -xzf {} -C {}'.format(quote(remote_archive), quote(staging))]
+            commands += [
+                'mv -f {0}/{2} {1}/{2}'.format(quote(staging), quote(catalog_path), quote(file)) for file in added + changed
+            ]
+            commands += ['rmdir ' + quote(staging), 'rm -f ' + quote(remote_archive)]
+        commands += ['rm -f {}/{}'.format(quote(catalog_path), quote(file)) for file in removed]
+        conn.run(' && '.join(commands), hide=True)
+        result['ok'] = True
+    except Exception as e:
+        result['error'] = str(e).strip().splitlines()[-1] if str(e).strip() else repr(e)
+        logger.error("[{}]: sync failed: {}".format(conn.host, result['error']))
+        if not dry_run:
+            with contextlib.suppress(Exception):
+                conn.run('rm -rf {} {}'.format(quote(staging), quote(remote_archive)), hide=True, warn=True)
+    finally:
+        result['seconds'] = round(time.time() - start, 3)
+    return result
+
+
+def report_sync(results, elapsed, dry_run=False):
+    """
+    输出每台机器的差异、耗时与结果，返回失败的机器数
+    """
+    for result in results:
+        if result['ok']:
+            logger.info("[{}]: {} {}, {} added, {} changed, {} removed in {}s".format(
+                result['host'], result['role'], 'would sync' if dry_run else 'synced',
+                len(result['added']), len(result['changed']), len(result['removed']), result['seconds']
+            ))
+            for mark, files in (('+', result['added']), ('~', result['changed']), ('-', result['removed'])):
                 for file in files:
-                    conn.put('catalog/{}'.format(file), worker_catalog_path)
-                logger.info("[{}]: reload complete!".format(conn.host))
-                break
+                    logger.info("[{}]:   {} {}".format(result['host'], mark, file))
+        else:
+            logger.error("[{}]: {} FAILED in {}s: {}".format(
+                result['host'], result['role'], result['seconds'], result['error']
+            ))
+
+    failed = len([result for result in results if not result['ok']])
+    logger.info("{} {} hosts in {:.1f}s, {} succeeded, {} failed".format(
+        'compared' if dry_run else 'synced', len(results), elapsed, len(results) - failed, failed
+    ))
+    return failed
 
 
 @task
@@ -33,6 +33,7 @@ class PrestoAdmin():
         初始化时将参数通过 self.__set_args() 绑定到 self.__args 变量上
         """
         self.__args = self.__set_args()
+        self.__fabfile = None
         self.__check_args()
 
 
@@ -49,6 +50,14 @@ class PrestoAdmin():
         parser.add_argument(
             '--reload-catalog', '-rc', action='store_true', dest='reload_catalog', default=False, help="reload catalog"
         )
+        parser.add_argument(
+            '--sync-catalog', '-sc', action='store_true', dest='sync_catalog', default=False,
+            help="sync only the added, changed and removed catalog files by sha256"
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run', default=False,
+            help="with --sync-catalog, only show the catalog diff of every host"
+        )
         parser.add_argument(
             '--list-catalog', '-lc', action='store_true', dest='list_catalog', default=False,
             help="list catalog file"
@@ -94,10 +103,64 @@ class PrestoAdmin():
 
 
     def __check_args(self):
-            self.list_catalog()
-            self.backup_catalog()
-            self.reload_catalog()
-            self.show_usage()
+        self.exit_code = 0
+        try:
+            # 前一步失败时不再执行后面的操作，例如备份失败时不重载
+            for action in (self.list_catalog, self.backup_catalog, self.reload_catalog, self.sync_catalog):
+                self.exit_code = action()
+                if self.exit_code != 0:
+                    break
+        finally:
+            self.__close_connections()
+        self.show_usage()
+
+
+    def __get_fabfile(self):
+        """
+        第一次执行 task 时才导入 fabfile (读取 config.ini 并创建所有机器的 Connection)，--usage / -h 不需要 config.ini
+        """
+        if self.__fabfile is None:
+            if not os.path.exists('config.ini'):
+                raise FileNotFoundError("config.ini not found in {}".format(os.getcwd()))
+            import fabfile
+            self.__fabfile = fabfile
+        return self.__fabfile
+
+
+    def __run_task(self, name, *args, **kwargs):
+        """
+        在当前进程中执行 fabfile 的 task
+
+        **Basic**
+
+        所有 task 共用 fabfile 中每台机器的 Connection，同一次执行中的多个操作只建立一次 SSH 连接；
+        task 以 invoke.Exit 退出时使用其退出码，fabric 的 GroupException 按机器输出错误
+
+        :params name: task 名，例如 reload
+        :return: 退出码，0 为成功
+        """
+        from invoke import Context, Exit
+        from fabric.exceptions import GroupException
+
+        try:
+            getattr(self.__get_fabfile(), name)(Context(), *args, **kwargs)
+        except Exit as e:
+            if e.message:
+                logger.error(e.message)
+            return e.code
+        except GroupException as e:
+            for conn, error in e.result.failed.items():
+                logger.error("[{}]: {}".format(conn.host, error_message(error)))
+            return 1
+        except Exception as e:
+            logger.error("{} failed: {}".format(name, error_message(e)))
+            return 1
+        return 0
+
+
+    def __close_connections(self):
+        if self.__fabfile is not None:
+            self.__fabfile.close_connections()
 
 
     def backup_catalog(self):
@@ -106,8 +169,11 @@ class PrestoAdmin():
         """
         if self.__args.backup_catalog is True:
             logger.info("backuping catalog file...")
-            os.system('fab backup catalog')
-            logger.info("backuping complete!")
+            exit_code = self.__run_task('backup', 'catalog')
+            if exit_code == 0:
+                logger.info("backuping complete!")
+            return exit_code
+        return 0
 
 
     def reload_catalog(self):
@@ -116,15 +182,34 @@ class PrestoAdmin():
         """
         if self.__args.reload_catalog is True:
             logger.info("reloading catalog file...")
-            os.system('fab reload catalog')
-            logger.info("reloading complete!")
+            exit_code = self.__run_task('reload', 'catalog')
+            if exit_code == 0:
+                logger.info("reloading complete!")
+            return exit_code
+        return 0
+
+
+    def sync_catalog(self):
+        """
+        sync catalog file
+        """
+        if self.__args.sync_catalog is True:
+            logger.info("syncing catalog file...")
+            exit_code = self.__run_task('sync', 'catalog', dry_run=self.__args.dry_run)
+            if exit_code == 0:
+                logger.info("syncing complete!")
+            return exit_code
+        return 0
+
 
-    
     def list_catalog(self):
         if self.__args.list_catalog is True:
             logger.info("list catalog file...")
-            os.system('fab show catalog')
-            logger.info("list complete!")
+            exit_code = self.__run_task('show', 'catalog')
+            if exit_code == 0:
+                logger.info("list complete!")
+            return exit_code
+        return 0
 
 
     def show_usage(self):
@@ -132,5 +217,14 @@ class PrestoAdmin():
             print(textwrap.dedent(PrestoAdmin.USAGE))
 
 
+def error_message(error):
+    """
+    异常的最后一行 (invoke 的 UnexpectedExit 会包含完整的命令输出)
+    """
+    message = str(error).strip()
+    return message.splitlines()[-1] if message else repr(error)
+
+
 if __name__ == '__main__':
     presto_admin = PrestoAdmin()
+    sys.exit(presto_admin.exit_code)
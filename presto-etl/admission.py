@@ -0,0 +1,180 @@
+import time
+import random
+import threading
+import contextlib
+
+
+class AdmissionController:
+    """
+    根据 coordinator 负载控制同时执行的语句数
+
+    **Basic**
+
+    提交语句前先获取执行名额 (slot)，同时执行的语句数不超过 limit。
+    每隔 poll_interval 秒通过 fetch_cluster 获取一次集群负载 (/v1/cluster 的 runningQueries、queuedQueries)，
+    以 queued 查询数与水位线比较调整 limit:
+
+    - queued >= high_watermark: limit 减半 (不低于 min_in_flight)，并且暂停提交，
+      按带抖动的指数退避等待，直到 queued 回落到 high_watermark 以下
+    - queued <= low_watermark: limit 加 1 (不超过 max_in_flight)
+    - 介于两者之间: limit 不变
+
+    获取集群负载失败时 (例如没有权限访问 /v1/cluster) 不做限制，只按 max_in_flight 控制
+
+    **Usage**
+
+        controller = AdmissionController(fetch_cluster, high_watermark=50, low_watermark=10, max_in_flight=8)
+        with controller.slot():
+            cursor.execute(sql)
+            ...
+
+        # 协程中
+        async with controller.async_slot():
+            await cursor.execute_async(sql)
+            ...
+        print(controller.summary())
+    """
+
+    # 退避的初始等待时间 (秒)
+    BASE_BACKOFF = 0.5
+
+    def __init__(self, fetch_cluster, high_watermark, low_watermark, max_in_flight, min_in_flight=1,
+                 poll_interval=2.0, max_backoff=30.0, logger=None):
+        """
+        :params fetch_cluster: 获取集群负载的函数，返回 /v1/cluster 的 json (dict)
+        :params high_watermark: queued 查询数的高水位线
+        :params low_watermark: queued 查询数的低水位线
+        :params max_in_flight: 同时执行的语句数上限
+        :params min_in_flight: limit 的下限
+        :params poll_interval: 获取集群负载的间隔 (秒)
+        :params max_backoff: 单次退避的最长等待时间 (秒)
+        :params logger: 输出 limit 变化与退避的 logger
+        """
+        self.__fetch_cluster = fetch_cluster
+        self.__high_watermark = high_watermark
+        self.__low_watermark = low_watermark
+        self.__max_in_flight = max_in_flight
+        self.__min_in_flight = min(min_in_flight, max_in_flight)
+        self.__poll_interval = poll_interval
+        self.__max_backoff = max_backoff
+        self.__logger = logger
+
+        self.__limit = max_in_flight
+        self.__in_flight = 0
+        self.__overloaded = False
+        self.__condition = threading.Condition()
+
+        self.__poll_lock = threading.Lock()
+        self.__polled_at = None
+        self.__poll_failed = False
+
+        self.__backoffs = 0
+        self.__waited = 0.0
+        self.__limit_range = [max_in_flight, max_in_flight]
+
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """
+        协程中使用的 slot()，等待名额时不阻塞事件循环
+        """
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(None, self.acquire)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+    def acquire(self):
+        """
+        获取执行名额，集群过载或名额已满时阻塞
+        """
+        attempt = 0
+        start = time.time()
+        while True:
+            self.__poll()
+            with self.__condition:
+                if not self.__overloaded and self.__in_flight < self.__limit:
+                    self.__in_flight += 1
+                    self.__waited += time.time() - start
+                    return
+                overloaded = self.__overloaded
+                if not overloaded:
+                    # 名额已满，等待其他语句结束或下一次获取负载
+                    self.__condition.wait(self.__poll_interval)
+                    continue
+
+            backoff = min(self.__max_backoff, AdmissionController.BASE_BACKOFF * 2 ** attempt)
+            backoff *= random.uniform(0.5, 1.5)
+            attempt += 1
+            with self.__condition:
+                self.__backoffs += 1
+            time.sleep(backoff)
+
+
+    def release(self):
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify()
+
+
+    def summary(self):
+        """
+        执行结束后输出的摘要
+        """
+        with self.__condition:
+            return "in-flight limit {}..{} (max {}), {} backoffs, {:.1f}s waited for admission in total".format(
+                self.__limit_range[0], self.__limit_range[1], self.__max_in_flight, self.__backoffs, self.__waited
+            )
+
+
+    def __poll(self):
+        """
+        距上次获取超过 poll_interval 时获取集群负载并调整 limit，同一时间只有一个线程获取
+        """
+        with self.__poll_lock:
+            if self.__polled_at is not None and time.time() - self.__polled_at < self.__poll_interval:
+                return
+            self.__polled_at = time.time()
+
+            try:
+                cluster = self.__fetch_cluster()
+                queued = int(cluster.get('queuedQueries', 0))
+                running = int(cluster.get('runningQueries', 0))
+            except Exception as e:
+                if not self.__poll_failed and self.__logger is not None:
+                    self.__logger.warning("admission control disabled, failed to get cluster load: {}".format(e))
+                self.__poll_failed = True
+                with self.__condition:
+                    self.__overloaded = False
+                    self.__condition.notify_all()
+                return
+
+        with self.__condition:
+            limit = self.__limit
+            if queued >= self.__high_watermark:
+                limit = max(self.__min_in_flight, self.__limit // 2)
+            elif queued <= self.__low_watermark:
+                limit = min(self.__max_in_flight, self.__limit + 1)
+
+            overloaded = queued >= self.__high_watermark
+            if self.__logger is not None and (limit != self.__limit or overloaded != self.__overloaded):
+                self.__logger.info("cluster running {} queued {}: in-flight limit {} -> {}{}".format(
+                    running, queued, self.__limit, limit, ', backing off' if overloaded else ''
+                ))
+
+            self.__limit = limit
+            self.__overloaded = overloaded
+            self.__limit_range = [min(self.__limit_range[0], limit), max(self.__limit_range[1], limit)]
+            self.__condition.notify_all()
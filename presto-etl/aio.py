@@ -0,0 +1,355 @@
+import asyncio
+import threading
+import aiohttp
+import prestodb
+from urllib.parse import quote, unquote
+
+
+class AsyncQuery:
+    """
+    通过 presto HTTP statement 协议执行的查询
+
+    POST /v1/statement 提交查询，之后沿着 nextUri 轮询直到没有 nextUri 为止，
+    每次响应中的 data 为一页结果，请求头取自连接的会话，响应中的会话变更也会更新到会话上
+    """
+
+    def __init__(self, client, sql, session):
+        self.__client = client
+        self.__session = session
+        self.sql = sql
+        self.query_id = None
+        self.columns = None
+        self.stats = {}
+        self.finished = False
+        self.__next_uri = None
+
+
+    async def submit(self):
+        """
+        提交查询，返回第一页结果
+        """
+        status = await self.__client.request(
+            'POST', self.__client.statement_url, data=self.sql.encode('utf-8'), session=self.__session
+        )
+        return self.__process(status)
+
+
+    async def fetch(self):
+        """
+        获取下一页结果，查询已结束时返回 None
+
+        :return: [row, ...] 或 None
+        """
+        if self.finished:
+            return None
+        status = await self.__client.request('GET', self.__next_uri, session=self.__session)
+        return self.__process(status)
+
+
+    async def cancel(self):
+        if self.__next_uri is not None and not self.finished:
+            await self.__client.request('DELETE', self.__next_uri)
+            self.finished = True
+
+
+    def __process(self, status):
+        self.query_id = status.get('id', self.query_id)
+        self.stats.update({'queryId': self.query_id})
+        self.stats.update(status.get('stats', {}))
+        if status.get('columns') is not None:
+            self.columns = status['columns']
+
+        if status.get('error') is not None:
+            self.finished = True
+            raise self.__client.query_error(status['error'], self.query_id)
+
+        self.__next_uri = status.get('nextUri')
+        if self.__next_uri is None:
+            self.finished = True
+
+        return status.get('data', [])
+
+
+class AsyncPrestoSession:
+    """
+    连接的会话状态，与 prestodb.client.ClientSession 一致
+
+    每个请求都带上会话的 catalog、schema 与 session properties；
+    SET SESSION / RESET SESSION / USE 执行后，presto 通过响应头 X-Presto-Set-Session、X-Presto-Clear-Session、
+    X-Presto-Set-Catalog、X-Presto-Set-Schema 返回会话的变更，由 update() 更新到会话上
+    """
+
+    def __init__(self, user, catalog, schema, source):
+        self.user = user
+        self.catalog = catalog
+        self.schema = schema
+        self.source = source
+        self.properties = {}
+
+
+    def headers(self):
+        return {
+            'X-Presto-User': self.user,
+            'X-Presto-Catalog': self.catalog,
+            'X-Presto-Schema': self.schema,
+            'X-Presto-Source': self.source,
+            'X-Presto-Session': ','.join(
+                '{}={}'.format(name, quote(str(value))) for name, value in self.properties.items()
+            ),
+        }
+
+
+    def update(self, headers):
+        """
+        根据响应头更新会话
+
+        :params headers: 响应头 (aiohttp 的 CIMultiDictProxy)
+        """
+        for value in headers.getall('X-Presto-Set-Catalog', []):
+            self.catalog = value.strip()
+        for value in headers.getall('X-Presto-Set-Schema', []):
+            self.schema = value.strip()
+
+        for value in headers.getall('X-Presto-Clear-Session', []):
+            for name in value.split(','):
+                self.properties.pop(name.strip(), None)
+
+        for value in headers.getall('X-Presto-Set-Session', []):
+            for property in value.split(','):
+                name, _, property_value = property.partition('=')
+                self.properties[name.strip()] = unquote(property_value.strip())
+
+
+class AsyncPrestoClient:
+    """
+    基于 asyncio 的 presto 客户端
+
+    **Basic**
+
+    直接实现 presto HTTP statement 协议，所有查询的提交与 nextUri 轮询都在同一个事件循环里进行，
+    共享一个带 keep-alive 连接池的 aiohttp.ClientSession；轮询不再占用线程，
+    同时执行大量查询时只需要与连接池大小相当的 HTTP 连接
+
+    事件循环运行在后台线程中，每个连接有自己的会话 (AsyncPrestoSession)，只共享事件循环与连接池。
+    connect() 得到的连接与 prestodb.dbapi 兼容，cursor 既可以在同步代码中使用 (execute / fetchmany)，
+    也可以在事件循环的协程中使用 (execute_async / fetchmany_async)，
+    查询结果与异常类型 (prestodb.exceptions) 都与 prestodb.dbapi 一致
+
+    **Usage**
+
+        client = AsyncPrestoClient(host, port, user, catalog, schema)
+        cursor = client.connect().cursor()
+        cursor.execute('select 1')
+        print(cursor.fetchall())
+
+        # 协程中
+        await cursor.execute_async('select 1')
+        print(await cursor.fetchall_async())
+        client.close()
+    """
+
+    # 503 与连接错误的重试次数，与 prestodb 默认值一致
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, host, port, user, catalog, schema, max_connections=100, source='presto-etl'):
+        """
+        :params max_connections: 连接池大小
+        """
+        self.statement_url = 'http://{}:{}/v1/statement'.format(host, port)
+        self.__session_args = (user, catalog, schema, source)
+        self.__max_connections = max_connections
+
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name='presto-aio', daemon=True)
+        self.__thread.start()
+        self.__http_session = self.run(self.__create_http_session())
+
+
+    async def __create_http_session(self):
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.__max_connections))
+
+
+    def run(self, coroutine):
+        """
+        在客户端的事件循环中执行协程，并等待结果 (供同步代码调用)
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+
+    async def request(self, method, url, data=None, session=None):
+        """
+        发送请求并返回 json，503 与连接错误会按指数退避重试
+
+        :params session: 请求所属连接的 AsyncPrestoSession，请求头取自会话，响应头中的会话变更会更新到会话上
+        """
+        headers = session.headers() if session is not None else None
+        for attempt in range(1, AsyncPrestoClient.MAX_ATTEMPTS + 1):
+            try:
+                async with self.__http_session.request(method, url, data=data, headers=headers) as response:
+                    if response.status == 503 and attempt < AsyncPrestoClient.MAX_ATTEMPTS:
+                        await asyncio.sleep(0.1 * 2 ** attempt)
+                        continue
+                    if response.status == 204 or method == 'DELETE':
+                        return {}
+                    if response.status == 503:
+                        raise prestodb.exceptions.Http503Error("error 503: service unavailable")
+                    if response.status != 200:
+                        raise prestodb.exceptions.HttpError(
+                            "error {}: {}".format(response.status, await response.text())
+                        )
+                    if session is not None:
+                        session.update(response.headers)
+                    return await response.json(content_type=None)
+            except aiohttp.ClientConnectionError as e:
+                if attempt == AsyncPrestoClient.MAX_ATTEMPTS:
+                    raise prestodb.exceptions.OperationalError(str(e))
+                await asyncio.sleep(0.1 * 2 ** attempt)
+
+
+    def query_error(self, error, query_id):
+        """
+        按 errorType 转换为与 prestodb 相同的异常类型
+        """
+        error_type = error.get('errorType')
+        if error_type == 'EXTERNAL':
+            return prestodb.exceptions.PrestoExternalError(error, query_id)
+        elif error_type == 'USER_ERROR':
+            return prestodb.exceptions.PrestoUserError(error, query_id)
+        return prestodb.exceptions.PrestoQueryError(error, query_id)
+
+
+    async def execute(self, sql, session=None):
+        """
+        提交查询
+
+        :params session: 查询使用的会话，为 None 时使用一个只属于该查询的新会话
+        :return: (AsyncQuery, 第一页结果)
+        """
+        query = AsyncQuery(self, sql, session if session is not None else self.session())
+        rows = await query.submit()
+        return query, rows
+
+
+    def session(self):
+        """
+        以客户端的 user、catalog、schema 新建会话
+        """
+        return AsyncPrestoSession(*self.__session_args)
+
+
+    def connect(self):
+        """
+        获取与 prestodb.dbapi.Connection 兼容的连接，连接有自己的会话，所有连接共享客户端的事件循环与连接池
+        """
+        return AsyncPrestoConnection(self, self.session())
+
+
+    def close(self):
+        self.run(self.__http_session.close())
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+
+
+class AsyncPrestoConnection:
+    """
+    prestodb.dbapi.Connection 兼容的连接，连接内的 cursor 共享同一个会话
+    """
+
+    def __init__(self, client, session):
+        self.client = client
+        self.session = session
+
+
+    def cursor(self):
+        return AsyncPrestoCursor(self)
+
+
+    def run(self, coroutine):
+        """
+        在客户端的事件循环中执行协程，并等待结果 (供同步代码调用)
+        """
+        return self.client.run(coroutine)
+
+
+    def close(self):
+        # 连接池属于 AsyncPrestoClient，由 client.close() 统一关闭
+        pass
+
+
+class AsyncPrestoCursor:
+    """
+    prestodb.dbapi.Cursor 兼容的 cursor，网络请求都在 AsyncPrestoClient 的事件循环中执行
+
+    同步方法 (execute / fetchmany / fetchall) 供普通线程调用，
+    *_async 方法是对应的协程，供事件循环中的协程调用
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.__client = connection.client
+        self.__query = None
+        self.__rows = []
+        self.arraysize = 1
+
+
+    @property
+    def description(self):
+        if self.__query is None or self.__query.columns is None:
+            return None
+        return [(column['name'], column['type'], None, None, None, None, None) for column in self.__query.columns]
+
+
+    @property
+    def stats(self):
+        return self.__query.stats if self.__query is not None else None
+
+
+    async def execute_async(self, operation):
+        self.__query = None
+        self.__query, rows = await self.__client.execute(operation, self.connection.session)
+        self.__rows = list(rows)
+        return self
+
+
+    async def fetchmany_async(self, size=None):
+        size = self.arraysize if size is None else size
+        while len(self.__rows) < size and not self.__query.finished:
+            self.__rows.extend(await self.__query.fetch() or [])
+
+        rows, self.__rows = self.__rows[:size], self.__rows[size:]
+        return rows
+
+
+    async def fetchall_async(self):
+        rows = []
+        while True:
+            batch = await self.fetchmany_async(1000)
+            if len(batch) == 0:
+                return rows
+            rows.extend(batch)
+
+
+    def execute(self, operation):
+        return self.__client.run(self.execute_async(operation))
+
+
+    def fetchmany(self, size=None):
+        return self.__client.run(self.fetchmany_async(size))
+
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if len(rows) != 0 else None
+
+
+    def fetchall(self):
+        return self.__client.run(self.fetchall_async())
+
+
+    def cancel(self):
+        if self.__query is not None:
+            self.__client.run(self.__query.cancel())
+
+
+    def close(self):
+        pass
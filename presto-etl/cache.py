@@ -0,0 +1,378 @@
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import collections
+
+
+# 结果缓存的 ttl 声明: -- @cache.ttl: 3600 / 30m / 1h / 1d
+CACHE_TTL_HINT = re.compile(r'--\s*@cache\.ttl:\s*(\d+)\s*([smhd]?)\b')
+
+TTL_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# 规范化 sql 时识别的片段: 字符串常量、带引号的标识符、连续的注释与空白
+SQL_FRAGMENT = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|(?:\s|--[^\n]*|/\*.*?\*/)+", re.S)
+
+
+class SqlCacheError(Exception):
+    """
+    sql 脚本既无法从远程获取，也没有可用的本地缓存
+    """
+    pass
+
+
+class SqlCache:
+    """
+    SQL 脚本的本地磁盘缓存
+
+    **Basic**
+
+    以 url 为 key 缓存 sql 脚本内容，脚本内容按 sha256 存储 (内容寻址)，
+    相同内容的脚本只保存一份，目录结构如下:
+
+        <cache_dir>/meta/<sha1(url)>.json  ==> {url, digest, etag, last_modified, fetched_at}
+        <cache_dir>/blobs/<sha256(content)>
+
+    - 缓存在 ttl 秒内直接使用，不发送请求
+    - 超过 ttl 后带上 If-None-Match / If-Modified-Since 发送条件请求，返回 304 时继续使用缓存
+    - 远程不可达 (连接失败或 5xx) 时退回使用过期缓存
+    - offline 模式下完全不发送请求，只使用缓存
+    - blobs 总大小超过 max_size 时，按最近使用时间淘汰
+
+    所有写入都是先写临时文件再 rename，多个进程可以共享同一个缓存目录
+
+    .. version v1.0
+    """
+
+    def __init__(self, cache_dir, ttl=300, max_size=64 * 1024 * 1024, offline=False):
+        """
+        :params cache_dir: 缓存目录
+        :params ttl: 缓存有效时间 (秒)，期间不再向远程确认
+        :params max_size: blobs 总大小上限 (字节)
+        :params offline: 离线模式，只读缓存
+        """
+        self.__meta_dir = os.path.join(cache_dir, 'meta')
+        self.__blob_dir = os.path.join(cache_dir, 'blobs')
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__offline = offline
+
+        os.makedirs(self.__meta_dir, exist_ok=True)
+        os.makedirs(self.__blob_dir, exist_ok=True)
+
+
+    def get(self, session, url):
+        """
+        获取 url 对应的内容，优先使用缓存
+
+        :params session: requests.Session
+        :params url: 请求的 url
+        :return content: url 内容 (bytes)
+        """
+        meta = self.__read_meta(url)
+        content = self.__read_blob(meta['digest']) if meta is not None else None
+        if content is None:
+            meta = None
+
+        if self.__offline:
+            if content is None:
+                raise SqlCacheError("{}: not cached (offline mode)".format(url))
+            return content
+
+        if content is not None and time.time() - meta['fetched_at'] < self.__ttl:
+            self.__touch(url)
+            return content
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        import requests
+
+        try:
+            response = session.get(url, headers=headers)
+        except requests.exceptions.RequestException as e:
+            if content is not None:
+                return content
+            raise SqlCacheError("{}: {}".format(url, e))
+
+        if response.status_code == 304 and content is not None:
+            meta['fetched_at'] = time.time()
+            self.__write_meta(url, meta)
+            return content
+
+        if response.status_code == 200:
+            self.put(url, response.content, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            return response.content
+
+        if response.status_code >= 500 and content is not None:
+            return content
+
+        raise SqlCacheError("{}: {}, {}".format(url, response.status_code, response.reason))
+
+
+    def put(self, url, content, etag=None, last_modified=None):
+        """
+        写入缓存，超过大小上限时进行淘汰
+
+        :params url: url
+        :params content: 内容 (bytes)
+        :params etag: 响应头 ETag
+        :params last_modified: 响应头 Last-Modified
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        blob_path = os.path.join(self.__blob_dir, digest)
+        if not os.path.exists(blob_path):
+            atomic_write(blob_path, content)
+
+        self.__write_meta(url, {
+            'url': url,
+            'digest': digest,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+        })
+        self.evict()
+
+
+    def evict(self):
+        """
+        blobs 总大小超过上限时，按 meta 的最近使用时间 (mtime) 从旧到新淘汰，
+        并删除不再被引用的 blob
+        """
+        metas = []
+        for name in os.listdir(self.__meta_dir):
+            path = os.path.join(self.__meta_dir, name)
+            try:
+                with open(path) as f:
+                    metas.append((os.path.getmtime(path), path, json.load(f)['digest']))
+            except (OSError, ValueError, KeyError):
+                continue
+
+        blob_sizes = {}
+        for digest in os.listdir(self.__blob_dir):
+            try:
+                blob_sizes[digest] = os.path.getsize(os.path.join(self.__blob_dir, digest))
+            except OSError:
+                continue
+
+        references = collections.Counter(digest for _, _, digest in metas)
+        total_size = sum(size for digest, size in blob_sizes.items() if references[digest] > 0)
+
+        for _, path, digest in sorted(metas):
+            if total_size <= self.__max_size:
+                break
+            remove_file(path)
+            references[digest] -= 1
+            if references[digest] == 0:
+                total_size -= blob_sizes.get(digest, 0)
+
+        for digest in blob_sizes.keys():
+            if references[digest] <= 0 and not digest.startswith('.'):
+                remove_file(os.path.join(self.__blob_dir, digest))
+
+
+    def __meta_path(self, url):
+        return os.path.join(self.__meta_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+
+    def __read_meta(self, url):
+        try:
+            with open(self.__meta_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def __write_meta(self, url, meta):
+        atomic_write(self.__meta_path(url), json.dumps(meta).encode('utf-8'))
+
+
+    def __read_blob(self, digest):
+        # blob 可能已被其他进程淘汰，此时视为未命中
+        try:
+            with open(os.path.join(self.__blob_dir, digest), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+
+    def __touch(self, url):
+        try:
+            os.utime(self.__meta_path(url))
+        except OSError:
+            pass
+
+
+class ResultCache:
+    """
+    查询结果的本地磁盘缓存
+
+    **Basic**
+
+    用于获取 placeholder 等结果很小、在一段时间内不变的查询，以规范化后的 sql 与 presto 连接的
+    host、port、catalog、schema 为 key，目录结构如下:
+
+        <cache_dir>/<sha256(key)>.json  ==> {key, expires_at, columns, rows}
+
+    - 规范化: 去掉注释与结尾的分号，字符串常量以外的连续空白合并为一个空格，
+      只有格式或注释不同的 sql 命中同一个缓存
+    - ttl 由 sql 中的注释声明，例如 `-- @cache.ttl: 1h`，没有声明时使用默认 ttl，ttl 为 0 时不缓存
+    - 命中时更新文件的 mtime，总大小超过 max_size 时按 mtime 从旧到新淘汰，过期的结果同时被删除
+
+    与 SqlCache 一样先写临时文件再 rename，多个进程可以共享同一个缓存目录
+
+    **Usage**
+
+        cache = ResultCache('~/.presto-etl/result-cache', default_ttl=0)
+        key = ResultCache.key(sql, host, port, catalog, schema)
+        result = cache.get(key)
+        if result is None:
+            ...
+            cache.put(key, columns, rows, cache.ttl(sql))
+    """
+
+    def __init__(self, cache_dir, default_ttl=0, max_size=64 * 1024 * 1024):
+        """
+        :params cache_dir: 缓存目录
+        :params default_ttl: sql 没有声明 ttl 时使用的 ttl (秒)
+        :params max_size: 缓存总大小上限 (字节)
+        """
+        self.__cache_dir = cache_dir
+        self.__default_ttl = default_ttl
+        self.__max_size = max_size
+
+        os.makedirs(self.__cache_dir, exist_ok=True)
+
+
+    @staticmethod
+    def normalize(sql):
+        """
+        规范化 sql
+        """
+        def replace(match):
+            fragment = match.group(0)
+            return fragment if fragment[0] in '\'"' else ' '
+
+        return SQL_FRAGMENT.sub(replace, sql).strip().rstrip(';').strip()
+
+
+    @staticmethod
+    def key(sql, host, port, catalog, schema):
+        """
+        计算缓存的 key
+        """
+        return json.dumps([ResultCache.normalize(sql), host, port, catalog, schema])
+
+
+    def ttl(self, sql):
+        """
+        sql 中声明的 ttl (秒)，有多个时以最后一个为准，没有声明时返回默认 ttl
+        """
+        ttl = self.__default_ttl
+        for value, unit in CACHE_TTL_HINT.findall(sql):
+            ttl = int(value) * TTL_UNITS[unit]
+        return ttl
+
+
+    def get(self, key):
+        """
+        获取未过期的结果
+
+        :return: (columns, rows)，未命中时为 None
+        """
+        path = self.__path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get('key') != key or entry['expires_at'] <= time.time():
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry['columns'], entry['rows']
+
+
+    def put(self, key, columns, rows, ttl):
+        """
+        写入结果，ttl 不大于 0 时不写入
+
+        :params columns: 列名
+        :params rows: 结果 (可以 json 序列化)
+        :params ttl: 有效时间 (秒)
+        """
+        if ttl <= 0:
+            return
+
+        atomic_write(self.__path(key), json.dumps({
+            'key': key,
+            'expires_at': time.time() + ttl,
+            'columns': columns,
+            'rows': rows,
+        }).encode('utf-8'))
+        self.evict()
+
+
+    def evict(self):
+        """
+        删除过期的结果，总大小超过上限时按 mtime 从旧到新淘汰
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.__cache_dir):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.__cache_dir, name)
+            try:
+                stat = os.stat(path)
+                with open(path) as f:
+                    expires_at = json.load(f)['expires_at']
+            except (OSError, ValueError, KeyError):
+                continue
+
+            if expires_at <= now:
+                remove_file(path)
+            else:
+                entries.append((stat.st_mtime, path, stat.st_size))
+
+        total_size = sum(size for _, _, size in entries)
+        for _, path, size in sorted(entries):
+            if total_size <= self.__max_size:
+                break
+            remove_file(path)
+            total_size -= size
+
+
+    def __path(self, key):
+        return os.path.join(self.__cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def atomic_write(path, content):
+    """
+    先写临时文件再 rename，其他进程不会读到写了一半的文件
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        remove_file(tmp_path)
+        raise
@@ -0,0 +1,300 @@
+import re
+
+
+# 写入表的语句
+WRITE_PATTERNS = [
+    re.compile(r'^insert\s+(?:overwrite\s+)?(?:into\s+)?(?:table\s+)?([\w."`]+)'),
+    re.compile(r'^create\s+(?:or\s+replace\s+)?(?:table|view)\s+(?:if\s+not\s+exists\s+)?([\w."`]+)'),
+    re.compile(r'^drop\s+(?:table|view)\s+(?:if\s+exists\s+)?([\w."`]+)'),
+    re.compile(r'^delete\s+from\s+([\w."`]+)'),
+    re.compile(r'^alter\s+table\s+(?:if\s+exists\s+)?([\w."`]+)(?:.*\brename\s+to\s+([\w."`]+))?'),
+]
+
+# 可以推断读写关系的语句，其他语句 (set session, use, call 等) 作为屏障，与前后所有语句都有依赖
+KNOWN_KEYWORDS = (
+    'select', 'with', 'values', 'insert', 'create', 'drop', 'delete', 'alter', 'show', 'describe', 'explain'
+)
+
+# 显式依赖注释: -- @after: create, fully#2
+AFTER_HINT = re.compile(r'--\s*@after:([^\n]*)')
+
+# 标识符 (可带 catalog/schema 前缀与引号) 或括号、逗号
+TOKEN = re.compile(r'(?:"[^"]*"|`[^`]*`|\w+)(?:\.(?:"[^"]*"|`[^`]*`|\w+))*|[(),]')
+
+
+class Node:
+    """
+    DAG 的节点
+
+    普通脚本的每条语句为一个节点，id 为 <sql_name>#<语句序号>；
+    带 placeholder 的脚本整体作为一个节点 (id 为 <sql_name>)，保持按组合依次执行整个脚本的语义
+    """
+
+    def __init__(self, node_id, sql_name, index, sql, reads, writes, hints, barrier):
+        """
+        :params node_id: 节点 id
+        :params sql_name: sql 名
+        :params index: 语句序号 (从 1 开始)，整个脚本为一个节点时为 None
+        :params sql: sql 文本
+        :params reads: 读取的表
+        :params writes: 写入的表
+        :params hints: 注释中声明的依赖，没有声明时为 None
+        :params barrier: 是否为屏障节点
+        """
+        self.id = node_id
+        self.sql_name = sql_name
+        self.index = index
+        self.sql = sql
+        self.reads = reads
+        self.writes = writes
+        self.hints = hints
+        self.barrier = barrier
+        self.deps = []
+
+
+class DagError(Exception):
+    pass
+
+
+def split_statements(sql):
+    """
+    按 ';' 拆分语句，与 PrestoETL.exec_sql 的拆分方式一致
+    """
+    return [statement.strip('\n').strip() for statement in sql.split(';') if statement.strip('\n').strip() != '']
+
+
+def strip_sql(sql):
+    """
+    去掉注释与字符串常量，转为小写
+    """
+    sql = re.sub(r'--[^\n]*', ' ', sql)
+    sql = re.sub(r'/\*.*?\*/', ' ', sql, flags=re.S)
+    sql = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    return sql.lower().strip().lstrip('(').strip()
+
+
+def qualify(name, catalog, schema):
+    """
+    将表名补全为 catalog.schema.table
+    """
+    parts = [part.strip('"`') for part in name.split('.')]
+    if len(parts) == 1:
+        parts = [catalog, schema] + parts
+    elif len(parts) == 2:
+        parts = [catalog] + parts
+    return '.'.join(parts).lower()
+
+
+def parse_tables(sql, catalog, schema):
+    """
+    解析语句读写的表
+
+    :params sql: 单条 sql 语句
+    :params catalog: 默认 catalog
+    :params schema: 默认 schema
+    :return: (reads, writes, barrier)
+    """
+    text = strip_sql(sql)
+    if text == '' or text.split(None, 1)[0] not in KNOWN_KEYWORDS:
+        return set(), set(), True
+
+    writes = set()
+    for pattern in WRITE_PATTERNS:
+        match = pattern.match(text)
+        if match is not None:
+            writes.update(qualify(name, catalog, schema) for name in match.groups() if name is not None)
+            break
+
+    tokens = TOKEN.findall(text)
+
+    # with 子句定义的名字不是表
+    ctes = set()
+    for i, token in enumerate(tokens[:-2]):
+        if tokens[i + 1] == 'as' and tokens[i + 2] == '(' and (i == 0 or tokens[i - 1] in ('with', ',', 'recursive')):
+            ctes.add(token)
+        elif token not in ('as', '(') and tokens[i + 1] == '(' and i > 0 and tokens[i - 1] in ('with', ','):
+            # with t (a, b) as (...)
+            ctes.add(token)
+
+    reads = set()
+    i = 0
+    while i < len(tokens):
+        if tokens[i] in ('from', 'join'):
+            i += 1
+            # from a, b 形式的多个表
+            while i < len(tokens):
+                if tokens[i] in ('(', 'unnest', 'lateral'):
+                    break
+                if tokens[i] not in ctes:
+                    reads.add(qualify(tokens[i], catalog, schema))
+                i += 1
+                # 跳过别名
+                if i < len(tokens) and tokens[i] == 'as':
+                    i += 1
+                if i < len(tokens) and re.match(r'^\w+$', tokens[i]) and tokens[i] not in SQL_CLAUSES:
+                    i += 1
+                if i < len(tokens) and tokens[i] == ',':
+                    i += 1
+                else:
+                    break
+        else:
+            i += 1
+
+    return reads, writes, False
+
+
+# from 子句之后可能出现的关键字，不是表的别名
+SQL_CLAUSES = (
+    'where', 'group', 'order', 'having', 'limit', 'union', 'intersect', 'except', 'join', 'left', 'right', 'full',
+    'inner', 'cross', 'natural', 'on', 'using', 'offset', 'fetch', 'window', 'tablesample', 'select', 'with',
+)
+
+
+def parse_hints(sql):
+    """
+    解析注释中的显式依赖，没有声明时返回 None
+
+    -- @after: create, fully#2   ==> ['create', 'fully#2']
+    -- @after:                   ==> [] (不依赖任何语句)
+    """
+    hints = None
+    for match in AFTER_HINT.finditer(sql):
+        hints = (hints or []) + [hint.strip() for hint in match.group(1).split(',') if hint.strip() != '']
+    return hints
+
+
+def build_nodes(sql_names, sql_file, whole_file_names, catalog, schema):
+    """
+    将脚本拆分为 DAG 节点
+
+    :params sql_names: 按执行顺序排列的 sql 名
+    :params sql_file: {sql_name: sql_text}
+    :params whole_file_names: 整体作为一个节点的 sql 名 (带 placeholder 的脚本)
+    :params catalog: 默认 catalog
+    :params schema: 默认 schema
+    :return: [Node, ...]
+    """
+    nodes = []
+    for sql_name in sql_names:
+        statements = split_statements(sql_file[sql_name])
+
+        if sql_name in whole_file_names:
+            reads, writes, barrier, hints = set(), set(), False, None
+            for statement in statements:
+                statement_reads, statement_writes, statement_barrier = parse_tables(statement, catalog, schema)
+                reads |= statement_reads
+                writes |= statement_writes
+                barrier = barrier or statement_barrier
+                statement_hints = parse_hints(statement)
+                if statement_hints is not None:
+                    hints = (hints or []) + statement_hints
+            nodes.append(Node(sql_name, sql_name, None, sql_file[sql_name], reads, writes, hints, barrier))
+        else:
+            for index, statement in enumerate(statements, 1):
+                reads, writes, barrier = parse_tables(statement, catalog, schema)
+                nodes.append(Node(
+                    '{}#{}'.format(sql_name, index), sql_name, index, statement,
+                    reads, writes, parse_hints(statement), barrier
+                ))
+
+    return nodes
+
+
+def build_dag(nodes):
+    """
+    计算节点依赖，结果写入 node.deps (已做传递约简)
+
+    推断规则 (按脚本与语句的原有顺序)，后面的语句依赖前面的语句，当:
+        - 读或写了前面语句写入的表
+        - 写入了前面语句读取的表
+        - 任意一方为屏障语句
+    注释中声明了 @after 的语句，依赖以声明为准
+
+    :params nodes: build_nodes() 的结果
+    """
+    by_id = dict((node.id, node) for node in nodes)
+    position = dict((node.id, i) for i, node in enumerate(nodes))
+
+    deps = {}
+    for j, node in enumerate(nodes):
+        if node.hints is not None:
+            deps[node.id] = set()
+            for hint in node.hints:
+                targets = [hint] if hint in by_id else [other.id for other in nodes if other.sql_name == hint]
+                if len(targets) == 0:
+                    raise DagError("{}: unknown @after target '{}'".format(node.id, hint))
+                deps[node.id].update(target for target in targets if target != node.id)
+            continue
+
+        deps[node.id] = set()
+        for other in nodes[:j]:
+            if (
+                node.barrier or other.barrier or
+                other.writes & (node.reads | node.writes) or
+                other.reads & node.writes
+            ):
+                deps[node.id].add(other.id)
+
+    # 检查环并得到拓扑序
+    order = []
+    state = {}
+
+    def visit(node_id, path):
+        if state.get(node_id) == 'done':
+            return
+        if state.get(node_id) == 'visiting':
+            raise DagError("dependency cycle: {}".format(' -> '.join(path + [node_id])))
+        state[node_id] = 'visiting'
+        for dep in sorted(deps[node_id], key=position.get):
+            visit(dep, path + [node_id])
+        state[node_id] = 'done'
+        order.append(node_id)
+
+    for node in nodes:
+        visit(node.id, [])
+
+    # 传递约简: 去掉可以经由其他依赖间接到达的依赖
+    ancestors = {}
+    for node_id in order:
+        ancestors[node_id] = set()
+        for dep in deps[node_id]:
+            ancestors[node_id] |= ancestors[dep] | {dep}
+
+    for node in nodes:
+        indirect = set()
+        for dep in deps[node.id]:
+            indirect |= ancestors[dep]
+        node.deps = sorted(deps[node.id] - indirect, key=position.get)
+
+    return nodes
+
+
+def format_plan(nodes):
+    """
+    输出 DAG 的文本形式: 每个节点的读写与依赖，以及可并行执行的层级
+    """
+    lines = ["DAG plan ({} nodes):".format(len(nodes))]
+    for node in nodes:
+        lines.append("  [{}]{}".format(node.id, ' (barrier)' if node.barrier else ''))
+        lines.append("      writes: {}".format(', '.join(sorted(node.writes)) or '-'))
+        lines.append("      reads:  {}".format(', '.join(sorted(node.reads)) or '-'))
+        lines.append("      after:  {}{}".format(
+            ', '.join(node.deps) or '-', ' (@after)' if node.hints is not None else ''
+        ))
+
+    by_id = dict((node.id, node) for node in nodes)
+    level = {}
+
+    def get_level(node_id):
+        if node_id not in level:
+            level[node_id] = max([get_level(dep) + 1 for dep in by_id[node_id].deps] or [1])
+        return level[node_id]
+
+    for node in nodes:
+        get_level(node.id)
+
+    lines.append("Levels:")
+    for i in range(1, max(list(level.values()) or [0]) + 1):
+        lines.append("  {}: {}".format(i, ', '.join(node.id for node in nodes if level[node.id] == i)))
+
+    return '\n'.join(lines)
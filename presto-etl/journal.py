@@ -0,0 +1,106 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+class Journal:
+    """
+    presto-etl 执行日志 (checkpoint)
+
+    **Basic**
+
+    使用本地 sqlite 记录每个 job 已经执行完成的语句，job 中断后重新执行时可以跳过已完成的语句。
+    语句的 key 由 sql 名、语句序号、语句内容的 sha256 以及 placeholder 的值计算得出，
+    sql 内容或 placeholder 的值变化后，对应的语句会被视为未执行
+
+    **Usage**
+
+        journal = Journal('~/.presto-etl/journal.db', job_id)
+        key = Journal.statement_key('fully', 1, sql, {'dt': '2019-01-01'})
+        if not journal.is_done(key):
+            ...
+            journal.mark_done(key, 'fully', 1, {'dt': '2019-01-01'})
+    """
+
+    def __init__(self, path, job_id):
+        """
+        :params path: sqlite 文件路径
+        :params job_id: job 标识
+        """
+        self.__job_id = job_id
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.__lock, self.__connection:
+            self.__connection.execute("""
+                CREATE TABLE IF NOT EXISTS finished_statement (
+                    job_id TEXT NOT NULL,
+                    statement_key TEXT NOT NULL,
+                    sql_name TEXT,
+                    statement_index INTEGER,
+                    placeholders TEXT,
+                    finished_at REAL,
+                    PRIMARY KEY (job_id, statement_key)
+                )
+            """)
+
+
+    @staticmethod
+    def statement_key(sql_name, statement_index, sql, placeholders=None):
+        """
+        计算语句的 key
+
+        :params sql_name: sql 名
+        :params statement_index: 语句在脚本中的序号
+        :params sql: 语句内容 (已填充 placeholder)
+        :params placeholders: placeholder 的值 {key: value}
+        """
+        content = json.dumps(
+            [sql_name, statement_index, hashlib.sha256(sql.encode('utf-8')).hexdigest(), placeholders],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+    def is_done(self, statement_key):
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT 1 FROM finished_statement WHERE job_id = ? AND statement_key = ?",
+                (self.__job_id, statement_key)
+            ).fetchone()
+        return row is not None
+
+
+    def mark_done(self, statement_key, sql_name, statement_index, placeholders=None):
+        with self.__lock, self.__connection:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO finished_statement VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    self.__job_id, statement_key, sql_name, statement_index,
+                    json.dumps(placeholders, sort_keys=True, default=str), time.time()
+                )
+            )
+
+
+    def count(self):
+        """
+        job 已完成的语句数
+        """
+        with self.__lock:
+            return self.__connection.execute(
+                "SELECT COUNT(*) FROM finished_statement WHERE job_id = ?", (self.__job_id,)
+            ).fetchone()[0]
+
+
+    def reset(self):
+        """
+        清空 job 的执行记录
+        """
+        with self.__lock, self.__connection:
+            self.__connection.execute("DELETE FROM finished_statement WHERE job_id = ?", (self.__job_id,))
+
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,129 @@
+import re
+
+
+# sql 里的 placeholder: {key}
+PLACEHOLDER = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+
+class PlaceholderError(Exception):
+    pass
+
+
+class PlaceholderTemplate:
+    """
+    预编译的 placeholder sql 模板
+
+    **Basic**
+
+    sql 文本只解析一次，拆分为常量片段与 placeholder 插槽:
+
+        "select * from t where dt = '{dt}' and id = {id}"
+        ==> literals: ["select * from t where dt = '", "' and id = ", ""]
+            slots:    ["dt", "id"]
+
+    每个组合只需按插槽顺序拼接，不再对整个 sql 做逐个 key 的 str.replace
+
+    **Usage**
+
+        template = PlaceholderTemplate(sql)
+        template.check(['dt', 'id'])
+        sql = template.render({'dt': '2019-01-01', 'id': 1})
+    """
+
+    def __init__(self, sql):
+        """
+        :params sql: 带 placeholder 的 sql 文本
+        """
+        self.__literals = []
+        self.__slots = []
+
+        position = 0
+        for match in PLACEHOLDER.finditer(sql):
+            self.__literals.append(sql[position:match.start()])
+            self.__slots.append(match.group(1))
+            position = match.end()
+        self.__literals.append(sql[position:])
+
+
+    @property
+    def keys(self):
+        """
+        sql 里出现的 placeholder (按首次出现的顺序)
+        """
+        keys = []
+        for slot in self.__slots:
+            if slot not in keys:
+                keys.append(slot)
+        return keys
+
+
+    def check(self, declared_keys):
+        """
+        检查 sql 里的 placeholder 与配置的 key 是否一致
+
+        :params declared_keys: placeholder 配置的 key
+        :raise PlaceholderError: sql 里有未配置的 placeholder，或配置的 key 在 sql 里没有用到
+        """
+        undeclared = [key for key in self.keys if key not in declared_keys]
+        unused = [key for key in declared_keys if key not in self.keys]
+
+        errors = []
+        if len(undeclared) != 0:
+            errors.append("undeclared placeholders {}".format(['{' + key + '}' for key in undeclared]))
+        if len(unused) != 0:
+            errors.append("unused placeholder keys {}".format(unused))
+        if len(errors) != 0:
+            raise PlaceholderError(', '.join(errors))
+
+
+    def render(self, fill_dict):
+        """
+        填充 placeholder
+
+        :params fill_dict: {key: value}，value 以 str(value) 填充
+        :return: sql 文本
+        """
+        parts = [self.__literals[0]]
+        for slot, literal in zip(self.__slots, self.__literals[1:]):
+            parts.append(str(fill_dict[slot]))
+            parts.append(literal)
+        return ''.join(parts)
+
+
+class PlaceholderBatch(list):
+    """
+    批量填充的一组 placeholder 值
+
+    填充到 sql 时渲染为以逗号分隔的 sql 常量，可用于 IN (...) 或 UNNEST(ARRAY[...]):
+
+        PlaceholderBatch([1, 2, 3])          ==> 1, 2, 3
+        PlaceholderBatch(['a', "b'c"])       ==> 'a', 'b''c'
+    """
+
+    def __str__(self):
+        return ', '.join(sql_literal(value) for value in self)
+
+
+def sql_literal(value):
+    """
+    将 python 值转为 sql 常量
+    """
+    if value is None:
+        return 'NULL'
+    elif isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    elif isinstance(value, (int, float)):
+        return str(value)
+    else:
+        return "'" + str(value).replace("'", "''") + "'"
+
+
+def chunk(values, size):
+    """
+    将取值按 size 分组
+
+    :params values: 取值列表
+    :params size: 每组的大小
+    :return: [PlaceholderBatch, ...]
+    """
+    return [PlaceholderBatch(values[i:i + size]) for i in range(0, len(values), size)]
@@ -1,18 +1,60 @@
+import io
 import os
+import re
 import sys
 import argparse
-import prestodb
-import requests
+import json
+import hashlib
 import textwrap
-import pandas as pd
+import threading
 import itertools as it
-import coloredlogs, logging
-from sqlalchemy import create_engine
+import contextlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from cache import SqlCache, SqlCacheError, ResultCache
+from sink import open_sink, SINK_FORMATS, SINK_COMPRESSIONS
+from dag import build_nodes, build_dag, format_plan, DagError
+from placeholder import PlaceholderTemplate, PlaceholderError, chunk
+from stats import QueryStatsRecorder, format_stats
+from admission import AdmissionController
+
+# prestodb、requests、coloredlogs 等较重的模块在用到时才导入，
+# --usage / -h / 参数检查不会导入它们，见 test/presto-etl-benchmark.py 的 imports 场景
 
 
 # Create a logger object.
+# 参数检查阶段只使用标准库的 handler，通过检查后由 install_logging() 换成 coloredlogs
 logger = logging.getLogger('presto-etl')
-coloredlogs.install(level='INFO', logger=logger)
+logger.setLevel(logging.INFO)
+_handler = logging.StreamHandler()
+_handler.setFormatter(logging.Formatter('%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s'))
+logger.addHandler(_handler)
+_logging_installed = False
+
+
+def install_logging():
+    """
+    安装 coloredlogs (替换上面的 handler)，同一进程只安装一次
+    """
+    global _logging_installed
+    if not _logging_installed:
+        import coloredlogs
+        coloredlogs.install(level='INFO', logger=logger)
+        _logging_installed = True
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    可以指定输出的 ArgumentParser，-h 与参数错误的信息写入 output (server 模式下为 job 的日志)，
+    output 为 None 时与 argparse.ArgumentParser 一致
+    """
+
+    def __init__(self, output=None, **kwargs):
+        super().__init__(**kwargs)
+        self.output = output
+
+    def _print_message(self, message, file=None):
+        super()._print_message(message, self.output if self.output is not None else file)
 
 
 class PrestoETL:
@@ -34,6 +76,13 @@ class PrestoETL:
             executor.execute()
         ```
     
+    - Embedded:
+        参数以列表传入，输出与日志可以单独指定，server 模式 (server.py) 即以这种方式执行 job:
+        ```
+        executor = PrestoETL(['--presto.host', ..., '--sql.names', 'create', 'fully'], output=stream, logger=logger)
+        executor.execute()
+        ```
+
     - Command:
         执行: python3 presto-etl.py -h 查看参数用法
         特性: 
@@ -61,8 +110,48 @@ class PrestoETL:
     # placeholder为中间变量，具体意义可参考方法 `get_placeholder_config()` 的注释
     OPTIONAL_ARGS = {
         '--placeholder.config': 'placeholder_config',
+        '--placeholder.parallelism': 'placeholder_parallelism',
+        '--placeholder.continue.on.error': 'placeholder_continue_on_error',
+        '--placeholder.batch': 'placeholder_batch',
+        '--placeholder.batch.size': 'placeholder_batch_size',
+        '--sql.cache.dir': 'sql_cache_dir',
+        '--sql.cache.ttl': 'sql_cache_ttl',
+        '--sql.cache.max.size': 'sql_cache_max_size',
+        '--sql.cache.offline': 'sql_cache_offline',
+        '--result.cache.dir': 'result_cache_dir',
+        '--result.cache.ttl': 'result_cache_ttl',
+        '--result.cache.max.size': 'result_cache_max_size',
+        '--sql.fetch.parallelism': 'sql_fetch_parallelism',
+        '--sql.archive.url': 'sql_archive_url',
+        '--result.batch.size': 'result_batch_size',
+        '--result.preview.rows': 'result_preview_rows',
+        '--result.sink.dir': 'result_sink_dir',
+        '--result.sink.format': 'result_sink_format',
+        '--result.sink.compression': 'result_sink_compression',
+        '--dag.parallelism': 'dag_parallelism',
+        '--plan': 'plan',
+        '--presto.engine': 'presto_engine',
+        '--resume': 'resume',
+        '--journal.path': 'journal_path',
+        '--job.id': 'job_id',
+        '--stats.path': 'stats_path',
+        '--stats.prometheus.path': 'stats_prometheus_path',
+        '--admission.high.watermark': 'admission_high_watermark',
+        '--admission.low.watermark': 'admission_low_watermark',
+        '--admission.max.in.flight': 'admission_max_in_flight',
+        '--admission.poll.interval': 'admission_poll_interval',
+        '--admission.max.backoff': 'admission_max_backoff',
     }
 
+    # 执行日志的默认路径
+    DEFAULT_JOURNAL_PATH = '~/.presto-etl/journal.db'
+
+    # 以这些关键字开头的语句视为查询，结果会写入 --result.sink.dir
+    QUERY_KEYWORDS = ('select', 'with', 'values', 'show', 'describe', 'explain', 'table')
+
+    # 修改客户端会话的语句 (SET SESSION / RESET SESSION / USE)，需要同步到工作线程的连接上
+    SESSION_KEYWORDS = ('set', 'reset', 'use')
+
     USAGE = """
         python prestoetl.py <option> [arguments]
 
@@ -105,20 +194,59 @@ class PrestoETL:
             --sql.url.prefix ${sql.url.prefix} \\
             --sql.dir ${sql.dir} \\
             --sql.names ${sql.names}
+
+        job server
+        ----------
+        # 常驻进程，job 共享 HTTP session、sql 缓存与 presto 的 HTTP 连接池
+        python3 presto-etl.py --server --server.port 7878 --server.concurrency 4
+
+        # azkaban 中改为提交到 server，输出与退出码与直接执行一致
+        python3 presto-etl.py --submit --server.port 7878 \\
+            --presto.host 10.10.22.5 \\
+            ... \\
+            --sql.names create fully
     """
 
-    def __init__(self):
+    def __init__(self, argv=None, output=None, logger=None, session=None, sql_cache=None, connection_pool=None):
         """
         初始化时将参数通过 self.__set_args() 绑定到 self.__args 变量上
         同时初始化 session 以作为请求 url 的会话
+
+        :params argv: 参数列表，为 None 时使用 sys.argv[1:]
+        :params output: 执行信息的输出，为 None 时输出到 sys.stdout
+        :params logger: 日志使用的 logger，为 None 时使用模块的 logger
+        :params session: 共享的 requests.Session，为 None 时新建
+        :params sql_cache: 未指定 --sql.cache.dir 时使用的共享 SqlCache
+        :params connection_pool: 共享的 presto HTTP 连接池 (server.PrestoConnectionPool)，为 None 时使用 job 自己的连接
         """
+        self.__argv = argv
+        self.__output = output
+        self.__logger = logger if logger is not None else logging.getLogger('presto-etl')
+        self.__connection_pool = connection_pool
+
         self.__args = self.__set_args()
         self.__check_args()
-
-        self.__session = self.__set_session()
+        install_logging()
+
+        self.__session = self.__set_session() if session is None else session
+        self.__sql_cache = self.__set_sql_cache() or sql_cache
+        self.__result_cache = self.__set_result_cache()
+        self.__journal = None
+        self.__aio_client = None
+        self.__stats_recorder = None
+        self.__admission = None
+        self.__sql_text = {}
         self.__sql_file = {}
         self.__placeholder_config = {}
         self.__placeholder_group = {}
+
+        # 并行执行 placeholder 组合时，每个工作线程持有自己的 presto 连接
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+        # 已执行的会话语句，工作线程的连接使用前按顺序补执行; {cursor: 已执行的会话语句数}
+        self.__session_statements = []
+        self.__session_applied = {}
  
 
     @property
@@ -128,13 +256,22 @@ class PrestoETL:
     @property
     def sql_file(self):
         return self.__sql_file
+
+
+    def __print(self, *values):
+        print(*values, file=self.__output, flush=True)
         
 
     def __set_args(self):
         """
         设置参数选项
         """
-        parser = argparse.ArgumentParser(prog="python3 presto-etl.py", description="This is a python etl script")
+        parser = ArgumentParser(
+            output=self.__output, prog="python3 presto-etl.py",
+            description="This is a python etl script. "
+                        "Run with --server to start a job server, or with --submit to run the job on a job server "
+                        "(see --server -h / --submit -h)"
+        )
 
         # set usage
         parser.add_argument('--usage', action='store_true', dest='usage', default=False, help="show usage")
@@ -148,6 +285,10 @@ class PrestoETL:
         parser.add_argument('--presto.user', action='store', dest='presto_user', help="set presto user")
         parser.add_argument('--presto.catalog', action='store', dest='presto_catalog', help="set presto catalog")
         parser.add_argument('--presto.schema', action='store', dest='presto_schema', help="set presto schema")
+        parser.add_argument(
+            '--presto.engine', action='store', dest='presto_engine', choices=['dbapi', 'asyncio'], default='dbapi',
+            help="set the presto client. (dbapi: presto-python-client, one blocking http session per connection; asyncio: all queries are polled on one event loop with a shared keep-alive connection pool and parallel placeholders and dag nodes run as coroutines, requires aiohttp. default: dbapi)"
+        )
         parser.add_argument(
             '--sql.url.prefix', action='store', dest='sql_url_prefix',
             help="set the git repo url. (route to the system name [e.g. crm, mms, tpos, etc.]) for sql file"
@@ -165,8 +306,130 @@ class PrestoETL:
             '--placeholder.config', action='store', dest='placeholder_config', nargs='*',
             help="set the placeholder config. (the format of this option is <sql.name>:<placeholder.sql.name>. see the annotate of function get_placeholder_config() for more detail to use it)"
         )
+        parser.add_argument(
+            '--placeholder.parallelism', action='store', dest='placeholder_parallelism', type=int, default=1,
+            help="set the number of placeholder combinations executed concurrently, each worker uses its own presto connection. (default: 1)"
+        )
+        parser.add_argument(
+            '--placeholder.continue.on.error', action='store_true', dest='placeholder_continue_on_error', default=False,
+            help="keep executing the remaining placeholder combinations when one fails. (default: fail fast)"
+        )
+        parser.add_argument(
+            '--placeholder.batch', action='store', dest='placeholder_batch', nargs='*',
+            help="mark placeholders as batchable, their values are filled in chunks as a comma separated sql literal list (for IN (...) or UNNEST(ARRAY[...])) instead of one value per query. (the format of this option is <sql.name>:<placeholder.key>[,<placeholder.key>...])"
+        )
+        parser.add_argument(
+            '--placeholder.batch.size', action='store', dest='placeholder_batch_size', type=int, default=100,
+            help="set the number of values filled into a batchable placeholder per query. (default: 100)"
+        )
+        parser.add_argument(
+            '--sql.cache.dir', action='store', dest='sql_cache_dir',
+            help="enable the local sql file cache and set its directory. (e.g. ~/.cache/presto-etl)"
+        )
+        parser.add_argument(
+            '--sql.cache.ttl', action='store', dest='sql_cache_ttl', type=int, default=300,
+            help="set the seconds a cached sql file is used without revalidating it with the remote. (default: 300)"
+        )
+        parser.add_argument(
+            '--sql.cache.max.size', action='store', dest='sql_cache_max_size', type=int, default=64,
+            help="set the max size (MB) of the sql file cache, least recently used files are evicted. (default: 64)"
+        )
+        parser.add_argument(
+            '--sql.cache.offline', action='store_true', dest='sql_cache_offline', default=False,
+            help="read sql files from the cache only, never request the remote"
+        )
+        parser.add_argument(
+            '--result.cache.dir', action='store', dest='result_cache_dir',
+            help="cache the results of placeholder sql in this directory, sql declares its ttl with a '-- @cache.ttl: 1h' comment"
+        )
+        parser.add_argument(
+            '--result.cache.ttl', action='store', dest='result_cache_ttl', type=int, default=0,
+            help="set the result cache ttl in seconds for placeholder sql without a '-- @cache.ttl:' comment, 0 disables caching them. (default: 0)"
+        )
+        parser.add_argument(
+            '--result.cache.max.size', action='store', dest='result_cache_max_size', type=int, default=64,
+            help="set the max size of the result cache in MB. (default: 64)"
+        )
+        parser.add_argument(
+            '--sql.fetch.parallelism', action='store', dest='sql_fetch_parallelism', type=int, default=8,
+            help="set the number of sql files fetched concurrently. (default: 8)"
+        )
+        parser.add_argument(
+            '--sql.archive.url', action='store', dest='sql_archive_url',
+            help="fetch all sql files in one request from an archive (zip or tar.gz) of the sql repo, the files are matched by <sql.dir>/<sql.name>.sql. (e.g. http://gitlab.company.com/group/repo/-/archive/branch/repo-branch.zip?path=sql/etl/dwh/ods/some_system)"
+        )
+        parser.add_argument(
+            '--result.batch.size', action='store', dest='result_batch_size', type=int, default=1000,
+            help="set the number of rows fetched per batch when consuming results. (default: 1000)"
+        )
+        parser.add_argument(
+            '--result.preview.rows', action='store', dest='result_preview_rows', type=int, default=10,
+            help="set the number of result rows printed to the log. (default: 10)"
+        )
+        parser.add_argument(
+            '--result.sink.dir', action='store', dest='result_sink_dir',
+            help="write the rows of query statements (select, with, show, etc.) to files under this directory"
+        )
+        parser.add_argument(
+            '--result.sink.format', action='store', dest='result_sink_format', choices=SINK_FORMATS, default='csv',
+            help="set the result file format. (parquet requires pyarrow, default: csv)"
+        )
+        parser.add_argument(
+            '--result.sink.compression', action='store', dest='result_sink_compression', choices=SINK_COMPRESSIONS,
+            default='gzip', help="set the result file compression. (zstd requires zstandard, default: gzip)"
+        )
+        parser.add_argument(
+            '--dag.parallelism', action='store', dest='dag_parallelism', type=int,
+            help="schedule the statements of all --sql.names by their table dependencies and run independent statements concurrently, at most N at a time. (use '-- @after: <sql.name>[#<n>], ...' in sql comments to declare dependencies explicitly)"
+        )
+        parser.add_argument(
+            '--plan', action='store_true', dest='plan', default=False,
+            help="print the statement dependency graph (DAG) and exit without executing"
+        )
+        parser.add_argument(
+            '--resume', action='store_true', dest='resume', default=False,
+            help="record finished statements in the journal and skip the ones finished by the previous interrupted run of the same job. (the journal of a job is cleared once it succeeds)"
+        )
+        parser.add_argument(
+            '--journal.path', action='store', dest='journal_path',
+            help="record finished statements in this sqlite file. (default with --resume: {})".format(
+                PrestoETL.DEFAULT_JOURNAL_PATH
+            )
+        )
+        parser.add_argument(
+            '--job.id', action='store', dest='job_id',
+            help="set the job identity in the journal. (default: a hash of the presto, sql and placeholder arguments)"
+        )
+        parser.add_argument(
+            '--stats.path', action='store', dest='stats_path',
+            help="append the query id and final stats (wall, queued and cpu time, processed rows and bytes, peak memory) of every statement to this json lines file"
+        )
+        parser.add_argument(
+            '--stats.prometheus.path', action='store', dest='stats_prometheus_path',
+            help="write the statement stats to this prometheus textfile (for the node_exporter textfile collector) when the job ends"
+        )
+        parser.add_argument(
+            '--admission.high.watermark', action='store', dest='admission_high_watermark', type=int,
+            help="enable admission control: pause submitting and halve the in-flight statements when the coordinator has this many queued queries"
+        )
+        parser.add_argument(
+            '--admission.low.watermark', action='store', dest='admission_low_watermark', type=int,
+            help="grow the in-flight statements by one when the coordinator has at most this many queued queries. (default: half of the high watermark)"
+        )
+        parser.add_argument(
+            '--admission.max.in.flight', action='store', dest='admission_max_in_flight', type=int,
+            help="set the max in-flight statements under admission control. (default: the placeholder or dag parallelism)"
+        )
+        parser.add_argument(
+            '--admission.poll.interval', action='store', dest='admission_poll_interval', type=float, default=2.0,
+            help="set the seconds between two polls of the coordinator /v1/cluster endpoint. (default: 2)"
+        )
+        parser.add_argument(
+            '--admission.max.backoff', action='store', dest='admission_max_backoff', type=float, default=30.0,
+            help="set the max seconds of one jittered backoff while the coordinator is overloaded. (default: 30)"
+        )
 
-        args = parser.parse_args()
+        args = parser.parse_args(self.__argv)
 
         # set args_dict
         args_key = list(map(lambda kv: kv[0], args._get_kwargs()))
@@ -189,98 +452,732 @@ class PrestoETL:
         # check necesary arguments
         for necessary_arg in PrestoETL.NECESSARY_ARGS.values():
             if self.__args_dict[necessary_arg] is None:
-                logger.error(
+                self.__logger.error(
                     "Please provide all necessary arguments: {}".format(str(list(PrestoETL.NECESSARY_ARGS.keys())))
                 )
                 sys.exit(1)
 
+        # check placeholder parallelism
+        if self.__args.placeholder_parallelism < 1:
+            self.__logger.error("--placeholder.parallelism must be a positive integer")
+            sys.exit(1)
+
+        # check sql cache
+        if self.__args.sql_cache_offline is True and self.__args.sql_cache_dir is None:
+            self.__logger.error("--sql.cache.offline requires --sql.cache.dir")
+            sys.exit(1)
+
+        # check result cache
+        if self.__args.result_cache_ttl < 0 or self.__args.result_cache_max_size < 1:
+            self.__logger.error("--result.cache.ttl must not be negative and --result.cache.max.size must be positive")
+            sys.exit(1)
+
+        # check sql fetch parallelism
+        if self.__args.sql_fetch_parallelism < 1:
+            self.__logger.error("--sql.fetch.parallelism must be a positive integer")
+            sys.exit(1)
+
+        # check dag parallelism
+        if self.__args.dag_parallelism is not None and self.__args.dag_parallelism < 1:
+            self.__logger.error("--dag.parallelism must be a positive integer")
+            sys.exit(1)
+
+        # check admission control
+        if self.__args.admission_high_watermark is not None:
+            if self.__args.admission_low_watermark is None:
+                self.__args.admission_low_watermark = self.__args.admission_high_watermark // 2
+            if not 0 <= self.__args.admission_low_watermark < self.__args.admission_high_watermark:
+                self.__logger.error("--admission.low.watermark must be in [0, --admission.high.watermark)")
+                sys.exit(1)
+            if self.__args.admission_max_in_flight is not None and self.__args.admission_max_in_flight < 1:
+                self.__logger.error("--admission.max.in.flight must be a positive integer")
+                sys.exit(1)
+            if self.__args.admission_poll_interval <= 0 or self.__args.admission_max_backoff <= 0:
+                self.__logger.error("--admission.poll.interval and --admission.max.backoff must be positive")
+                sys.exit(1)
+
+        # check result consuming
+        if self.__args.result_batch_size < 1 or self.__args.result_preview_rows < 0:
+            self.__logger.error("--result.batch.size must be positive and --result.preview.rows must not be negative")
+            sys.exit(1)
+
+        # check optional dependencies of presto engine and result sink
+        dependencies = []
+        if self.__args.presto_engine == 'asyncio':
+            dependencies.append(('--presto.engine', 'aiohttp'))
+        if self.__args.result_sink_dir is not None:
+            if self.__args.result_sink_format == 'parquet':
+                dependencies.append(('--result.sink.format', 'pyarrow'))
+            elif self.__args.result_sink_compression == 'zstd':
+                dependencies.append(('--result.sink.compression', 'zstandard'))
+        for option, dependency in dependencies:
+            try:
+                __import__(dependency)
+            except ImportError:
+                self.__logger.error("{} requires {}, please install it first".format(option, dependency))
+                sys.exit(1)
+
+        # check placeholder config
+        self.__placeholder_sql_names = self.__parse_placeholder_config()
+        self.__placeholder_batch = self.__parse_placeholder_batch()
+
+
+    def __parse_placeholder_batch(self):
+        """
+        解析 --placeholder.batch 参数
+
+        :return: {sql_name: [placeholder_key, ...]}
+        """
+        if self.__args.placeholder_batch_size < 1:
+            self.__logger.error("--placeholder.batch.size must be a positive integer")
+            sys.exit(1)
+
+        placeholder_batch = {}
+        if self.__args.placeholder_batch is not None:
+            for pb in self.__args.placeholder_batch:
+                pb_list = pb.split(':')
+
+                # 判断参数是否正确
+                if len(pb_list) < 2 or pb_list[0] not in [pc[0] for pc in self.__placeholder_sql_names]:
+                    self.__logger.error(
+                        "--placeholder.batch error. the args form must be <sql_name>:<placeholder_key>[,<placeholder_key>...], and <sql_name> must be configured in --placeholder.config"
+                    )
+                    sys.exit(1)
+
+                placeholder_batch.setdefault(pb_list[0], []).extend(
+                    key.strip() for key in pb_list[1].split(',') if key.strip() != ''
+                )
+
+        return placeholder_batch
+
+
+    def __parse_placeholder_config(self):
+        """
+        解析 --placeholder.config 参数
+
+        :return: [(sql_name, placeholder_sql_name), ...]
+        """
+        placeholder_sql_names = []
+        if self.__args.placeholder_config is not None:
+            for pc in self.__args.placeholder_config:
+                pc_list = pc.split(':')
+
+                # 判断参数是否正确
+                if len(pc_list) < 2:
+                    self.__logger.error("--placeholder.config error. the args form must be <sql_name>:<placeholder_sql_name>")
+                    sys.exit(0)
+
+                # 被填充的 sql 必须在 --sql.names 中，否则没有可填充的脚本
+                if pc_list[0] not in (self.__args.sql_names or []):
+                    self.__logger.error("--placeholder.config error. {}.sql is not in --sql.names".format(pc_list[0]))
+                    sys.exit(1)
+
+                placeholder_sql_names.append((pc_list[0], pc_list[1]))
+
+        return placeholder_sql_names
+
 
     def __set_session(self):
         """
         设置session
         """
+        import requests
+
         session = requests.session()
-        request_retry = requests.adapters.HTTPAdapter(max_retries=3)
+        request_retry = requests.adapters.HTTPAdapter(
+            max_retries=3, pool_maxsize=max(self.__args.sql_fetch_parallelism, 10)
+        )
         session.mount('https://', request_retry)
         session.mount('http://', request_retry)
 
         return session
 
 
+    def __set_sql_cache(self):
+        """
+        设置 sql 脚本缓存，未指定 --sql.cache.dir 时不启用
+        """
+        if self.__args.sql_cache_dir is None:
+            return None
+
+        return SqlCache(
+            cache_dir=os.path.expanduser(self.__args.sql_cache_dir),
+            ttl=self.__args.sql_cache_ttl,
+            max_size=self.__args.sql_cache_max_size * 1024 * 1024,
+            offline=self.__args.sql_cache_offline
+        )
+
+
+    def __set_result_cache(self):
+        """
+        设置查询结果缓存，未指定 --result.cache.dir 时不启用
+        """
+        if self.__args.result_cache_dir is None:
+            return None
+
+        return ResultCache(
+            cache_dir=os.path.expanduser(self.__args.result_cache_dir),
+            default_ttl=self.__args.result_cache_ttl,
+            max_size=self.__args.result_cache_max_size * 1024 * 1024
+        )
+
+
+    def __set_admission(self):
+        """
+        设置准入控制，未指定 --admission.high.watermark 时不启用
+        """
+        if self.__args.admission_high_watermark is None:
+            return None
+
+        cluster_url = 'http://{}:{}/v1/cluster'.format(self.__args.presto_host, self.__args.presto_port)
+
+        def fetch_cluster():
+            response = self.__session.get(cluster_url, headers={'X-Presto-User': self.__args.presto_user}, timeout=5)
+            response.raise_for_status()
+            return response.json()
+
+        return AdmissionController(
+            fetch_cluster,
+            high_watermark=self.__args.admission_high_watermark,
+            low_watermark=self.__args.admission_low_watermark,
+            max_in_flight=self.__args.admission_max_in_flight or max(
+                self.__args.placeholder_parallelism, self.__args.dag_parallelism or 1
+            ),
+            poll_interval=self.__args.admission_poll_interval,
+            max_backoff=self.__args.admission_max_backoff,
+            logger=self.__logger
+        )
+
+
+    def __admit(self):
+        """
+        语句执行期间占用的准入名额，未启用准入控制时不做限制
+        """
+        return self.__admission.slot() if self.__admission is not None else contextlib.nullcontext()
+
+
+    @contextlib.asynccontextmanager
+    async def __admit_async(self):
+        """
+        协程中使用的 __admit()
+        """
+        if self.__admission is None:
+            yield
+        else:
+            async with self.__admission.async_slot():
+                yield
+
+
+    def __set_journal(self):
+        """
+        设置执行日志，未指定 --resume 或 --journal.path 时不启用
+        不是 --resume 时，job 之前的执行记录会被清空
+        """
+        if self.__args.resume is False and self.__args.journal_path is None:
+            return None
+
+        path = os.path.expanduser(self.__args.journal_path or PrestoETL.DEFAULT_JOURNAL_PATH)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        job_id = self.__args.job_id
+        if job_id is None:
+            job_id = hashlib.sha256(json.dumps([
+                self.__args.presto_host, self.__args.presto_port, self.__args.presto_catalog,
+                self.__args.presto_schema, self.__args.sql_url_prefix, self.__args.sql_dir,
+                self.__args.sql_names, self.__args.placeholder_config, self.__args.placeholder_batch,
+                self.__args.placeholder_batch_size
+            ]).encode('utf-8')).hexdigest()
+
+        from journal import Journal
+
+        journal = Journal(path, job_id)
+        if self.__args.resume is False:
+            journal.reset()
+        else:
+            self.__logger.info("resume job {}: {} statements finished before".format(job_id[:12], journal.count()))
+
+        return journal
+
+
     def __get_presto_connection(self):
-        return prestodb.dbapi.connect(
-            host=self.__args.presto_host,
-            port=self.__args.presto_port,
-            user=self.__args.presto_user,
-            catalog=self.__args.presto_catalog,
-            schema=self.__args.presto_schema
-        )
-
-
-    def __get_presto_engine(self):
-        return create_engine('presto://{user}@{host}:{port}/{catalog}/{schema}'.format(
-            user=self.__args.presto_user,
-            host=self.__args.presto_host,
-            port=self.__args.presto_port,
-            catalog=self.__args.presto_catalog,
-            schema=self.__args.presto_schema
-        ))
+        """
+        新建 presto 连接
+        连接池 (server 模式) 提供的连接共享 server 的 HTTP 连接池，由 server 统一关闭，不记录在 self.__connections 中
+        """
+        if self.__connection_pool is not None:
+            return self.__connection_pool.connect(
+                engine=self.__args.presto_engine,
+                host=self.__args.presto_host,
+                port=self.__args.presto_port,
+                user=self.__args.presto_user,
+                catalog=self.__args.presto_catalog,
+                schema=self.__args.presto_schema
+            )
+
+        if self.__args.presto_engine == 'asyncio':
+            connection = self.__get_aio_client().connect()
+        else:
+            import prestodb
+
+            connection = prestodb.dbapi.connect(
+                host=self.__args.presto_host,
+                port=self.__args.presto_port,
+                user=self.__args.presto_user,
+                catalog=self.__args.presto_catalog,
+                schema=self.__args.presto_schema
+            )
+
+        with self.__connections_lock:
+            self.__connections.append(connection)
+
+        return connection
+
+
+    def __get_aio_client(self):
+        """
+        获取 asyncio 客户端，所有连接共享同一个事件循环与连接池
+        """
+        with self.__connections_lock:
+            if self.__aio_client is None:
+                from aio import AsyncPrestoClient
+                self.__aio_client = AsyncPrestoClient(
+                    host=self.__args.presto_host,
+                    port=self.__args.presto_port,
+                    user=self.__args.presto_user,
+                    catalog=self.__args.presto_catalog,
+                    schema=self.__args.presto_schema
+                )
+
+        return self.__aio_client
+
+
+    def __get_thread_cursor(self):
+        """
+        获取当前线程专属的 presto cursor，线程内首次调用时创建连接
+
+        其他连接上已执行的会话语句 (SET SESSION / USE) 会先在该连接上按顺序补执行，
+        保证 DAG 与并行 placeholder 的工作线程与主连接的会话一致
+        """
+        if not hasattr(self.__local, 'cursor'):
+            self.__local.cursor = self.__get_presto_connection().cursor()
+
+        for sql in self.__pending_session_statements(self.__local.cursor):
+            self.__logger.info("replay session statement on {}: {}".format(threading.current_thread().name, sql))
+            with self.__admit():
+                self.__local.cursor.execute(sql)
+                self.__local.cursor.fetchall()
+
+        return self.__local.cursor
+
+
+    @contextlib.asynccontextmanager
+    async def __borrow_cursor(self, idle):
+        """
+        协程中获取空闲的 presto cursor (没有时新建连接)，用完后放回 idle
+        与 __get_thread_cursor() 一样，使用前先补执行其他连接上已执行的会话语句
+
+        :params idle: 空闲的 aio.AsyncPrestoCursor 列表
+        """
+        presto_cursor = idle.pop() if len(idle) != 0 else self.__get_presto_connection().cursor()
+        try:
+            for sql in self.__pending_session_statements(presto_cursor):
+                self.__logger.info("replay session statement: {}".format(sql))
+                async with self.__admit_async():
+                    await presto_cursor.execute_async(sql)
+                    await presto_cursor.fetchall_async()
+            yield presto_cursor
+        finally:
+            idle.append(presto_cursor)
+
+
+    def __pending_session_statements(self, presto_cursor):
+        """
+        获取 presto_cursor 的连接上还没有执行过的会话语句
+        """
+        with self.__connections_lock:
+            applied = self.__session_applied.get(presto_cursor, 0)
+            self.__session_applied[presto_cursor] = len(self.__session_statements)
+            return self.__session_statements[applied:]
+
+
+    def __record_session_statement(self, presto_cursor, sql):
+        """
+        记录执行成功的会话语句，语句所在的连接不再补执行
+        """
+        with self.__connections_lock:
+            self.__session_statements.append(sql)
+            self.__session_applied[presto_cursor] = len(self.__session_statements)
+
+
+    def __close_connections(self):
+        """
+        关闭主连接与工作线程新建的 presto 连接 (不包括连接池提供的连接)
+        """
+        with self.__connections_lock:
+            for connection in self.__connections:
+                connection.close()
+            self.__connections = []
+
+            if self.__aio_client is not None:
+                self.__aio_client.close()
+                self.__aio_client = None
 
 
     def get_sql(self, sql_name: str):
         """
         获取 sql_name 对应的 sql 脚本内容
+        同一个脚本在一次执行中只请求一次；启用 --sql.cache.dir 时通过本地缓存获取
 
         :params sql_name: sql 脚本名
         :return response.text: 请求 url 返回的 sql 文本
         """
-        sql_url = "{}/{}/{}.sql".format(
-            self.__args.sql_url_prefix,
-            self.__args.sql_dir,
-            sql_name
-        )
-        response = self.__session.get(sql_url)
-        if response.status_code == 200:
-            return response.text.strip('\n').strip()
+        sql_url = self.__get_sql_url(sql_name)
+        if sql_url in self.__sql_text:
+            return self.__sql_text[sql_url]
+
+        if self.__sql_cache is not None:
+            try:
+                text = self.__sql_cache.get(self.__session, sql_url).decode('utf-8')
+            except SqlCacheError as e:
+                self.__logger.error(str(e))
+                sys.exit(1)
         else:
-            logger.error("{sql_url}: {status_code}, {reason}".format(
-                    sql_url=sql_url, status_code=response.status_code, reason=response.reason
-                ))
-            sys.exit(1)
+            response = self.__session.get(sql_url)
+            if response.status_code == 200:
+                text = response.text
+            else:
+                self.__logger.error("{sql_url}: {status_code}, {reason}".format(
+                        sql_url=sql_url, status_code=response.status_code, reason=response.reason
+                    ))
+                sys.exit(1)
+
+        self.__sql_text[sql_url] = text.strip('\n').strip()
+        return self.__sql_text[sql_url]
+
+
+    def __get_sql_url(self, sql_name):
+        return "{}/{}/{}.sql".format(self.__args.sql_url_prefix, self.__args.sql_dir, sql_name)
+
+
+    def load_sql_archive(self, sql_names):
+        """
+        通过一次请求获取 --sql.archive.url 指定的压缩包 (zip 或 tar.gz)，在内存中解压，
+        将 <sql.dir>/<sql_name>.sql 的内容放入 get_sql 的缓存
+
+        :params sql_names: 需要的 sql 脚本名
+        :return: 压缩包里没有找到的 sql 脚本名
+        """
+        archive_url = self.__args.sql_archive_url
+        if self.__sql_cache is not None:
+            try:
+                content = self.__sql_cache.get(self.__session, archive_url)
+            except SqlCacheError as e:
+                self.__logger.error(str(e))
+                sys.exit(1)
+        else:
+            response = self.__session.get(archive_url)
+            if response.status_code != 200:
+                self.__logger.error("{sql_url}: {status_code}, {reason}".format(
+                        sql_url=archive_url, status_code=response.status_code, reason=response.reason
+                    ))
+                sys.exit(1)
+            content = response.content
+
+        # {'<sql.dir>/<sql_name>.sql': sql_name}，按路径后缀匹配压缩包内的文件
+        suffixes = dict(('{}/{}.sql'.format(self.__args.sql_dir, sql_name), sql_name) for sql_name in sql_names)
+        found = {}
+
+        def match(member_name, read):
+            for suffix, sql_name in suffixes.items():
+                if member_name == suffix or member_name.endswith('/' + suffix):
+                    found[sql_name] = read().decode('utf-8')
+
+        if content[:2] == b'PK':
+            import zipfile
+            with zipfile.ZipFile(io.BytesIO(content)) as archive:
+                for member in archive.infolist():
+                    match(member.filename, lambda: archive.read(member))
+        else:
+            import tarfile
+            with tarfile.open(fileobj=io.BytesIO(content), mode='r:*') as archive:
+                for member in archive.getmembers():
+                    if member.isfile():
+                        match(member.name, lambda: archive.extractfile(member).read())
+
+        for sql_name, text in found.items():
+            self.__sql_text[self.__get_sql_url(sql_name)] = text.strip('\n').strip()
+
+        return [sql_name for sql_name in sql_names if sql_name not in found]
 
 
     def get_sql_file(self):
         """
         获取 self.__sql_file<dict>
-        
+        --sql.names 与 --placeholder.config 用到的所有 sql 脚本会在这里一次性并发获取
+
         .. note:
             self.__sql_file 为 dict 类型，格式为 {sql_name: sql_text}
         """
-        print("Following sql file will be executed: " + str(list(map(lambda x: x + '.sql', self.__args.sql_names))))
+        self.__print("Following sql file will be executed: " + str(list(map(lambda x: x + '.sql', self.__args.sql_names))))
+
+        # 需要获取的脚本: 执行的脚本 + placeholder 脚本 (去重并保持顺序)
+        sql_names = []
+        for sql_name in self.__args.sql_names + [pc[1] for pc in self.__placeholder_sql_names]:
+            if sql_name not in sql_names:
+                sql_names.append(sql_name)
+
+        if self.__args.sql_archive_url is not None:
+            sql_names = self.load_sql_archive(sql_names)
+            if len(sql_names) != 0:
+                self.__logger.warning("Following sql file not found in archive, fetch them one by one: {}".format(
+                    str(list(map(lambda x: x + '.sql', sql_names)))
+                ))
+
+        parallelism = min(self.__args.sql_fetch_parallelism, max(len(sql_names), 1))
+        if parallelism == 1:
+            for sql_name in sql_names:
+                self.get_sql(sql_name)
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                for _ in executor.map(self.get_sql, sql_names):
+                    pass
+
         for sql_name in self.__args.sql_names:
             self.__sql_file[sql_name] = self.get_sql(sql_name)
 
 
-    def exec_sql(self, presto_cursor, sql):
+    def exec_sql(self, presto_cursor, sql, tag=None, name=None, first_index=1, sql_name=None, placeholders=None):
         """
         执行 sql
 
+        结果通过 fetchmany 按 --result.batch.size 分批读取，日志里只输出前 --result.preview.rows 行以及行数/字节数，
+        指定 --result.sink.dir 时查询语句的结果会分批写入 <result.sink.dir>/<name>-<语句序号>.<format>
+
         :params presto_cursor: prestodb.dbapi.connection.cursor
         :params sql: sql text
+        :params tag: 输出前缀，并行执行时用于区分不同的 placeholder 组合
+        :params name: 结果文件名前缀，一般为 sql 名 (placeholder 组合为 <sql 名>-<组合序号>)
+        :params first_index: 第一条语句的序号，sql 为脚本中的部分语句时使用
+        :params sql_name: sql 名，用于执行日志，默认与 name 相同
+        :params placeholders: 填充的 placeholder 值，用于执行日志
         """
+        prefix = '' if tag is None else '[{}] '.format(tag)
+        for statement_index, sql, statement_key, sink_path in self.__iter_statements(
+            sql, prefix, name, first_index, sql_name, placeholders
+        ):
+            try:
+                with self.__admit():
+                    presto_cursor.execute(sql)
+                    results = self.consume_results(presto_cursor, sink_path)
+            except Exception as e:
+                self.record_stats(presto_cursor, sql_name or name, statement_index, placeholders, error=e)
+                raise
+
+            self.__finish_statement(
+                presto_cursor, sql, prefix, results, statement_index, statement_key, sql_name or name, placeholders
+            )
+
+
+    async def exec_sql_async(self, presto_cursor, sql, tag=None, name=None, first_index=1, sql_name=None,
+                             placeholders=None):
+        """
+        exec_sql() 的协程版本，--presto.engine asyncio 时在事件循环中并发执行 DAG 节点与 placeholder 组合
+
+        :params presto_cursor: aio.AsyncPrestoCursor
+        """
+        prefix = '' if tag is None else '[{}] '.format(tag)
+        for statement_index, sql, statement_key, sink_path in self.__iter_statements(
+            sql, prefix, name, first_index, sql_name, placeholders
+        ):
+            try:
+                async with self.__admit_async():
+                    await presto_cursor.execute_async(sql)
+                    results = await self.consume_results_async(presto_cursor, sink_path)
+            except Exception as e:
+                self.record_stats(presto_cursor, sql_name or name, statement_index, placeholders, error=e)
+                raise
+
+            self.__finish_statement(
+                presto_cursor, sql, prefix, results, statement_index, statement_key, sql_name or name, placeholders
+            )
+
+
+    def __iter_statements(self, sql, prefix, name, first_index, sql_name, placeholders):
+        """
+        按 ';' 拆分语句，跳过执行日志中已完成的语句
+
+        会话语句 (set, reset, use) 不写入执行日志，--resume 时总是重新执行，之后的语句才会在正确的会话中执行
+
+        :return: 生成 (语句序号, 语句, 执行日志的 key, 结果文件路径) 的 generator
+        """
+        statement_index = first_index - 1
         for sql in sql.split(';'):
             sql = sql.strip('\n').strip()
             if sql != '':
-                print("Execute sql:")
-                print(sql)
-                presto_cursor.execute(sql)
-                print("Results: " + str(presto_cursor.fetchall()))
-                print("\n" + "="*100)
-            else:
-                pass
+                statement_index += 1
 
-    
-    def get_placeholder_config(self, presto_engine):
+                statement_key = None
+                if self.__journal is not None and not self.is_session_statement(sql):
+                    statement_key = self.__journal.statement_key(sql_name or name, statement_index, sql, placeholders)
+                    if self.__journal.is_done(statement_key):
+                        self.__print(prefix + "Skip finished sql:\n" + sql + "\n" + "\n" + "="*100)
+                        continue
+
+                sink_path = None
+                if self.__args.result_sink_dir is not None and self.is_query(sql):
+                    sink_path = os.path.join(
+                        self.__args.result_sink_dir, '{}-{}'.format(name or 'result', statement_index)
+                    )
+
+                yield statement_index, sql, statement_key, sink_path
+
+
+    def __finish_statement(self, presto_cursor, sql, prefix, results, statement_index, statement_key, sql_name,
+                           placeholders):
+        """
+        语句执行成功后记录统计、输出执行信息并写入执行日志
+
+        :params results: consume_results() 的返回值
+        """
+        preview, row_count, byte_count = results
+        stats = self.record_stats(presto_cursor, sql_name, statement_index, placeholders)
+
+        # placeholder 组合里的会话语句只属于该组合，每个组合都会自己执行
+        if placeholders is None and self.is_session_statement(sql):
+            self.__record_session_statement(presto_cursor, sql)
+
+        summary = "{} rows, {} bytes".format(row_count, byte_count)
+        if row_count > len(preview):
+            summary = "showing {} of {}".format(len(preview), summary)
+
+        # 一次性输出，避免并行执行时多个线程的输出交错
+        self.__print(
+            prefix + "Execute sql:\n" + sql + "\n" +
+            prefix + "Results: " + str(preview) + " (" + summary + ")\n" +
+            prefix + "Stats: " + format_stats(stats) + "\n" +
+            "\n" + "="*100
+        )
+
+        if statement_key is not None:
+            self.__journal.mark_done(statement_key, sql_name, statement_index, placeholders)
+
+
+    def record_stats(self, presto_cursor, sql_name, statement_index, placeholders=None, error=None):
+        """
+        记录语句的 presto 查询统计 (--stats.path, --stats.prometheus.path)
+
+        :return: 统计记录 (dict)
+        """
+        if self.__stats_recorder is None:
+            self.__stats_recorder = QueryStatsRecorder(
+                jsonl_path=self.__args.stats_path, prometheus_path=self.__args.stats_prometheus_path
+            )
+
+        return self.__stats_recorder.record(
+            getattr(presto_cursor, 'stats', None), self.__args.sql_dir, sql_name, statement_index, placeholders, error
+        )
+
+
+    def consume_results(self, presto_cursor, sink_path=None):
+        """
+        分批读取 presto_cursor 的结果
+
+        :params presto_cursor: 已执行语句的 prestodb.dbapi.connection.cursor
+        :params sink_path: 结果文件路径 (不带后缀)，为 None 时不写文件
+        :return: (前 --result.preview.rows 行, 总行数, 总字节数)
+        """
+        consumer = self.__result_consumer(presto_cursor, sink_path)
+        next(consumer)
+        try:
+            while True:
+                consumer.send(presto_cursor.fetchmany(self.__args.result_batch_size))
+        except StopIteration as e:
+            return e.value
+        finally:
+            consumer.close()
+
+
+    async def consume_results_async(self, presto_cursor, sink_path=None):
+        """
+        consume_results() 的协程版本
+
+        :params presto_cursor: 已执行语句的 aio.AsyncPrestoCursor
+        """
+        consumer = self.__result_consumer(presto_cursor, sink_path)
+        next(consumer)
+        try:
+            while True:
+                consumer.send(await presto_cursor.fetchmany_async(self.__args.result_batch_size))
+        except StopIteration as e:
+            return e.value
+        finally:
+            consumer.close()
+
+
+    def __result_consumer(self, presto_cursor, sink_path):
+        """
+        处理分批结果的 generator: 通过 send() 依次传入每批结果，传入空的一批时结束，
+        返回值 (StopIteration.value) 为 (前 --result.preview.rows 行, 总行数, 总字节数)
+        """
+        preview = []
+        row_count = 0
+        byte_count = 0
+        sink = None
+
+        try:
+            rows = yield
+
+            # 列信息在取到第一批结果后才确定，结果为空时也会写出只有列名的文件
+            if sink_path is not None and presto_cursor.description is not None:
+                os.makedirs(os.path.dirname(sink_path) or '.', exist_ok=True)
+                sink = open_sink(
+                    sink_path,
+                    self.__args.result_sink_format,
+                    self.__args.result_sink_compression,
+                    presto_cursor.description
+                )
+
+            while len(rows) != 0:
+                if sink is not None:
+                    sink.write(rows)
+
+                if len(preview) < self.__args.result_preview_rows:
+                    preview.extend(rows[:self.__args.result_preview_rows - len(preview)])
+                row_count += len(rows)
+                # 字节数按值的字符串长度估算
+                byte_count += sum(len(str(value)) for row in rows for value in row)
+
+                rows = yield
+        finally:
+            if sink is not None:
+                sink.close()
+
+        if sink is not None:
+            self.__logger.info("{} rows written to {}".format(row_count, sink.path))
+
+        return preview, row_count, byte_count
+
+
+    def is_query(self, sql):
+        """
+        判断语句是否为查询 (跳过开头的注释)
+        """
+        return self.__first_keyword(sql) in PrestoETL.QUERY_KEYWORDS
+
+
+    def is_session_statement(self, sql):
+        """
+        判断语句是否修改客户端会话 (SET SESSION / RESET SESSION / USE)
+        """
+        return self.__first_keyword(sql) in PrestoETL.SESSION_KEYWORDS
+
+
+    def __first_keyword(self, sql):
+        sql = re.sub(r'^(\s*(--[^\n]*(\n|$)|/\*.*?\*/))*', '', sql, flags=re.S).lstrip('( \n\t')
+        return sql.split(None, 1)[0].lower() if sql != '' else None
+
+
+    def get_placeholder_config(self, presto_connection):
         """
         获取 placeholder 填充配置
         在脚本选项中，--placeholder.config 的参数格式应为 ==> 被填充的sql名:获取填充内容的sql名
@@ -308,105 +1205,572 @@ class PrestoETL:
         形成的组合就是: ['1', 'tom'], ['2', 'tom']
 
         里面的值分别填充到 fully.sql 里的 {times}, {names}, 则 fully.sql 会被执行 2 次
-        """
 
-        if self.__args.placeholder_config is not None:
+        获取填充内容的 sql 与主语句使用同一个 presto 连接，有多个时各自使用一个 cursor 并发执行
 
-            for pc in self.__args.placeholder_config:
-                pc_list = pc.split(':')
+        :params presto_connection: presto 连接
+        """
+        if len(self.__placeholder_sql_names) == 0:
+            return
 
-                # 判断参数是否正确
-                if len(pc_list) < 2:
-                    logger.error("--placeholder.config error. the args form must be <sql_name>:<placeholder_sql_name>")
-                    sys.exit(0)
-                
-                sql_name = pc_list[0]
-                placeholder_sql_name = pc_list[1]
+        placeholder_sql_names = list(dict.fromkeys(name for _, name in self.__placeholder_sql_names))
+        with ThreadPoolExecutor(max_workers=len(placeholder_sql_names)) as executor:
+            futures = {
+                name: executor.submit(self.query_placeholder_values, presto_connection, name)
+                for name in placeholder_sql_names
+            }
+            placeholder_values = {name: future.result() for name, future in futures.items()}
+
+        for sql_name, placeholder_sql_name in self.__placeholder_sql_names:
+            self.__placeholder_config.setdefault(sql_name, {}).update(placeholder_values[placeholder_sql_name])
 
-                placeholder_key_values = pd.read_sql(
-                    sql=self.get_sql(placeholder_sql_name).strip(';'),
-                    con=presto_engine.connect()
-                ).to_dict(orient='records')[0]
 
-                if sql_name not in self.__placeholder_config.keys():
-                    self.__placeholder_config[sql_name] = placeholder_key_values
-                else:
-                    self.__placeholder_config[sql_name].update(placeholder_key_values)
+    def query_placeholder_values(self, presto_connection, placeholder_sql_name):
+        """
+        执行获取填充内容的 sql，取第一行，array 类型的列直接解码为 list
+        启用 --result.cache.dir 时，ttl 内相同的 sql 直接使用缓存的结果
 
+        :params presto_connection: presto 连接
+        :params placeholder_sql_name: 获取填充内容的 sql 名
+        :return: {key: [value, ...]}
+        """
+        sql = self.get_sql(placeholder_sql_name).strip(';')
+
+        cache_key, cached = None, None
+        if self.__result_cache is not None:
+            cache_key = ResultCache.key(
+                sql, self.__args.presto_host, self.__args.presto_port,
+                self.__args.presto_catalog, self.__args.presto_schema
+            )
+            cached = self.__result_cache.get(cache_key)
+
+        if cached is not None:
+            keys, rows = cached
+            self.__logger.info("{}.sql: use cached result".format(placeholder_sql_name))
         else:
-            pass
+            presto_cursor = presto_connection.cursor()
+            with self.__admit():
+                presto_cursor.execute(sql)
+                rows = presto_cursor.fetchall()
+            keys = [column[0] for column in presto_cursor.description]
+
+        if len(rows) == 0:
+            self.__logger.error("{}.sql returns no rows".format(placeholder_sql_name))
+            sys.exit(1)
+
+        not_arrays = [key for key, value in zip(keys, rows[0]) if not isinstance(value, list)]
+        if len(not_arrays) != 0:
+            self.__logger.error("{}.sql: columns {} must be array type".format(placeholder_sql_name, not_arrays))
+            sys.exit(1)
+
+        if cache_key is not None and cached is None:
+            self.__result_cache.put(cache_key, keys, rows[:1], self.__result_cache.ttl(sql))
+
+        return dict(zip(keys, rows[0]))
     
 
     def get_placeholder_group(self):
         """
         获取 placeholder 填充组合
         根据 placeholder_config 得出
+
+        组合不会预先展开，只记录 key、每个 key 的取值与组合总数，执行时由
+        iter_placeholder_combinations() 惰性生成；sql 同时被编译为 PlaceholderTemplate
+
+        --placeholder.batch 标记的 key，取值按 --placeholder.batch.size 分组，每组作为一个值参与组合，
+        N 个取值的组合数因此变为 ceil(N / batch.size)
         """
         for sql_name in self.__placeholder_config.keys():
 
             self.__placeholder_group[sql_name] = {}
 
             placeholder_keys_list = list(self.__placeholder_config[sql_name].keys())
-            placeholder_values_group_list = [
-                list(group) for group in it.product(*list(self.__placeholder_config[sql_name].values()))
-            ]
+            placeholder_values_list = []
+            for key in placeholder_keys_list:
+                values = list(self.__placeholder_config[sql_name][key])
+                if key in self.__placeholder_batch.get(sql_name, []):
+                    values = chunk(values, self.__args.placeholder_batch_size)
+                placeholder_values_list.append(values)
+
+            total = 1
+            for values in placeholder_values_list:
+                total *= len(values)
 
             self.__placeholder_group[sql_name]['keys'] = placeholder_keys_list
-            self.__placeholder_group[sql_name]['values'] = placeholder_values_group_list
+            self.__placeholder_group[sql_name]['values'] = placeholder_values_list
+            self.__placeholder_group[sql_name]['total'] = total
+            self.__placeholder_group[sql_name]['template'] = PlaceholderTemplate(self.__sql_file[sql_name])
+
+
+    def check_placeholder_group(self):
+        """
+        执行前检查每个带 placeholder 的脚本: sql 里的 placeholder 必须都已配置，配置的 key 也必须都被用到，
+        --placeholder.batch 标记的 key 必须是配置的 key
+        """
+        errors = []
+        for sql_name, group in self.__placeholder_group.items():
+            try:
+                group['template'].check(group['keys'])
+            except PlaceholderError as e:
+                errors.append("{}.sql: {}".format(sql_name, e))
+
+        for sql_name, keys in self.__placeholder_batch.items():
+            unknown = [key for key in keys if key not in self.__placeholder_group.get(sql_name, {}).get('keys', [])]
+            if len(unknown) != 0:
+                errors.append("{}.sql: --placeholder.batch keys {} are not placeholder keys".format(sql_name, unknown))
+
+        if len(errors) != 0:
+            for error in errors:
+                self.__logger.error(error)
+            sys.exit(1)
+
+
+    def iter_placeholder_combinations(self, sql_name):
+        """
+        惰性生成 placeholder 组合
+
+        :params sql_name: sql 名
+        :return: 生成 {key: value} 的 generator
+        """
+        keys = self.__placeholder_group[sql_name]['keys']
+        for values in it.product(*self.__placeholder_group[sql_name]['values']):
+            yield dict(zip(keys, values))
+
+
+    def exec_placeholder_combination(self, presto_cursor, sql_name, index, total, fill_dict):
+        """
+        填充并执行单个 placeholder 组合
+
+        :params presto_cursor: prestodb.dbapi.connect.cursor，为 None 时使用当前线程专属的 cursor
+        :params sql_name: sql 名
+        :params index: 组合序号 (从 0 开始)
+        :params total: 组合总数
+        :params fill_dict: 组合的填充值 {key: value}
+        :return: 执行成功返回 None，否则返回异常对象
+        """
+        tag = "{}.sql {}/{}".format(sql_name, index + 1, total)
+        sql = self.__placeholder_group[sql_name]['template'].render(fill_dict)
+
+        if presto_cursor is None:
+            presto_cursor = self.__get_thread_cursor()
+
+        self.__logger.info("[{}]: start with placeholders {}".format(tag, fill_dict))
+        try:
+            self.exec_sql(
+                presto_cursor, sql, tag=tag, name='{}-{}'.format(sql_name, index + 1),
+                sql_name=sql_name, placeholders=fill_dict
+            )
+        except Exception as e:
+            self.__logger.error("[{}]: failed with placeholders {}: {}".format(tag, fill_dict, e))
+            return e
+
+        self.__logger.info("[{}]: complete".format(tag))
+        return None
+
+
+    async def exec_placeholder_combination_async(self, presto_cursor, sql_name, index, total, fill_dict):
+        """
+        exec_placeholder_combination() 的协程版本
+
+        :params presto_cursor: aio.AsyncPrestoCursor
+        :return: 执行成功返回 None，否则返回异常对象
+        """
+        tag = "{}.sql {}/{}".format(sql_name, index + 1, total)
+        sql = self.__placeholder_group[sql_name]['template'].render(fill_dict)
+
+        self.__logger.info("[{}]: start with placeholders {}".format(tag, fill_dict))
+        try:
+            await self.exec_sql_async(
+                presto_cursor, sql, tag=tag, name='{}-{}'.format(sql_name, index + 1),
+                sql_name=sql_name, placeholders=fill_dict
+            )
+        except Exception as e:
+            self.__logger.error("[{}]: failed with placeholders {}: {}".format(tag, fill_dict, e))
+            return e
+
+        self.__logger.info("[{}]: complete".format(tag))
+        return None
 
 
     def exec_sql_with_placeholders(self, presto_cursor, sql_name):
         """
         将 placeholder 的值填充到 sql 字符串里，并执行
 
+        --placeholder.parallelism 大于 1 时，组合会被分发到有界的线程池中并行执行，
+        每个工作线程使用自己的 presto 连接；否则在 presto_cursor 上依次执行
+        组合按需生成，同一时间最多只有 2 倍并行数的组合在排队或执行
+        --presto.engine asyncio 时并行的组合改为在事件循环中以协程执行，见 exec_placeholder_combinations_async()
+
+        默认遇到失败的组合即停止 (已提交的组合会执行完，未开始的组合会被跳过)，
+        指定 --placeholder.continue.on.error 时会继续执行剩余组合
+        所有组合结束后按组合序号输出汇总，有失败的组合时以状态码 1 退出
+
         :params presto_cursor: prestodb.dbapi.connect.cursor
         :params sql_name: sql 名
         """
-        for values in self.__placeholder_group[sql_name]['values']:
-            fill_dict = dict(zip(self.__placeholder_group[sql_name]['keys'], values))
-            sql = self.__sql_file[sql_name]
-            
-            for key in fill_dict.keys():
-                sql = sql.replace('{' + key + '}', str(fill_dict[key]))
-            
-            self.exec_sql(presto_cursor, sql)
+        total = self.__placeholder_group[sql_name]['total']
+        combinations = enumerate(self.iter_placeholder_combinations(sql_name))
+        parallelism = min(self.__args.placeholder_parallelism, max(total, 1))
+        continue_on_error = self.__args.placeholder_continue_on_error
+
+        # {组合序号: None 或 异常}，未出现在结果里的组合视为跳过
+        results = {}
+        # {组合序号: fill_dict}，只保留失败的组合用于汇总
+        failed = {}
+
+        if parallelism == 1:
+            for index, fill_dict in combinations:
+                results[index] = self.exec_placeholder_combination(presto_cursor, sql_name, index, total, fill_dict)
+                if results[index] is not None:
+                    failed[index] = fill_dict
+                    if not continue_on_error:
+                        break
+        elif self.__args.presto_engine == 'asyncio':
+            presto_cursor.connection.run(
+                self.exec_placeholder_combinations_async(presto_cursor, sql_name, results, failed)
+            )
+        else:
+            self.__logger.info("[{}.sql]: execute {} placeholder combinations with parallelism {}".format(
+                sql_name, total, parallelism
+            ))
+            stopped = False
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                running = {}
+                while True:
+                    while not stopped and len(running) < parallelism * 2:
+                        combination = next(combinations, None)
+                        if combination is None:
+                            break
+                        index, fill_dict = combination
+                        future = executor.submit(
+                            self.exec_placeholder_combination, None, sql_name, index, total, fill_dict
+                        )
+                        running[future] = (index, fill_dict)
+
+                    if len(running) == 0:
+                        break
+
+                    finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        index, fill_dict = running.pop(future)
+                        results[index] = future.result()
+                        if results[index] is not None:
+                            failed[index] = fill_dict
+                            stopped = stopped or not continue_on_error
+
+        self.__report_placeholder_summary(sql_name, total, results, failed)
+
+
+    async def exec_sql_with_placeholders_async(self, presto_cursor, sql_name):
+        """
+        exec_sql_with_placeholders() 的协程版本，DAG 节点在事件循环中执行时使用
+
+        :params presto_cursor: aio.AsyncPrestoCursor
+        :params sql_name: sql 名
+        """
+        results, failed = {}, {}
+        await self.exec_placeholder_combinations_async(presto_cursor, sql_name, results, failed)
+        self.__report_placeholder_summary(sql_name, self.__placeholder_group[sql_name]['total'], results, failed)
+
+
+    async def exec_placeholder_combinations_async(self, presto_cursor, sql_name, results, failed):
+        """
+        在事件循环中执行 placeholder 组合 (--presto.engine asyncio)
+
+        并行执行时每个组合是一个协程，通过 asyncio.gather 等待全部完成，
+        同时执行的组合数由大小为 --placeholder.parallelism 的 semaphore 限制；
+        组合仍按需生成，拿到名额后才创建下一个组合的协程，协程之间复用空闲的 cursor。
+        失败处理与 exec_sql_with_placeholders() 一致
+
+        :params presto_cursor: 不并行时依次执行组合的 aio.AsyncPrestoCursor
+        :params sql_name: sql 名
+        :params results: 执行结果 {组合序号: None 或 异常}
+        :params failed: 失败的组合 {组合序号: fill_dict}
+        """
+        import asyncio
+
+        total = self.__placeholder_group[sql_name]['total']
+        combinations = enumerate(self.iter_placeholder_combinations(sql_name))
+        parallelism = min(self.__args.placeholder_parallelism, max(total, 1))
+        continue_on_error = self.__args.placeholder_continue_on_error
+
+        if parallelism == 1:
+            for index, fill_dict in combinations:
+                results[index] = await self.exec_placeholder_combination_async(
+                    presto_cursor, sql_name, index, total, fill_dict
+                )
+                if results[index] is not None:
+                    failed[index] = fill_dict
+                    if not continue_on_error:
+                        break
+            return
+
+        self.__logger.info("[{}.sql]: execute {} placeholder combinations with parallelism {} on the event loop".format(
+            sql_name, total, parallelism
+        ))
+        semaphore = asyncio.Semaphore(parallelism)
+        idle = []
+        stopped = False
+
+        async def run(index, fill_dict):
+            nonlocal stopped
+            try:
+                async with self.__borrow_cursor(idle) as cursor:
+                    results[index] = await self.exec_placeholder_combination_async(
+                        cursor, sql_name, index, total, fill_dict
+                    )
+                if results[index] is not None:
+                    failed[index] = fill_dict
+                    stopped = stopped or not continue_on_error
+            except Exception:
+                stopped = True
+                raise
+            finally:
+                semaphore.release()
+
+        tasks = []
+        for index, fill_dict in combinations:
+            await semaphore.acquire()
+            if stopped:
+                semaphore.release()
+                break
+            tasks.append(asyncio.ensure_future(run(index, fill_dict)))
+
+        # 与线程池一样等待所有已开始的组合结束后再抛出异常
+        for error in await asyncio.gather(*tasks, return_exceptions=True):
+            if error is not None:
+                raise error
+
+
+    def __report_placeholder_summary(self, sql_name, total, results, failed):
+        """
+        按组合序号输出 placeholder 执行汇总，有失败的组合时退出
+        """
+        succeeded = len(results) - len(failed)
+        skipped = total - len(results)
+
+        self.__print("Placeholder summary of {}.sql: total {}, succeeded {}, failed {}, skipped {}".format(
+            sql_name, total, succeeded, len(failed), skipped
+        ))
+        for index in sorted(failed.keys()):
+            self.__print("  failed {}/{}: {} => {}".format(index + 1, total, failed[index], results[index]))
+
+        if len(failed) != 0:
+            self.__logger.error("[{}.sql]: {} placeholder combinations failed".format(sql_name, len(failed)))
+            sys.exit(1)
+
+
+    def get_dag(self):
+        """
+        将 --sql.names 的所有语句构建为 DAG，带 placeholder 的脚本整体作为一个节点
+
+        :return: [dag.Node, ...]
+        """
+        try:
+            return build_dag(build_nodes(
+                self.__args.sql_names,
+                self.__sql_file,
+                set(pc[0] for pc in self.__placeholder_sql_names),
+                self.__args.presto_catalog,
+                self.__args.presto_schema
+            ))
+        except DagError as e:
+            self.__logger.error(str(e))
+            sys.exit(1)
+
+
+    def exec_dag_node(self, node):
+        """
+        在当前线程专属的 presto cursor 上执行 DAG 节点
+
+        :params node: dag.Node
+        """
+        presto_cursor = self.__get_thread_cursor()
+        if node.index is None:
+            if node.sql_name in self.__placeholder_group.keys():
+                self.exec_sql_with_placeholders(presto_cursor, node.sql_name)
+            else:
+                self.exec_sql(presto_cursor, node.sql, name=node.sql_name)
+        else:
+            self.exec_sql(presto_cursor, node.sql, tag=node.id, name=node.sql_name, first_index=node.index)
+
+
+    async def exec_dag_node_async(self, presto_cursor, node):
+        """
+        exec_dag_node() 的协程版本
+
+        :params presto_cursor: aio.AsyncPrestoCursor
+        :params node: dag.Node
+        """
+        if node.index is None:
+            if node.sql_name in self.__placeholder_group.keys():
+                await self.exec_sql_with_placeholders_async(presto_cursor, node.sql_name)
+            else:
+                await self.exec_sql_async(presto_cursor, node.sql, name=node.sql_name)
+        else:
+            await self.exec_sql_async(
+                presto_cursor, node.sql, tag=node.id, name=node.sql_name, first_index=node.index
+            )
+
+
+    async def execute_dag_async(self, nodes, done, failed):
+        """
+        在事件循环中按 DAG 调度执行 (--presto.engine asyncio)
+
+        每个节点是一个协程，依赖都完成后获取大小为 --dag.parallelism 的 semaphore 再执行，
+        所有节点通过 asyncio.gather 等待，协程之间复用空闲的 cursor；
+        有节点失败时还没开始的节点不再执行
+
+        :params nodes: [dag.Node, ...]
+        :params done: 执行成功的节点 id (set)
+        :params failed: 失败的节点 {节点 id: 异常}
+        """
+        import asyncio
+
+        semaphore = asyncio.Semaphore(self.__args.dag_parallelism)
+        finished = {node.id: asyncio.Event() for node in nodes}
+        idle = []
+
+        async def run(node):
+            try:
+                for dep in node.deps:
+                    await finished[dep].wait()
+                async with semaphore:
+                    if len(failed) != 0:
+                        return
+                    async with self.__borrow_cursor(idle) as presto_cursor:
+                        await self.exec_dag_node_async(presto_cursor, node)
+                done.add(node.id)
+            # 带 placeholder 的节点有组合失败时以 SystemExit 结束，与线程池中一样记为节点失败
+            except (Exception, SystemExit) as e:
+                self.__logger.error("[{}]: failed: {}".format(node.id, e))
+                failed[node.id] = e
+            finally:
+                finished[node.id].set()
+
+        await asyncio.gather(*(run(node) for node in nodes))
+
+
+    def execute_dag(self, presto_connection):
+        """
+        按 DAG 调度执行，依赖都完成的节点最多 --dag.parallelism 个同时执行
+        --presto.engine asyncio 时节点在事件循环中以协程执行，见 execute_dag_async()
+
+        有节点失败时不再提交新的节点，等待执行中的节点结束后输出汇总并以状态码 1 退出
+
+        :params presto_connection: 主连接，asyncio 时通过它在事件循环中执行
+        """
+        nodes = self.get_dag()
+        parallelism = self.__args.dag_parallelism
+        self.__logger.info("execute {} statements as dag with parallelism {}".format(len(nodes), parallelism))
+
+        waiting = list(nodes)
+        running = {}
+        done = set()
+        failed = {}
+
+        if self.__args.presto_engine == 'asyncio':
+            presto_connection.run(self.execute_dag_async(nodes, done, failed))
+            waiting = [node for node in nodes if node.id not in done and node.id not in failed]
+        else:
+            with ThreadPoolExecutor(max_workers=parallelism) as executor:
+                while True:
+                    if len(failed) == 0:
+                        for node in list(waiting):
+                            if len(running) >= parallelism:
+                                break
+                            if all(dep in done for dep in node.deps):
+                                waiting.remove(node)
+                                running[executor.submit(self.exec_dag_node, node)] = node
+
+                    if len(running) == 0:
+                        break
+
+                    finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        node = running.pop(future)
+                        error = future.exception()
+                        if error is None:
+                            done.add(node.id)
+                        else:
+                            self.__logger.error("[{}]: failed: {}".format(node.id, error))
+                            failed[node.id] = error
+
+        self.__print("DAG summary: total {}, succeeded {}, failed {}, skipped {}".format(
+            len(nodes), len(done), len(failed), len(waiting)
+        ))
+        for node in nodes:
+            if node.id in failed:
+                self.__print("  failed {} => {}".format(node.id, failed[node.id]))
+
+        if len(failed) != 0:
+            sys.exit(1)
 
 
     def execute(self):
         """
         执行
         """
-        presto_cursor = self.__get_presto_connection().cursor()
-        presto_engine = self.__get_presto_engine()
-        
         self.get_sql_file()
-        self.get_placeholder_config(presto_engine)
-        if len(self.__placeholder_config) != 0:
-            self.get_placeholder_group()
-
-        if len(self.__placeholder_group) != 0:
-            for sql_name in self.__sql_file.keys():
-                if sql_name in self.__placeholder_group.keys():
-                    self.exec_sql_with_placeholders(presto_cursor, sql_name)
-                else:
-                    self.exec_sql(presto_cursor, self.__sql_file[sql_name])
-        else:
-            for sql_name in self.__sql_file.keys():
-                self.exec_sql(presto_cursor, self.__sql_file[sql_name])
-
-        print("============= Finish =============")
+        if self.__args.plan is True:
+            self.__print(format_plan(self.get_dag()))
+            return
+
+        self.__journal = self.__set_journal()
+        self.__admission = self.__set_admission()
+        self.__stats_recorder = QueryStatsRecorder(
+            jsonl_path=self.__args.stats_path, prometheus_path=self.__args.stats_prometheus_path
+        )
+        try:
+            presto_connection = self.__get_presto_connection()
+            presto_cursor = presto_connection.cursor()
+
+            self.get_placeholder_config(presto_connection)
+            if len(self.__placeholder_config) != 0:
+                self.get_placeholder_group()
+                self.check_placeholder_group()
+
+            if self.__args.dag_parallelism is not None:
+                self.execute_dag(presto_connection)
+            elif len(self.__placeholder_group) != 0:
+                for sql_name in self.__sql_file.keys():
+                    if sql_name in self.__placeholder_group.keys():
+                        self.exec_sql_with_placeholders(presto_cursor, sql_name)
+                    else:
+                        self.exec_sql(presto_cursor, self.__sql_file[sql_name], name=sql_name)
+            else:
+                for sql_name in self.__sql_file.keys():
+                    self.exec_sql(presto_cursor, self.__sql_file[sql_name], name=sql_name)
+
+            # 执行成功后清空执行记录，下次执行从头开始
+            if self.__journal is not None:
+                self.__journal.reset()
+        finally:
+            # 失败时也输出已执行语句的统计，并释放连接 (server 模式下进程不会退出)
+            self.__stats_recorder.close()
+            self.__close_connections()
+            if self.__journal is not None:
+                self.__journal.close()
+            if self.__admission is not None:
+                self.__logger.info("admission control: " + self.__admission.summary())
+
+        self.__print("============= Finish =============")
 
     
     def show_usage(self):
         if self.__args.usage is True:
-            print(textwrap.dedent(PrestoETL.USAGE))
+            self.__print(textwrap.dedent(PrestoETL.USAGE))
 
         
     def test(self):
-        print(self.args_dict)
+        self.__print(self.args_dict)
 
 
 if __name__ == '__main__':
+    if '--server' in sys.argv[1:] or '--submit' in sys.argv[1:]:
+        from server import main
+        sys.exit(main(sys.argv[1:], PrestoETL))
+
     executor = PrestoETL()
     executor.execute()
     # executor.test()
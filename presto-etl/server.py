@@ -0,0 +1,583 @@
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import signal
+import socket
+import logging
+import argparse
+import threading
+import collections
+import http.client
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn, UnixStreamServer
+from cache import SqlCache
+
+
+logger = logging.getLogger('presto-etl.server')
+
+# job 日志的格式
+LOG_FORMAT = '%(asctime)s %(name)s[%(process)d] %(levelname)s %(message)s'
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7878
+
+
+class JobLog:
+    """
+    job 的输出 (执行信息与日志)
+
+    PrestoETL 的 output 与 job logger 的 handler 都写入这里，写入的同时可以被多个客户端流式读取
+    """
+
+    def __init__(self):
+        self.__chunks = []
+        self.__closed = False
+        self.__condition = threading.Condition()
+
+
+    def write(self, text):
+        with self.__condition:
+            self.__chunks.append(text)
+            self.__condition.notify_all()
+        return len(text)
+
+
+    def flush(self):
+        pass
+
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+    def read(self, offset, timeout=None):
+        """
+        读取 offset 之后的输出，没有新输出时阻塞，直到有新输出、job 结束或超时
+
+        :params offset: 已读取的片段数
+        :return: ([text, ...], job 是否已结束)
+        """
+        with self.__condition:
+            self.__condition.wait_for(lambda: len(self.__chunks) > offset or self.__closed, timeout)
+            return self.__chunks[offset:], self.__closed
+
+
+class Job:
+    """
+    提交到 server 的 job
+    """
+
+    def __init__(self, argv):
+        """
+        :params argv: presto-etl.py 的参数列表
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.argv = argv
+        self.state = 'queued'
+        self.exit_code = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.log = JobLog()
+
+
+    def start(self):
+        self.state = 'running'
+        self.started_at = time.time()
+
+
+    def finish(self, exit_code):
+        self.exit_code = exit_code
+        self.state = 'succeeded' if exit_code == 0 else 'failed'
+        self.finished_at = time.time()
+        self.log.close()
+
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'argv': self.argv,
+            'state': self.state,
+            'exit_code': self.exit_code,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class PrestoConnectionPool:
+    """
+    server 内共享的 presto HTTP 连接池
+
+    每个 job 都新建自己的 presto 连接，SET SESSION / USE 等会话状态只属于该 job，只共享底层的 HTTP 连接:
+    相同 (host, port) 的 dbapi 连接共用一个带 keep-alive 连接池的 requests.Session，
+    相同 (host, port, user, catalog, schema) 的 asyncio 连接共用一个 AsyncPrestoClient 的事件循环与连接池
+    """
+
+    def __init__(self, max_connections=100):
+        """
+        :params max_connections: 每个 requests.Session / AsyncPrestoClient 的连接池大小
+        """
+        self.__max_connections = max_connections
+        self.__http_sessions = {}
+        self.__aio_clients = {}
+        self.__lock = threading.Lock()
+
+
+    def connect(self, engine, host, port, user, catalog, schema):
+        """
+        新建一个 presto 连接，底层的 HTTP 连接池由相同 presto 地址的连接共享
+
+        :return: prestodb.dbapi.Connection 或 aio.AsyncPrestoConnection
+        """
+        if engine == 'asyncio':
+            return self.__get_aio_client(host, port, user, catalog, schema).connect()
+
+        import prestodb
+
+        connection = prestodb.dbapi.connect(host=host, port=port, user=user, catalog=catalog, schema=schema)
+        # prestodb.dbapi.connect 不接受外部的 requests.Session，替换连接自己新建的 session;
+        # 会话状态都通过每个请求的 headers 发送，不依赖 session 本身
+        connection._http_session = self.__get_http_session(host, port)
+        return connection
+
+
+    def __get_http_session(self, host, port):
+        import requests
+
+        with self.__lock:
+            if (host, port) not in self.__http_sessions:
+                session = requests.session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.__max_connections)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self.__http_sessions[(host, port)] = session
+
+            return self.__http_sessions[(host, port)]
+
+
+    def __get_aio_client(self, host, port, user, catalog, schema):
+        key = (host, port, user, catalog, schema)
+        with self.__lock:
+            if key not in self.__aio_clients:
+                from aio import AsyncPrestoClient
+                self.__aio_clients[key] = AsyncPrestoClient(
+                    host=host, port=port, user=user, catalog=catalog, schema=schema,
+                    max_connections=self.__max_connections
+                )
+
+            return self.__aio_clients[key]
+
+
+    def close(self):
+        with self.__lock:
+            for session in self.__http_sessions.values():
+                session.close()
+            for client in self.__aio_clients.values():
+                client.close()
+            self.__http_sessions = {}
+            self.__aio_clients = {}
+
+
+class JobServer:
+    """
+    presto-etl job server
+
+    **Basic**
+
+    常驻进程，接收 job 提交并放入队列，由 concurrency 个工作线程执行。
+    所有 job 共享获取 sql 的 HTTP session、sql 缓存与 presto 的 HTTP 连接池，不再每个 job 启动一个进程、
+    重新建立连接与获取 sql
+
+    每个工作线程有自己的 logger (presto-etl.worker.<n>)，执行 job 时把日志与执行信息写入 job 的 JobLog
+
+    **Usage**
+
+        server = JobServer(PrestoETL, concurrency=4)
+        job = server.submit(['--presto.host', ..., '--sql.names', 'create', 'fully'])
+        ...
+        server.close()
+    """
+
+    def __init__(self, presto_etl_class, concurrency=4, history=100, sql_cache=None):
+        """
+        :params presto_etl_class: PrestoETL
+        :params concurrency: 同时执行的 job 数
+        :params history: 保留的已结束 job 数
+        :params sql_cache: 未指定 --sql.cache.dir 的 job 使用的 SqlCache
+        """
+        import requests
+
+        self.__presto_etl_class = presto_etl_class
+        self.__history = history
+        self.__sql_cache = sql_cache
+        self.__connection_pool = PrestoConnectionPool()
+
+        self.__session = requests.session()
+        request_retry = requests.adapters.HTTPAdapter(max_retries=3, pool_maxsize=max(concurrency * 8, 10))
+        self.__session.mount('https://', request_retry)
+        self.__session.mount('http://', request_retry)
+
+        self.__jobs = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.__queue = queue.Queue()
+        self.__closing = False
+        self.__workers = [
+            threading.Thread(target=self.__work, args=(slot,), name='presto-etl-worker-{}'.format(slot), daemon=True)
+            for slot in range(concurrency)
+        ]
+        for worker in self.__workers:
+            worker.start()
+
+
+    def submit(self, argv):
+        """
+        提交 job
+
+        :params argv: presto-etl.py 的参数列表
+        :return: Job
+        """
+        job = Job(argv)
+        with self.__lock:
+            self.__jobs[job.id] = job
+        self.__queue.put(job)
+        logger.info("job {} queued: {}".format(job.id, ' '.join(argv)))
+        return job
+
+
+    def get(self, job_id):
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+
+    def jobs(self):
+        with self.__lock:
+            return list(self.__jobs.values())
+
+
+    def __work(self, slot):
+        job_logger = logging.getLogger('presto-etl.worker.{}'.format(slot))
+        while True:
+            job = self.__queue.get()
+            if job is None:
+                return
+
+            if self.__closing:
+                job.log.write("server is shutting down, job is not executed\n")
+                job.finish(1)
+                continue
+
+            handler = logging.StreamHandler(job.log)
+            handler.setFormatter(logging.Formatter(LOG_FORMAT))
+            job_logger.addHandler(handler)
+            job.start()
+            logger.info("job {} started".format(job.id))
+            try:
+                self.__presto_etl_class(
+                    job.argv, output=job.log, logger=job_logger, session=self.__session,
+                    sql_cache=self.__sql_cache, connection_pool=self.__connection_pool
+                ).execute()
+                exit_code = 0
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except Exception:
+                job_logger.exception("job {} failed".format(job.id))
+                exit_code = 1
+            finally:
+                job_logger.removeHandler(handler)
+
+            job.finish(exit_code)
+            logger.info("job {} {} with exit code {}".format(job.id, job.state, exit_code))
+            self.__trim_history()
+
+
+    def __trim_history(self):
+        """
+        只保留最近 history 个已结束的 job
+        """
+        with self.__lock:
+            finished = [job_id for job_id, job in self.__jobs.items() if job.finished_at is not None]
+            for job_id in finished[:max(len(finished) - self.__history, 0)]:
+                del self.__jobs[job_id]
+
+
+    def close(self):
+        """
+        停止 server: 队列中未开始的 job 不再执行 (以 1 结束)，等待正在执行的 job 结束后释放连接
+        """
+        self.__closing = True
+        for _ in self.__workers:
+            self.__queue.put(None)
+        for worker in self.__workers:
+            worker.join()
+        self.__connection_pool.close()
+        self.__session.close()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_handler(job_server):
+    """
+    HTTP API:
+
+    - POST /jobs {"argv": [...]}: 提交 job，返回 job 信息
+    - GET /jobs: 所有 job
+    - GET /jobs/<job_id>: job 信息 (state, exit_code 等)
+    - GET /jobs/<job_id>/log: 以 chunked 编码流式返回 job 的输出，job 结束时响应结束
+    - GET /health: server 状态
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def do_GET(self):
+            parts = [part for part in self.path.split('?')[0].split('/') if part != '']
+            if parts == ['health']:
+                jobs = job_server.jobs()
+                self.send_json(200, {
+                    'status': 'ok',
+                    'queued': len([job for job in jobs if job.state == 'queued']),
+                    'running': len([job for job in jobs if job.state == 'running']),
+                })
+            elif parts == ['jobs']:
+                self.send_json(200, [job.to_dict() for job in job_server.jobs()])
+            elif len(parts) in (2, 3) and parts[0] == 'jobs':
+                job = job_server.get(parts[1])
+                if job is None:
+                    self.send_json(404, {'error': 'job {} not found'.format(parts[1])})
+                elif len(parts) == 2:
+                    self.send_json(200, job.to_dict())
+                elif parts[2] == 'log':
+                    self.stream_log(job)
+                else:
+                    self.send_json(404, {'error': 'not found'})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path.split('?')[0].rstrip('/') != '/jobs':
+                self.send_json(404, {'error': 'not found'})
+                return
+
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                argv = body['argv']
+                if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+                    raise ValueError("argv must be a list of strings")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': 'invalid job: {}'.format(e)})
+                return
+
+            self.send_json(202, job_server.submit(argv).to_dict())
+
+        def send_json(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def stream_log(self, job):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            offset, closed = 0, False
+            while not closed:
+                chunks, closed = job.log.read(offset, timeout=10)
+                offset += len(chunks)
+                content = ''.join(chunks).encode('utf-8')
+                if len(content) != 0:
+                    self.wfile.write('{:x}\r\n'.format(len(content)).encode('ascii') + content + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+
+    return Handler
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    通过 unix socket 连接 server 的 HTTPConnection
+    """
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.__path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.__path)
+
+
+def server_connection(args):
+    if args.server_socket is not None:
+        return UnixHTTPConnection(args.server_socket)
+    return http.client.HTTPConnection(args.server_host, args.server_port)
+
+
+def request_json(args, method, path, body=None):
+    connection = server_connection(args)
+    try:
+        content = json.dumps(body).encode('utf-8') if body is not None else None
+        connection.request(method, path, body=content, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        result = json.loads(response.read().decode('utf-8'))
+        if response.status >= 400:
+            raise ValueError(result.get('error', response.reason))
+        return result
+    finally:
+        connection.close()
+
+
+def submit(args, job_argv, output=None):
+    """
+    client 模式: 提交 job，流式输出 job 的输出，返回 job 的退出码
+
+    :params args: server 地址参数
+    :params job_argv: job 的参数
+    :params output: 输出 (二进制)，为 None 时输出到 sys.stdout.buffer
+    :return: exit code
+    """
+    output = output if output is not None else sys.stdout.buffer
+    try:
+        job = request_json(args, 'POST', '/jobs', {'argv': job_argv})
+
+        connection = server_connection(args)
+        try:
+            connection.request('GET', '/jobs/{}/log'.format(job['id']))
+            response = connection.getresponse()
+            while True:
+                content = response.read1(65536)
+                if len(content) == 0:
+                    break
+                output.write(content)
+                output.flush()
+        finally:
+            connection.close()
+
+        return request_json(args, 'GET', '/jobs/{}'.format(job['id']))['exit_code']
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        logger.error("submit job to {} failed: {}".format(
+            args.server_socket or '{}:{}'.format(args.server_host, args.server_port), e
+        ))
+        return 1
+
+
+def serve(args, presto_etl_class):
+    """
+    server 模式: 启动 job server，直到收到 SIGINT / SIGTERM
+    """
+    sql_cache = None
+    if args.sql_cache_dir is not None:
+        sql_cache = SqlCache(
+            cache_dir=os.path.expanduser(args.sql_cache_dir),
+            ttl=args.sql_cache_ttl,
+            max_size=args.sql_cache_max_size * 1024 * 1024
+        )
+
+    job_server = JobServer(presto_etl_class, args.server_concurrency, args.server_history, sql_cache)
+    handler = make_handler(job_server)
+    if args.server_socket is not None:
+        if os.path.exists(args.server_socket):
+            os.remove(args.server_socket)
+        # unix socket 不支持 TCP_NODELAY
+        handler.disable_nagle_algorithm = False
+        http_server = ThreadingUnixHTTPServer(args.server_socket, handler)
+        address = args.server_socket
+    else:
+        http_server = ThreadingHTTPServer((args.server_host, args.server_port), handler)
+        address = 'http://{}:{}'.format(*http_server.server_address[:2])
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info("presto-etl server listening on {} with concurrency {}".format(address, args.server_concurrency))
+    try:
+        http_server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        logger.info("presto-etl server shutting down")
+        http_server.server_close()
+        job_server.close()
+        if args.server_socket is not None and os.path.exists(args.server_socket):
+            os.remove(args.server_socket)
+
+    return 0
+
+
+def main(argv, presto_etl_class):
+    """
+    presto-etl.py --server / --submit 的入口
+
+    :params argv: 命令行参数
+    :params presto_etl_class: PrestoETL
+    :return: exit code
+    """
+    server_mode = '--server' in argv
+    parser = argparse.ArgumentParser(
+        prog="python3 presto-etl.py {}".format('--server' if server_mode else '--submit'),
+        description="run a presto-etl job server" if server_mode else
+                    "run the job on a presto-etl job server, other arguments are passed to the job",
+        allow_abbrev=False
+    )
+    parser.add_argument('--server', action='store_true', dest='server', help="run as a job server")
+    parser.add_argument('--submit', action='store_true', dest='submit', help="submit the job to a job server")
+    parser.add_argument(
+        '--server.host', action='store', dest='server_host', default=DEFAULT_HOST,
+        help="set job server host. (default: {})".format(DEFAULT_HOST)
+    )
+    parser.add_argument(
+        '--server.port', action='store', dest='server_port', type=int, default=DEFAULT_PORT,
+        help="set job server port. (default: {})".format(DEFAULT_PORT)
+    )
+    parser.add_argument(
+        '--server.socket', action='store', dest='server_socket',
+        help="use this unix socket instead of --server.host and --server.port"
+    )
+
+    if not server_mode:
+        args, job_argv = parser.parse_known_args(argv)
+        return submit(args, job_argv)
+
+    parser.add_argument(
+        '--server.concurrency', action='store', dest='server_concurrency', type=int, default=4,
+        help="set the number of jobs executed at the same time. (default: 4)"
+    )
+    parser.add_argument(
+        '--server.history', action='store', dest='server_history', type=int, default=100,
+        help="set the number of finished jobs kept for querying. (default: 100)"
+    )
+    parser.add_argument(
+        '--sql.cache.dir', action='store', dest='sql_cache_dir',
+        help="cache sql scripts in this directory for jobs without their own --sql.cache.dir"
+    )
+    parser.add_argument(
+        '--sql.cache.ttl', action='store', dest='sql_cache_ttl', type=int, default=300,
+        help="set the seconds a cached sql script is used without revalidation. (default: 300)"
+    )
+    parser.add_argument(
+        '--sql.cache.max.size', action='store', dest='sql_cache_max_size', type=int, default=64,
+        help="set the max size of the sql cache in MB. (default: 64)"
+    )
+    args = parser.parse_args(argv)
+
+    if args.server_concurrency < 1 or args.server_history < 0:
+        logger.error("--server.concurrency must be positive and --server.history must not be negative")
+        return 1
+
+    return serve(args, presto_etl_class)
@@ -0,0 +1,180 @@
+import io
+import abc
+import csv
+import json
+import gzip
+
+
+# 支持的输出格式与压缩方式
+SINK_FORMATS = ['csv', 'jsonl', 'parquet']
+SINK_COMPRESSIONS = ['gzip', 'zstd', 'none']
+
+# 文件后缀
+COMPRESSION_SUFFIX = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+# presto 类型 ==> parquet 列类型，未列出的类型统一以字符串写入
+PARQUET_TYPES = {
+    'tinyint': 'int64',
+    'smallint': 'int64',
+    'integer': 'int64',
+    'bigint': 'int64',
+    'real': 'float64',
+    'double': 'float64',
+    'boolean': 'bool_',
+}
+
+
+class ResultSink(abc.ABC):
+    """
+    查询结果输出基类
+
+    **Basic**
+
+    按批次 (fetchmany 的结果) 增量写入文件，内存占用只与批次大小有关
+
+    **Usage**
+
+        sink = open_sink('/data/fully-1', 'csv', 'gzip', presto_cursor.description)
+        while True:
+            rows = presto_cursor.fetchmany(1000)
+            if not rows:
+                break
+            sink.write(rows)
+        sink.close()
+    """
+
+    def __init__(self, path, description):
+        """
+        :params path: 输出文件路径
+        :params description: cursor.description
+        """
+        self.path = path
+        self.columns = [column[0] for column in description]
+        self.types = [column[1] for column in description]
+
+
+    @abc.abstractmethod
+    def write(self, rows):
+        pass
+
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class CsvSink(ResultSink):
+    """
+    csv 输出，首行为列名
+    """
+
+    def __init__(self, path, description, compression):
+        super().__init__(path, description)
+        self.__file = open_text(path, compression)
+        self.__writer = csv.writer(self.__file)
+        self.__writer.writerow(self.columns)
+
+
+    def write(self, rows):
+        self.__writer.writerows(
+            [json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else value for value in row]
+            for row in rows
+        )
+
+
+    def close(self):
+        self.__file.close()
+
+
+class JsonlSink(ResultSink):
+    """
+    jsonl 输出，每行一个 {column: value} 对象
+    """
+
+    def __init__(self, path, description, compression):
+        super().__init__(path, description)
+        self.__file = open_text(path, compression)
+
+
+    def write(self, rows):
+        self.__file.writelines(
+            json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str) + '\n' for row in rows
+        )
+
+
+    def close(self):
+        self.__file.close()
+
+
+class ParquetSink(ResultSink):
+    """
+    parquet 输出，每个批次写为一个 row group，需要安装 pyarrow
+    """
+
+    def __init__(self, path, description, compression):
+        super().__init__(path, description)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.__pa = pa
+        self.__arrow_types = [
+            getattr(pa, PARQUET_TYPES.get(column_type.split('(')[0], 'string'))() for column_type in self.types
+        ]
+        schema = pa.schema([pa.field(name, arrow_type) for name, arrow_type in zip(self.columns, self.__arrow_types)])
+        self.__writer = pq.ParquetWriter(
+            path, schema, compression={'gzip': 'gzip', 'zstd': 'zstd', 'none': 'none'}[compression]
+        )
+
+
+    def write(self, rows):
+        pa = self.__pa
+        arrays = []
+        for values, arrow_type in zip(zip(*rows), self.__arrow_types):
+            if arrow_type == pa.string():
+                values = [
+                    None if value is None else
+                    json.dumps(value, ensure_ascii=False) if isinstance(value, (list, dict)) else str(value)
+                    for value in values
+                ]
+            arrays.append(pa.array(values, type=arrow_type))
+        self.__writer.write_table(pa.Table.from_arrays(arrays, names=self.columns))
+
+
+    def close(self):
+        self.__writer.close()
+
+
+def open_text(path, compression):
+    """
+    以文本方式打开 (可压缩的) 输出文件
+
+    :params path: 文件路径
+    :params compression: gzip, zstd, none
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    elif compression == 'zstd':
+        import zstandard
+        return io.TextIOWrapper(zstandard.open(path, 'wb'), encoding='utf-8', newline='')
+    else:
+        return open(path, 'w', encoding='utf-8', newline='')
+
+
+def open_sink(path, sink_format, compression, description):
+    """
+    创建输出
+
+    :params path: 不带后缀的文件路径，后缀根据格式与压缩方式添加
+    :params sink_format: csv, jsonl, parquet
+    :params compression: gzip, zstd, none (parquet 为列压缩方式)
+    :params description: cursor.description
+    :return: ResultSink
+    """
+    if sink_format == 'parquet':
+        return ParquetSink(path + '.parquet', description, compression)
+
+    path = path + '.' + sink_format + COMPRESSION_SUFFIX[compression]
+    if sink_format == 'csv':
+        return CsvSink(path, description, compression)
+    else:
+        return JsonlSink(path, description, compression)
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+
+# 记录的 presto 查询统计: (输出字段, presto stats 字段, prometheus 指标名, 换算系数, 同一语句多条记录的聚合函数)
+QUERY_STATS = [
+    ('wall_time_ms', 'wallTimeMillis', 'presto_etl_query_wall_seconds', 0.001, sum),
+    ('elapsed_time_ms', 'elapsedTimeMillis', 'presto_etl_query_elapsed_seconds', 0.001, sum),
+    ('queued_time_ms', 'queuedTimeMillis', 'presto_etl_query_queued_seconds', 0.001, sum),
+    ('cpu_time_ms', 'cpuTimeMillis', 'presto_etl_query_cpu_seconds', 0.001, sum),
+    ('processed_rows', 'processedRows', 'presto_etl_query_processed_rows', 1, sum),
+    ('processed_bytes', 'processedBytes', 'presto_etl_query_processed_bytes', 1, sum),
+    ('peak_memory_bytes', 'peakMemoryBytes', 'presto_etl_query_peak_memory_bytes', 1, max),
+]
+
+# 每条语句按结束状态计数的 prometheus 指标名
+QUERY_COUNT_METRIC = 'presto_etl_queries'
+
+
+class QueryStatsRecorder:
+    """
+    presto 查询统计记录
+
+    **Basic**
+
+    每条语句执行结束后 (成功或失败)，从 cursor.stats 取出 query id 与最终的统计信息，
+    附带 sql.dir、sql 名、语句序号与 placeholder 的值:
+
+    - 写入 jsonl 文件，每条语句一行，写完即 flush，job 中断时已执行的语句也有记录
+    - 可选写入 prometheus textfile (node_exporter textfile collector)，在 close() 时整体替换；
+      按 sql.dir、sql 名与语句序号聚合 (placeholder 组合的时间、行数与字节数求和，峰值内存取最大值)，
+      query id 与 placeholder 的值只写入 jsonl，series 的数量不随组合数与执行次数增长
+
+    **Usage**
+
+        recorder = QueryStatsRecorder('stats.jsonl', 'presto_etl.prom')
+        recorder.record(cursor.stats, 'table_name', 'fully', 1, {'dt': '2019-01-01'})
+        recorder.close()
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None):
+        """
+        :params jsonl_path: jsonl 文件路径，追加写入
+        :params prometheus_path: prometheus textfile 路径
+        """
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__records = []
+        self.__prometheus_path = prometheus_path
+
+        if jsonl_path is not None:
+            os.makedirs(os.path.dirname(jsonl_path) or '.', exist_ok=True)
+            self.__file = open(jsonl_path, 'a', encoding='utf-8')
+
+
+    def record(self, stats, sql_dir, sql_name, statement_index, placeholders=None, error=None):
+        """
+        记录一条语句的统计
+
+        :params stats: cursor.stats
+        :params sql_dir: sql.dir
+        :params sql_name: sql 名
+        :params statement_index: 语句序号
+        :params placeholders: placeholder 的值
+        :params error: 语句失败时的异常
+        :return: 记录的内容 (dict)
+        """
+        stats = stats or {}
+        record = {
+            'time': time.time(),
+            'query_id': stats.get('queryId'),
+            'state': stats.get('state', 'FAILED' if error is not None else None),
+            'sql_dir': sql_dir,
+            'sql_name': sql_name,
+            'statement': statement_index,
+            'placeholders': placeholders,
+        }
+        for field, stats_field, _, _, _ in QUERY_STATS:
+            record[field] = stats.get(stats_field)
+        if error is not None:
+            record['error'] = str(error)
+
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                self.__file.flush()
+            if self.__prometheus_path is not None:
+                self.__records.append(record)
+
+        return record
+
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            if self.__prometheus_path is not None:
+                self.__write_prometheus()
+
+
+    def __write_prometheus(self):
+        """
+        写入 prometheus textfile，先写临时文件再 rename，避免 collector 读到写了一半的文件
+        """
+        statements = {}
+        for record in self.__records:
+            key = (record['sql_dir'], record['sql_name'], record['statement'])
+            statements.setdefault(key, []).append(record)
+
+        lines = ['# TYPE {} gauge'.format(QUERY_COUNT_METRIC)]
+        for key, records in statements.items():
+            states = {}
+            for record in records:
+                states[record['state'] or ''] = states.get(record['state'] or '', 0) + 1
+            for state, count in sorted(states.items()):
+                lines.append('{}{{{},state="{}"}} {}'.format(
+                    QUERY_COUNT_METRIC, statement_labels(*key), escape_label(state), count
+                ))
+
+        for field, _, metric, scale, aggregate in QUERY_STATS:
+            lines.append('# TYPE {} gauge'.format(metric))
+            for key, records in statements.items():
+                values = [record[field] for record in records if record[field] is not None]
+                if len(values) != 0:
+                    lines.append('{}{{{}}} {}'.format(metric, statement_labels(*key), aggregate(values) * scale))
+
+        directory = os.path.dirname(self.__prometheus_path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, self.__prometheus_path)
+
+
+def statement_labels(sql_dir, sql_name, statement_index):
+    return 'sql_dir="{}",sql_name="{}",statement="{}"'.format(
+        escape_label(sql_dir), escape_label(sql_name), escape_label(statement_index)
+    )
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_stats(record):
+    """
+    日志中输出的统计摘要
+    """
+    return "query_id={} state={} wall={}ms queued={}ms cpu={}ms rows={} bytes={} peak_memory={}".format(
+        record['query_id'], record['state'], record['wall_time_ms'], record['queued_time_ms'],
+        record['cpu_time_ms'], record['processed_rows'], record['processed_bytes'], record['peak_memory_bytes']
+    )
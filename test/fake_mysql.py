@@ -0,0 +1,146 @@
+import re
+import time
+import sqlite3
+import threading
+
+
+class FakeMysqlServer:
+    """
+    以 sqlite 文件模拟的 mysql，用于 presqoop 的 benchmark
+
+    **Basic**
+
+    connect() 返回的连接实现 presqoop 用到的 pymysql 连接的子集 (cursor、commit、rollback、escape、close)，
+    执行前把 mysql 的 `标识符` 与 %s 参数转换为 sqlite 的写法，executemany 与 pymysql 一样按 max_stmt_length 分条；
+    每条语句可配置固定的延迟 (在 sqlite 锁之外 sleep)，模拟到 mysql 的网络往返，
+    sqlite 同一时间只有一个写事务，写入的并发度由 latency 决定而不是由 sqlite 决定
+
+    **Usage**
+
+        mysql = FakeMysqlServer('/tmp/bench.db', latency=0.001)
+        mysql.execute('CREATE TABLE bench_target (id INTEGER, value TEXT)')
+        pymysql.connect = mysql.connect
+    """
+
+    def __init__(self, path, latency=0.0):
+        """
+        :params path: sqlite 文件路径
+        :params latency: 每条语句的延迟 (秒)
+        """
+        self.path = path
+        self.latency = latency
+        self.statements = 0
+        self.__lock = threading.Lock()
+
+
+    def execute(self, sql, parameters=()):
+        """
+        直接在 sqlite 中执行 (准备数据用)
+        """
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(sql, parameters)
+
+
+    def executemany(self, sql, rows):
+        with sqlite3.connect(self.path) as connection:
+            connection.executemany(sql, rows)
+
+
+    def count(self, table):
+        with sqlite3.connect(self.path) as connection:
+            return connection.execute('SELECT count(*) FROM {}'.format(table)).fetchone()[0]
+
+
+    def connect(self, **kwargs):
+        """
+        与 pymysql.connect 的参数兼容，连接参数被忽略
+        """
+        return FakeMysqlConnection(self, sqlite3.connect(self.path, timeout=60, check_same_thread=False))
+
+
+    def delay(self):
+        with self.__lock:
+            self.statements += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class FakeMysqlConnection:
+
+    def __init__(self, server, connection):
+        self.__server = server
+        self.__connection = connection
+
+
+    def cursor(self, cursorclass=None):
+        # SSCursor 与普通 cursor 相同，sqlite 的 cursor 本身就是按需读取的
+        return FakeMysqlCursor(self.__server, self.__connection.cursor())
+
+
+    def escape(self, value):
+        return "'{}'".format(str(value).replace("'", "''"))
+
+
+    def commit(self):
+        self.__server.delay()
+        self.__connection.commit()
+
+
+    def rollback(self):
+        self.__connection.rollback()
+
+
+    def close(self):
+        self.__connection.close()
+
+
+class FakeMysqlCursor:
+
+    def __init__(self, server, cursor):
+        self.__server = server
+        self.__cursor = cursor
+        self.max_stmt_length = 1024000
+
+
+    @property
+    def description(self):
+        return self.__cursor.description
+
+
+    def execute(self, sql, args=None):
+        self.__server.delay()
+        sql = re.sub(r'`([^`]*)`', r'"\1"', sql).replace('%s', '?')
+        self.__cursor.execute(sql, args or ())
+        return self.__cursor.rowcount
+
+
+    def executemany(self, sql, rows):
+        """
+        与 pymysql 一样按 max_stmt_length 把多行拼成一条语句发送，每条语句一次延迟 (长度按参数的字符串长度估算)
+        """
+        sql = re.sub(r'`([^`]*)`', r'"\1"', sql).replace('%s', '?')
+        chunk, length = [], 0
+        for row in rows:
+            row_length = sum(len(str(value)) + 3 for value in row) + 3
+            if len(chunk) != 0 and length + row_length > self.max_stmt_length:
+                self.__server.delay()
+                self.__cursor.executemany(sql, chunk)
+                chunk, length = [], 0
+            chunk.append(row)
+            length += row_length
+        if len(chunk) != 0:
+            self.__server.delay()
+            self.__cursor.executemany(sql, chunk)
+        return len(rows)
+
+
+    def fetchone(self):
+        return self.__cursor.fetchone()
+
+
+    def fetchmany(self, size):
+        return self.__cursor.fetchmany(size)
+
+
+    def fetchall(self):
+        return self.__cursor.fetchall()
@@ -0,0 +1,346 @@
+import re
+import json
+import time
+import random
+import itertools
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # 默认的 listen backlog 只有 5，大量连接同时建立时 (asyncio 引擎) 会被丢弃并等待 1s 的 SYN 重传
+    request_queue_size = 128
+
+
+class FakePrestoServer:
+    """
+    本地模拟的 presto coordinator，用于 benchmark
+
+    **Basic**
+
+    实现 presto HTTP statement 协议的最小子集:
+
+    - POST /v1/statement: 提交查询，返回 nextUri
+    - GET /v1/statement/<query_id>/<token>: 按页返回结果，前 queued_polls 次轮询只返回状态
+    - DELETE /v1/statement/<query_id>/<token>: 取消查询
+    - GET /v1/cluster: 集群负载 (runningQueries, queuedQueries 等)
+
+    可配置每次轮询的延迟、每个查询返回的行数与分页大小，以及按比例或按 sql 正则注入失败；
+    SET SESSION / RESET SESSION / USE 会像 presto 一样在结果响应中返回 X-Presto-Set-* 头，
+    每条语句提交时携带的会话记录在 sessions 中
+
+    **Usage**
+
+        server = FakePrestoServer(latency=0.01, rows=100)
+        server.respond(r'placeholder', [{'name': 'ids', 'type': 'array(integer)'}], [[[1, 2, 3]]])
+        server.start()
+        ... host='127.0.0.1', port=server.port ...
+        server.stop()
+    """
+
+    def __init__(self, latency=0.0, rows=1, page_size=1000, queued_polls=1, failure_rate=0.0, fail_pattern=None,
+                 max_running=None):
+        """
+        :params latency: 每次请求的延迟 (秒)
+        :params rows: 每个查询返回的行数
+        :params page_size: 每页的行数
+        :params queued_polls: 返回数据之前只返回状态的轮询次数
+        :params failure_rate: 查询失败的比例
+        :params fail_pattern: sql 匹配该正则时查询失败
+        :params max_running: /v1/cluster 报告的 running 查询数上限，超出的部分报告为 queued
+        """
+        self.latency = latency
+        self.rows = rows
+        self.page_size = page_size
+        self.queued_polls = queued_polls
+        self.failure_rate = failure_rate
+        self.fail_pattern = None if fail_pattern is None else re.compile(fail_pattern, re.I)
+        self.max_running = max_running
+
+        self.queries = {}
+        self.statements = []
+        self.sessions = []
+        self.requests = 0
+        self.__responses = []
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count()
+        self.__server = None
+
+
+    @property
+    def port(self):
+        return self.__server.server_port
+
+
+    def respond(self, pattern, columns, data):
+        """
+        sql 匹配 pattern 时返回固定的结果
+
+        :params pattern: sql 正则
+        :params columns: [{'name': ..., 'type': ...}, ...]
+        :params data: [row, ...]
+        """
+        self.__responses.append((re.compile(pattern, re.I | re.S), columns, data))
+
+
+    def running_queries(self):
+        with self.__lock:
+            return len([query for query in self.queries.values() if not query['finished']])
+
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # 响应头与响应体分两次写出，不关闭 nagle 时 keep-alive 连接上每个请求会多等一个 delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                sql = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                self.send_json(fake.submit(sql, self.base_url(), self.headers))
+
+            def do_GET(self):
+                if self.path.startswith('/v1/cluster'):
+                    self.send_json(fake.cluster())
+                elif self.path.startswith('/v1/statement/'):
+                    parts = self.path.split('/')
+                    body = fake.poll(parts[3], int(parts[4]), self.base_url())
+                    self.send_json(body, headers=fake.queries[parts[3]]['headers'] if 'nextUri' not in body else {})
+                else:
+                    self.send_json({'message': 'not found'}, 404)
+
+            def do_DELETE(self):
+                parts = self.path.split('/')
+                fake.cancel(parts[3])
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def base_url(self):
+                return 'http://{}'.format(self.headers.get('Host'))
+
+            def send_json(self, body, status=200, headers=None):
+                content = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+    def submit(self, sql, base_url, headers=None):
+        self.__delay()
+        query_id = 'fake_{}'.format(next(self.__ids))
+
+        columns = [{'name': 'id', 'type': 'bigint'}, {'name': 'value', 'type': 'varchar'}]
+        data = None
+        for pattern, response_columns, response_data in self.__responses:
+            if pattern.search(sql):
+                columns, data = response_columns, response_data
+                break
+
+        failed = (
+            (self.fail_pattern is not None and self.fail_pattern.search(sql) is not None) or
+            random.random() < self.failure_rate
+        )
+
+        with self.__lock:
+            self.statements.append(sql)
+            self.sessions.append({
+                'catalog': headers.get('X-Presto-Catalog'), 'schema': headers.get('X-Presto-Schema'),
+                'session': headers.get('X-Presto-Session'),
+            } if headers is not None else {})
+            self.queries[query_id] = {
+                'sql': sql, 'columns': columns, 'data': data, 'failed': failed,
+                'finished': False, 'created': time.time(), 'headers': self.__session_headers(sql),
+            }
+
+        return {
+            'id': query_id,
+            'infoUri': '{}/ui/query.html?{}'.format(base_url, query_id),
+            'nextUri': '{}/v1/statement/{}/1'.format(base_url, query_id),
+            'stats': self.__stats(query_id, 'QUEUED', 0),
+        }
+
+
+    def poll(self, query_id, token, base_url):
+        self.__delay()
+        query = self.queries[query_id]
+        response = {'id': query_id, 'infoUri': '{}/ui/query.html?{}'.format(base_url, query_id)}
+
+        if token <= self.queued_polls:
+            response['nextUri'] = '{}/v1/statement/{}/{}'.format(base_url, query_id, token + 1)
+            response['stats'] = self.__stats(query_id, 'RUNNING', 0)
+            return response
+
+        if query['failed']:
+            query['finished'] = True
+            response['stats'] = self.__stats(query_id, 'FAILED', 0)
+            response['error'] = {
+                'message': 'injected failure', 'errorCode': 65536, 'errorName': 'GENERIC_INTERNAL_ERROR',
+                'errorType': 'INTERNAL_ERROR', 'failureInfo': {'type': 'FakeFailure', 'message': 'injected failure'},
+            }
+            return response
+
+        page = token - self.queued_polls - 1
+        if query['data'] is not None:
+            data = query['data'][page * self.page_size:(page + 1) * self.page_size]
+            total = len(query['data'])
+        else:
+            start = page * self.page_size
+            data = [[i, 'value_{}'.format(i)] for i in range(start, min(start + self.page_size, self.rows))]
+            total = self.rows
+
+        response['columns'] = query['columns']
+        response['data'] = data
+        processed = min((page + 1) * self.page_size, total)
+        if processed < total:
+            response['nextUri'] = '{}/v1/statement/{}/{}'.format(base_url, query_id, token + 1)
+            response['stats'] = self.__stats(query_id, 'RUNNING', processed)
+        else:
+            query['finished'] = True
+            response['stats'] = self.__stats(query_id, 'FINISHED', processed)
+        return response
+
+
+    def cancel(self, query_id):
+        if query_id in self.queries:
+            self.queries[query_id]['finished'] = True
+
+
+    def cluster(self):
+        active = self.running_queries()
+        running = active if self.max_running is None else min(active, self.max_running)
+        return {
+            'runningQueries': running,
+            'blockedQueries': 0,
+            'queuedQueries': active - running,
+            'activeWorkers': 1,
+            'runningDrivers': 0,
+            'reservedMemory': 0.0,
+            'totalInputRows': 0,
+            'totalInputBytes': 0,
+            'totalCpuTimeSecs': 0,
+        }
+
+
+    def __stats(self, query_id, state, processed_rows):
+        elapsed = int((time.time() - self.queries[query_id]['created']) * 1000) if query_id in self.queries else 0
+        return {
+            'state': state, 'queued': state == 'QUEUED', 'scheduled': state != 'QUEUED', 'nodes': 1,
+            'totalSplits': 1, 'queuedSplits': 0, 'runningSplits': 0, 'completedSplits': 1,
+            'cpuTimeMillis': elapsed // 2, 'wallTimeMillis': elapsed, 'queuedTimeMillis': 0,
+            'elapsedTimeMillis': elapsed, 'processedRows': processed_rows, 'processedBytes': processed_rows * 16,
+            'peakMemoryBytes': 1024,
+        }
+
+
+    def __session_headers(self, sql):
+        """
+        会话语句在结果响应中返回的头
+        """
+        match = re.match(r'\s*set\s+session\s+(\S+)\s*=\s*(.+?)\s*$', sql, re.I | re.S)
+        if match is not None:
+            return {'X-Presto-Set-Session': '{}={}'.format(match.group(1), match.group(2).strip("'"))}
+
+        match = re.match(r'\s*reset\s+session\s+(\S+)\s*$', sql, re.I)
+        if match is not None:
+            return {'X-Presto-Clear-Session': match.group(1)}
+
+        match = re.match(r'\s*use\s+(?:(\w+)\.)?(\w+)\s*$', sql, re.I)
+        if match is not None:
+            headers = {'X-Presto-Set-Schema': match.group(2)}
+            if match.group(1) is not None:
+                headers['X-Presto-Set-Catalog'] = match.group(1)
+            return headers
+
+        return {}
+
+
+    def __delay(self):
+        with self.__lock:
+            self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class FakeSqlServer:
+    """
+    本地模拟的 sql 脚本服务器 (代替 gitlab raw 地址)，用于 benchmark
+
+    GET /<sql.dir>/<sql.name>.sql 返回 files 中对应的内容，可配置延迟与失败比例
+    """
+
+    def __init__(self, files, latency=0.0, failure_rate=0.0):
+        """
+        :params files: {'<sql.dir>/<sql.name>.sql': sql_text}
+        :params latency: 每次请求的延迟 (秒)
+        :params failure_rate: 返回 500 的比例
+        """
+        self.files = files
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.__server = None
+
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.__server.server_port)
+
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # 响应头与响应体分两次写出，不关闭 nagle 时 keep-alive 连接上每个请求会多等一个 delayed ack
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.requests += 1
+                if fake.latency > 0:
+                    time.sleep(fake.latency)
+
+                path = self.path.split('?')[0].lstrip('/')
+                if random.random() < fake.failure_rate:
+                    status, content = 500, b'injected failure'
+                elif path in fake.files:
+                    status, content = 200, fake.files[path].encode('utf-8')
+                else:
+                    status, content = 404, b'not found'
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_presto import FakePrestoServer
+from fake_mysql import FakeMysqlServer
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRESQOOP_DIR = os.path.join(ROOT_DIR, 'presqoop')
+
+# 结果文件格式的版本，字段含义变化时递增，不同版本的结果不做比较
+BENCHMARK_VERSION = 1
+
+SCENARIOS = ('export', 'import', 'files')
+
+USAGE = """
+    presqoop 的 benchmark
+
+    在本地启动模拟的 presto coordinator (test/fake_presto.py) 与以 sqlite 模拟的 mysql (test/fake_mysql.py)，
+    端到端地执行 Presqoop.execute()，对 --batch-sizes 与 --mappers 的每个组合测量吞吐:
+
+    - export: presto 查询导出到 mysql 表
+    - import: mysql 表导入到 presto 表
+    - files: presto 查询导出为 --target-dir 下的文件
+
+    每次传输的 rows/s、bytes/s、批次大小与 fetch/convert/write 各阶段的耗时取自 presqoop 的 --metrics-path，
+    多次执行 (--runs) 时取 rows/s 的中位数所在的那一次；
+    每个场景的 knee 是 rows/s 达到最大值 --knee-threshold 倍的组合中 mappers 最少、batch size 最小的一个，
+    超过 knee 之后增加 batch size 或 mappers 带来的提升很小
+
+    --presto-latency 与 --mysql-latency 模拟网络往返，为 0 时结果只反映本机的 cpu 开销，
+    sqlite 同一时间只有一个写事务，增加 mappers 的收益来自于重叠各条语句的延迟
+
+    example
+    -------
+    python3 test/presqoop-benchmark.py --output bench.json
+    python3 test/presqoop-benchmark.py --scenarios export --rows 200000 --batch-sizes 100 1000 10000 --mappers 1 4 16
+    python3 test/presqoop-benchmark.py --presto-latency 0.005 --mysql-latency 0.002 --output bench.json
+"""
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_presqoop(mysql, verbose=False):
+    """
+    以模块的方式加载 presqoop/presqoop.py，mysql 连接替换为 FakeMysqlServer
+    """
+    sys.path.insert(0, PRESQOOP_DIR)
+    import pymysql
+    import presqoop
+
+    pymysql.connect = mysql.connect
+    if not verbose:
+        presqoop.logger.setLevel(logging.CRITICAL)
+    return presqoop
+
+
+def presqoop_argv(execute_type, presto_port, metrics_path, batch_size, mappers, options=()):
+    return [
+        'presqoop.py', execute_type,
+        '--presto-host', '127.0.0.1',
+        '--presto-port', str(presto_port),
+        '--presto-user', 'bench',
+        '--presto-catalog', 'bench',
+        '--presto-schema', 'bench',
+        '--mysql-host', '127.0.0.1',
+        '--mysql-user', 'bench',
+        '--mysql-database', 'bench',
+        '--split-by', 'id',
+        '--num-mappers', str(mappers),
+        '--batch-size', str(batch_size),
+        '--progress-interval', '0',
+        '--metrics-path', metrics_path,
+    ] + list(options)
+
+
+def run_transfer(presqoop, argv):
+    """
+    执行一次传输 (Presqoop() + execute())
+
+    :return: presqoop 写入 --metrics-path 的统计，失败时返回 None
+    """
+    metrics_path = argv[argv.index('--metrics-path') + 1]
+    if os.path.exists(metrics_path):
+        os.remove(metrics_path)
+
+    sys.argv = argv
+    try:
+        presqoop.Presqoop().execute()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return None
+
+    with open(metrics_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+class Bench:
+    """
+    每个场景的数据准备与一次传输的参数
+    """
+
+    def __init__(self, args, work_dir, presto, mysql):
+        self.args = args
+        self.work_dir = work_dir
+        self.presto = presto
+        self.mysql = mysql
+        self.metrics_path = os.path.join(work_dir, 'metrics.json')
+
+
+    def prepare(self, scenario):
+        if scenario == 'import':
+            self.mysql.execute('DROP TABLE IF EXISTS bench_source')
+            self.mysql.execute('CREATE TABLE bench_source (id INTEGER PRIMARY KEY, value TEXT)')
+            self.mysql.executemany(
+                'INSERT INTO bench_source VALUES (?, ?)',
+                ((i, 'value_{}'.format(i)) for i in range(1, self.args.rows + 1))
+            )
+
+
+    def argv(self, scenario, batch_size, mappers):
+        port = self.presto.port
+        if scenario == 'export':
+            self.mysql.execute('DROP TABLE IF EXISTS bench_target')
+            self.mysql.execute('CREATE TABLE bench_target (id INTEGER, value TEXT)')
+            self.split_rows(mappers)
+            return presqoop_argv('export', port, self.metrics_path, batch_size, mappers, [
+                '--table', 'bench_source', '--mysql-table', 'bench_target',
+            ])
+
+        if scenario == 'import':
+            return presqoop_argv('import', port, self.metrics_path, batch_size, mappers, [
+                '--mysql-table', 'bench_source', '--table', 'bench_target',
+                '--max-statement-length', str(self.args.max_statement_length),
+            ])
+
+        self.split_rows(mappers)
+        return presqoop_argv('export', port, self.metrics_path, batch_size, mappers, [
+            '--table', 'bench_source',
+            '--target-dir', os.path.join(self.work_dir, 'files'), '--delete-target-dir',
+            '--file-format', self.args.file_format, '--compression', self.args.compression,
+        ])
+
+
+    def split_rows(self, mappers):
+        """
+        模拟的 presto 对每个 split 的查询都返回 presto.rows 行，按 mappers 平分使总行数不变
+        """
+        self.presto.rows = self.args.rows // mappers
+
+
+def find_knee(results, threshold):
+    """
+    rows/s 达到最大值 threshold 倍的组合中 mappers 最少、batch size 最小的一个
+    """
+    succeeded = [result for result in results if result.get('rows_per_sec')]
+    if len(succeeded) == 0:
+        return None
+    best = max(result['rows_per_sec'] for result in succeeded)
+    candidates = [result for result in succeeded if result['rows_per_sec'] >= best * threshold]
+    knee = min(candidates, key=lambda result: (result['mappers'], result['batch_size']))
+    return {
+        'batch_size': knee['batch_size'],
+        'mappers': knee['mappers'],
+        'rows_per_sec': knee['rows_per_sec'],
+        'max_rows_per_sec': best,
+    }
+
+
+def bench_scenario(args, bench, presqoop, scenario):
+    bench.prepare(scenario)
+    results = []
+    for mappers in args.mappers:
+        for batch_size in args.batch_sizes:
+            runs = []
+            for _ in range(args.runs):
+                metrics = run_transfer(presqoop, bench.argv(scenario, batch_size, mappers))
+                if metrics is not None:
+                    runs.append(metrics)
+
+            result = {'batch_size': batch_size, 'mappers': mappers, 'failed': args.runs - len(runs)}
+            if len(runs) != 0:
+                median = statistics.median_low(metrics['rows_per_sec'] for metrics in runs)
+                metrics = next(metrics for metrics in runs if metrics['rows_per_sec'] == median)
+                result.update({
+                    'rows': metrics['rows'],
+                    'seconds': metrics['elapsed_seconds'],
+                    'rows_per_sec': metrics['rows_per_sec'],
+                    'bytes_per_sec': metrics['bytes_per_sec'],
+                    'statements': metrics['statements'],
+                    'batches': metrics['batches'],
+                    'stages': {name: stage['seconds'] for name, stage in metrics['stages'].items()},
+                })
+            results.append(result)
+            print("{:<7} mappers={:<3} batch_size={:<6} {}".format(
+                scenario, mappers, batch_size,
+                '{:.0f} rows/s'.format(result['rows_per_sec']) if 'rows_per_sec' in result else 'failed'
+            ), file=sys.stderr)
+
+    return {'runs': results, 'knee': find_knee(results, args.knee_threshold)}
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix='presqoop-bench-')
+    presto = FakePrestoServer(latency=args.presto_latency, page_size=args.page_size, queued_polls=0)
+    presto.respond(r'min\(', [{'name': '_col0', 'type': 'bigint'}, {'name': '_col1', 'type': 'bigint'}], [[0, args.rows]])
+    presto.respond(r'^DESCRIBE', [{'name': 'Column', 'type': 'varchar'}, {'name': 'Type', 'type': 'varchar'}], [
+        ['id', 'bigint'], ['value', 'varchar'],
+    ])
+    presto.respond(r'^INSERT', [{'name': 'rows', 'type': 'bigint'}], [[0]])
+    mysql = FakeMysqlServer(os.path.join(work_dir, 'bench.db'), latency=args.mysql_latency)
+    presto.start()
+
+    results = {}
+    try:
+        presqoop = load_presqoop(mysql, args.verbose)
+        bench = Bench(args, work_dir, presto, mysql)
+        for scenario in args.scenarios:
+            print("running {} ...".format(scenario), file=sys.stderr)
+            results[scenario] = bench_scenario(args, bench, presqoop, scenario)
+    finally:
+        presto.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'benchmark': 'presqoop',
+        'version': BENCHMARK_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'rows': args.rows,
+            'batch_sizes': args.batch_sizes,
+            'mappers': args.mappers,
+            'runs': args.runs,
+            'presto_latency': args.presto_latency,
+            'mysql_latency': args.mysql_latency,
+            'page_size': args.page_size,
+            'max_statement_length': args.max_statement_length,
+            'file_format': args.file_format,
+            'compression': args.compression,
+            'knee_threshold': args.knee_threshold,
+        },
+        'results': results,
+    }
+
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
+
+    for scenario, result in results.items():
+        knee = result['knee']
+        if knee is None:
+            print("{}: all runs failed".format(scenario), file=sys.stderr)
+        else:
+            print("{}: knee at mappers={} batch_size={} ({:.0f} rows/s, max {:.0f} rows/s)".format(
+                scenario, knee['mappers'], knee['batch_size'], knee['rows_per_sec'], knee['max_rows_per_sec']
+            ), file=sys.stderr)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 presqoop-benchmark.py", description=USAGE, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--scenarios', action='store', dest='scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+        help="scenarios to run, default all"
+    )
+    parser.add_argument(
+        '--rows', action='store', dest='rows', type=int, default=100000,
+        help="rows of every transfer, default 100000"
+    )
+    parser.add_argument(
+        '--batch-sizes', action='store', dest='batch_sizes', type=int, nargs='+', default=[100, 1000, 10000],
+        help="--batch-size values to sweep, default 100 1000 10000"
+    )
+    parser.add_argument(
+        '--mappers', action='store', dest='mappers', type=int, nargs='+', default=[1, 2, 4, 8],
+        help="--num-mappers values to sweep, default 1 2 4 8"
+    )
+    parser.add_argument(
+        '--runs', action='store', dest='runs', type=int, default=1,
+        help="runs of every combination, the median is reported, default 1"
+    )
+    parser.add_argument(
+        '--presto-latency', action='store', dest='presto_latency', type=float, default=0.0,
+        help="fake presto latency of every request in seconds, default 0"
+    )
+    parser.add_argument(
+        '--mysql-latency', action='store', dest='mysql_latency', type=float, default=0.0,
+        help="fake mysql latency of every statement and commit in seconds, default 0"
+    )
+    parser.add_argument(
+        '--page-size', action='store', dest='page_size', type=int, default=1000,
+        help="rows of every fake presto result page, default 1000"
+    )
+    parser.add_argument(
+        '--max-statement-length', action='store', dest='max_statement_length', type=int, default=1000000,
+        help="--max-statement-length of the import scenario, default 1000000"
+    )
+    parser.add_argument(
+        '--file-format', action='store', dest='file_format', default='csv',
+        help="--file-format of the files scenario, default csv"
+    )
+    parser.add_argument(
+        '--compression', action='store', dest='compression', default='gzip',
+        help="--compression of the files scenario, default gzip"
+    )
+    parser.add_argument(
+        '--knee-threshold', action='store', dest='knee_threshold', type=float, default=0.9,
+        help="fraction of the max rows/s that counts as the knee, default 0.9"
+    )
+    parser.add_argument('--output', action='store', dest='output', help="write results to this json file")
+    parser.add_argument('--verbose', action='store_true', dest='verbose', default=False, help="show presqoop output")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args(sys.argv[1:]))
@@ -0,0 +1,514 @@
+import io
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import resource
+import statistics
+import subprocess
+import contextlib
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_presto import FakePrestoServer, FakeSqlServer
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ETL_DIR = os.path.join(ROOT_DIR, 'presto-etl')
+ETL_SCRIPT = os.path.join(ETL_DIR, 'presto-etl.py')
+
+# 结果文件格式的版本，字段含义变化时递增，不同版本的结果不做比较
+BENCHMARK_VERSION = 1
+
+SQL_DIR = 'bench'
+
+SCENARIOS = ('startup', 'imports', 'jobs', 'statements', 'placeholder')
+
+# --usage / -h / 参数检查不应导入的模块
+DEFERRED_MODULES = (
+    'prestodb', 'requests', 'urllib3', 'coloredlogs', 'humanfriendly', 'aiohttp', 'pyarrow', 'zstandard',
+    'sqlite3', 'zipfile', 'tarfile', 'pandas', 'sqlalchemy',
+)
+
+# imports 场景检查的命令行: (名称, 参数)
+IMPORT_PATHS = [('usage', ['--usage']), ('help', ['-h']), ('invalid', ['--presto.host', '127.0.0.1'])]
+
+USAGE = """
+    presto-etl 的 benchmark
+
+    在本地启动模拟的 presto coordinator 与 sql 脚本服务器 (test/fake_presto.py)，
+    端到端地执行 PrestoETL.execute()，测量:
+
+    - startup: python3 presto-etl.py --usage / -h 的启动耗时
+    - imports: --usage / -h / 参数检查的 import 耗时 (-X importtime)，超出 --import.budget.ms
+      或导入了 prestodb、requests、coloredlogs 等模块时，benchmark 以 1 退出
+    - jobs: 连续执行多个 job 的 jobs/sec
+    - statements: 单个 job 执行多条语句的 statements/sec
+    - placeholder: placeholder 组合数 (fan-out) 与 --placeholder.parallelism 的扩展性
+
+    除 startup 外，每个场景在独立的子进程中执行，peak_rss_mb 为该子进程的内存峰值
+
+    example
+    -------
+    python3 test/presto-etl-benchmark.py --output bench.json
+    python3 test/presto-etl-benchmark.py --latency 0.01 --fanout 10 100 --parallelism 1 8 --output bench.json
+    python3 test/presto-etl-benchmark.py --output new.json --compare bench.json
+    python3 test/presto-etl-benchmark.py --scenarios imports --import.budget.ms 100
+"""
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    进程的内存峰值 (MB)，linux 上 ru_maxrss 单位为 KB，macOS 上为字节
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    return round(maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+def summarize(samples):
+    return {
+        'median': round(statistics.median(samples), 6),
+        'min': round(min(samples), 6),
+        'max': round(max(samples), 6),
+        'runs': len(samples),
+    }
+
+
+def rate(count, seconds):
+    return round(count / seconds, 3) if seconds > 0 else None
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sql_files(args):
+    """
+    benchmark 使用的 sql 脚本
+
+    :return: {'<sql.dir>/<sql.name>.sql': sql_text}
+    """
+    files = {
+        '{}/job.sql'.format(SQL_DIR): 'select id, value from bench_source',
+        '{}/statements.sql'.format(SQL_DIR): ';\n'.join(
+            'select id, value from bench_source_{}'.format(i) for i in range(args.statements)
+        ),
+        '{}/fanout.sql'.format(SQL_DIR): 'insert into bench_target select id, value from bench_source where id = {id}',
+    }
+    for fanout in args.fanout:
+        files['{}/fanout-placeholders-{}.sql'.format(SQL_DIR, fanout)] = 'select sequence(1, {}) as id'.format(fanout)
+    return files
+
+
+def etl_argv(args, presto_port, sql_url, sql_names, options=()):
+    return [
+        ETL_SCRIPT,
+        '--presto.host', '127.0.0.1',
+        '--presto.port', str(presto_port),
+        '--presto.user', 'bench',
+        '--presto.catalog', 'bench',
+        '--presto.schema', 'bench',
+        '--presto.engine', args.engine,
+        '--sql.url.prefix', sql_url,
+        '--sql.dir', SQL_DIR,
+        '--sql.names', *sql_names,
+    ] + list(options)
+
+
+def load_presto_etl(verbose=False):
+    """
+    以模块的方式加载 presto-etl/presto-etl.py
+    """
+    sys.path.insert(0, ETL_DIR)
+    spec = importlib.util.spec_from_file_location('presto_etl', ETL_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if not verbose:
+        # 先安装 coloredlogs，否则 PrestoETL() 安装时会把日志级别重置为 INFO
+        module.install_logging()
+        module.logger.setLevel(logging.CRITICAL)
+    return module
+
+
+def run_job(presto_etl, argv, verbose=False):
+    """
+    执行一个 job (PrestoETL() + execute())
+
+    :return: (是否成功, 耗时)
+    """
+    sys.argv = argv
+    output = sys.stdout if verbose else io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            presto_etl.PrestoETL().execute()
+        ok = True
+    except SystemExit as e:
+        ok = e.code in (None, 0)
+    except Exception:
+        # 与命令行执行时一样，未处理的异常 (例如查询失败) 视为 job 失败
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def child_jobs(args, presto_etl, presto_port, sql_url):
+    argv = etl_argv(args, presto_port, sql_url, ['job'])
+    durations, failed = [], 0
+    for _ in range(args.jobs):
+        ok, seconds = run_job(presto_etl, argv, args.verbose)
+        durations.append(seconds)
+        failed += 0 if ok else 1
+
+    total = sum(durations)
+    return {
+        'jobs': args.jobs,
+        'failed': failed,
+        'seconds': round(total, 6),
+        'jobs_per_sec': rate(args.jobs, total),
+        'job_seconds': summarize(durations),
+    }
+
+
+def child_statements(args, presto_etl, presto_port, sql_url):
+    argv = etl_argv(args, presto_port, sql_url, ['statements'])
+    ok, seconds = run_job(presto_etl, argv, args.verbose)
+    return {
+        'statements': args.statements,
+        'rows_per_statement': args.rows,
+        'failed': 0 if ok else 1,
+        'seconds': round(seconds, 6),
+        'statements_per_sec': rate(args.statements, seconds),
+        'rows_per_sec': rate(args.statements * args.rows, seconds),
+    }
+
+
+def child_placeholder(args, presto_etl, presto_port, sql_url):
+    results = []
+    for fanout in args.fanout:
+        baseline = None
+        for parallelism in args.parallelism:
+            argv = etl_argv(args, presto_port, sql_url, ['fanout'], [
+                '--placeholder.config', 'fanout:fanout-placeholders-{}'.format(fanout),
+                '--placeholder.parallelism', str(parallelism),
+                '--placeholder.continue.on.error',
+            ])
+            ok, seconds = run_job(presto_etl, argv, args.verbose)
+            if baseline is None:
+                baseline = seconds
+            results.append({
+                'fanout': fanout,
+                'parallelism': parallelism,
+                'failed': 0 if ok else 1,
+                'seconds': round(seconds, 6),
+                'statements_per_sec': rate(fanout, seconds),
+                'speedup': round(baseline / seconds, 3) if seconds > 0 else None,
+            })
+    return results
+
+
+def run_child(args):
+    """
+    子进程: 执行一个场景，结果以 json 输出到 stdout
+    """
+    presto_port, sql_url = args.child_presto_port, args.child_sql_url
+    presto_etl = load_presto_etl(args.verbose)
+    scenario = {
+        'jobs': child_jobs,
+        'statements': child_statements,
+        'placeholder': child_placeholder,
+    }[args.child]
+
+    result = scenario(args, presto_etl, presto_port, sql_url)
+    sys.stdout = sys.__stdout__
+    print(json.dumps({'result': result, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def bench_startup(args):
+    """
+    启动耗时: 每次启动新的解释器执行 --usage 与 -h
+    """
+    result = {}
+    for name, option in [('usage', '--usage'), ('help', '-h')]:
+        durations = []
+        for _ in range(args.startup_runs):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, ETL_SCRIPT, option], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+            )
+            durations.append(time.perf_counter() - start)
+        result['{}_seconds'.format(name)] = summarize(durations)
+    result['peak_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    return result
+
+
+def import_time(arguments):
+    """
+    通过 -X importtime 统计 import 耗时
+
+    :params arguments: python 解释器的参数
+    :return: (顶层 import 的累计耗时 {module: 微秒}, 导入的全部模块)
+    """
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + arguments, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    top_level, modules = {}, set()
+    for line in process.stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if not name.startswith('  '):
+            top_level[name.strip()] = int(cumulative)
+    return top_level, modules
+
+
+def bench_imports(args):
+    """
+    import 耗时: 扣除空解释器 (python -c pass) 本身的 import 后，presto-etl.py 各命令行路径的 import 耗时
+    """
+    interpreter, _ = import_time(['-c', 'pass'])
+    result = {'budget_ms': args.import_budget_ms, 'ok': True}
+    for name, arguments in IMPORT_PATHS:
+        durations, deferred = [], set()
+        for _ in range(args.startup_runs):
+            top_level, modules = import_time([ETL_SCRIPT] + arguments)
+            durations.append(sum(us for module, us in top_level.items() if module not in interpreter) / 1000)
+            deferred.update(module for module in modules if module.split('.')[0] in DEFERRED_MODULES)
+
+        import_ms = summarize(durations)
+        within_budget = import_ms['median'] <= args.import_budget_ms
+        result[name] = {
+            'import_ms': import_ms,
+            'within_budget': within_budget,
+            'deferred_modules_imported': sorted(deferred),
+        }
+        if not within_budget or len(deferred) != 0:
+            result['ok'] = False
+            print("imports: {} takes {}ms (budget {}ms), deferred modules imported: {}".format(
+                name, import_ms['median'], args.import_budget_ms, sorted(deferred)
+            ), file=sys.stderr)
+    return result
+
+
+def bench_scenario(args, scenario, presto, sql_server):
+    """
+    在子进程中执行场景，附加该场景期间 presto 收到的语句数与请求数
+    """
+    statements, requests = len(presto.statements), presto.requests
+    command = [sys.executable, os.path.abspath(__file__)] + args.raw_argv + [
+        '--child', scenario,
+        '--child-presto-port', str(presto.port),
+        '--child-sql-url', sql_server.url,
+    ]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=None if args.verbose else subprocess.PIPE)
+    if process.returncode != 0:
+        # 场景本身出错 (不是注入的查询失败) 时记录错误，继续执行其余场景
+        error = process.stderr.decode('utf-8').strip().splitlines()[-1:] if process.stderr else []
+        print("scenario {} crashed: {}".format(scenario, ''.join(error)), file=sys.stderr)
+        return {'error': ''.join(error) or 'exit code {}'.format(process.returncode)}
+
+    output = json.loads(process.stdout.decode('utf-8').strip().splitlines()[-1])
+    return {
+        'result': output['result'],
+        'peak_rss_mb': output['peak_rss_mb'],
+        'presto_statements': len(presto.statements) - statements,
+        'presto_requests': presto.requests - requests,
+    }
+
+
+def flatten(value, prefix=''):
+    """
+    将结果展开为 {'a.b.c': number}，用于比较
+    """
+    items = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            items.update(flatten(item, '{}.{}'.format(prefix, key) if prefix else key))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, dict) and 'fanout' in item:
+                key = 'fanout={}.parallelism={}'.format(item['fanout'], item['parallelism'])
+            else:
+                key = str(index)
+            items.update(flatten(item, '{}.{}'.format(prefix, key)))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        items[prefix] = value
+    return items
+
+
+def compare(baseline, current):
+    """
+    输出与 baseline 结果文件的对比
+    """
+    if baseline.get('version') != current.get('version'):
+        print("baseline version {} != current version {}, skip comparing".format(
+            baseline.get('version'), current.get('version')
+        ))
+        return
+
+    old, new = flatten(baseline['results']), flatten(current['results'])
+    print("{:<64} {:>14} {:>14} {:>9}".format('metric', 'baseline', 'current', 'change'))
+    for key in sorted(set(old) & set(new)):
+        change = '{:+.1%}'.format((new[key] - old[key]) / old[key]) if old[key] != 0 else ''
+        print("{:<64} {:>14} {:>14} {:>9}".format(key, old[key], new[key], change))
+
+
+def run(args):
+    files = sql_files(args)
+    presto = FakePrestoServer(
+        latency=args.latency, rows=args.rows, page_size=args.page_size,
+        failure_rate=args.failure_rate, fail_pattern=args.fail_pattern
+    )
+    for fanout in args.fanout:
+        presto.respond(
+            r'sequence\(1, {}\)'.format(fanout), [{'name': 'id', 'type': 'array(bigint)'}], [[list(range(1, fanout + 1))]]
+        )
+    sql_server = FakeSqlServer(files, latency=args.sql_latency, failure_rate=args.sql_failure_rate)
+    presto.start()
+    sql_server.start()
+
+    results = {}
+    try:
+        for scenario in args.scenarios:
+            print("running {} ...".format(scenario), file=sys.stderr)
+            if scenario == 'startup':
+                results[scenario] = bench_startup(args)
+            elif scenario == 'imports':
+                results[scenario] = bench_imports(args)
+            else:
+                results[scenario] = bench_scenario(args, scenario, presto, sql_server)
+    finally:
+        presto.stop()
+        sql_server.stop()
+
+    report = {
+        'benchmark': 'presto-etl',
+        'version': BENCHMARK_VERSION,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'engine': args.engine,
+            'latency': args.latency,
+            'rows': args.rows,
+            'page_size': args.page_size,
+            'failure_rate': args.failure_rate,
+            'fail_pattern': args.fail_pattern,
+            'sql_latency': args.sql_latency,
+            'sql_failure_rate': args.sql_failure_rate,
+            'jobs': args.jobs,
+            'statements': args.statements,
+            'fanout': args.fanout,
+            'parallelism': args.parallelism,
+            'startup_runs': args.startup_runs,
+            'import_budget_ms': args.import_budget_ms,
+        },
+        'results': results,
+    }
+
+    content = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(content + '\n')
+    else:
+        print(content)
+
+    if args.compare is not None:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+    if not results.get('imports', {}).get('ok', True):
+        sys.exit(1)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog="python3 presto-etl-benchmark.py", description=USAGE, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '--scenarios', action='store', dest='scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS),
+        help="scenarios to run, default all"
+    )
+    parser.add_argument(
+        '--engine', action='store', dest='engine', choices=['dbapi', 'asyncio'], default='dbapi',
+        help="--presto.engine of presto-etl, default dbapi"
+    )
+    parser.add_argument(
+        '--latency', action='store', dest='latency', type=float, default=0.0,
+        help="fake presto latency of every request in seconds, default 0"
+    )
+    parser.add_argument(
+        '--rows', action='store', dest='rows', type=int, default=100, help="rows returned by every query, default 100"
+    )
+    parser.add_argument(
+        '--page.size', action='store', dest='page_size', type=int, default=1000,
+        help="rows of every fake presto result page, default 1000"
+    )
+    parser.add_argument(
+        '--failure.rate', action='store', dest='failure_rate', type=float, default=0.0,
+        help="fraction of fake presto queries that fail, default 0"
+    )
+    parser.add_argument(
+        '--fail.pattern', action='store', dest='fail_pattern',
+        help="fake presto queries matching this regex fail"
+    )
+    parser.add_argument(
+        '--sql.latency', action='store', dest='sql_latency', type=float, default=0.0,
+        help="fake sql server latency in seconds, default 0"
+    )
+    parser.add_argument(
+        '--sql.failure.rate', action='store', dest='sql_failure_rate', type=float, default=0.0,
+        help="fraction of fake sql server requests answered with 500, default 0"
+    )
+    parser.add_argument(
+        '--jobs', action='store', dest='jobs', type=int, default=20, help="jobs of the jobs scenario, default 20"
+    )
+    parser.add_argument(
+        '--statements', action='store', dest='statements', type=int, default=100,
+        help="statements of the statements scenario, default 100"
+    )
+    parser.add_argument(
+        '--fanout', action='store', dest='fanout', type=int, nargs='+', default=[10, 100],
+        help="placeholder combinations of the placeholder scenario, default 10 100"
+    )
+    parser.add_argument(
+        '--parallelism', action='store', dest='parallelism', type=int, nargs='+', default=[1, 4, 16],
+        help="--placeholder.parallelism of the placeholder scenario, default 1 4 16"
+    )
+    parser.add_argument(
+        '--startup.runs', action='store', dest='startup_runs', type=int, default=5,
+        help="runs of the startup scenario, default 5"
+    )
+    parser.add_argument(
+        '--import.budget.ms', action='store', dest='import_budget_ms', type=float, default=150,
+        help="import time budget of --usage / -h / argument validation in milliseconds, default 150"
+    )
+    parser.add_argument('--output', action='store', dest='output', help="write results to this json file")
+    parser.add_argument('--compare', action='store', dest='compare', help="compare results with this json file")
+    parser.add_argument('--verbose', action='store_true', dest='verbose', default=False, help="show presto-etl output")
+
+    # 子进程内部使用
+    parser.add_argument('--child', action='store', dest='child', help=argparse.SUPPRESS)
+    parser.add_argument('--child-presto-port', action='store', dest='child_presto_port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--child-sql-url', action='store', dest='child_sql_url', help=argparse.SUPPRESS)
+
+    args = parser.parse_args(argv)
+    args.raw_argv = list(argv)
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.child is not None:
+        run_child(args)
+    else:
+        run(args)